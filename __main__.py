@@ -1,9 +1,11 @@
 # Import backend
 import skewed
 from process_signal import process_signal
+import batch
 # Import other
 import cutie
 import os
+import sys
 
 # This file contains the user interface of the application and servers as its starting point
 
@@ -19,7 +21,7 @@ sm_ppg=50 # PPG smoothing window in ms
 sm_vpg=10 # VPG smoothing window in ms
 sm_apg=10 # APG smoothing window in ms
 sm_jpg=10 # JPG smoothing window in ms
-saving_format='csv' # Output file format ('csv', 'mat', 'both')
+saving_format='csv' # Output file format ('csv', 'mat', 'both', 'npz')
 saving_folder='results' # Output folder
 gauss = True # Perform Gaussian decomposition
 gauss_live_plot = False # Plot Gaussian decomposition for each pulse
@@ -27,6 +29,12 @@ g_values = [0.9, 0.2, 0.01, 2/3, 0.4, 0.01, 0.5, 0.6, 0.01, 1/3, 0.8, 0.01] # In
 skewed = True # Perform skewed Gaussian decomposition
 skewed_live_plot = False # Plot skewed Gaussian decomposition for each pulse
 s_values = [0.08, 0.2, 1/8, 1, 0.04, 0.4, 1/8, 1, 0.04, 0.6, 1/8, 1, 0.02, 0.8, 1/8, 1] # Initial skewed Gaussian parameters
+workers = 1 # Number of worker processes for pulse decomposition (1 to disable parallel processing)
+warm_start = False # Seed the decomposition of each pulse with the parameters of the previous pulse
+backend = 'curve_fit' # Fitting backend ('curve_fit' for SciPy per pulse, 'batch' for all pulses at once)
+resample = None # Number of points each pulse is resampled to before decomposition (None to disable)
+fit_cache = None # File caching decomposition results between runs (None to disable)
+signal_cache = None # Folder caching filtered signals and fiducial points between runs (None to disable)
 
 def main():
     '''
@@ -52,6 +60,12 @@ def main():
     global s_values
     global saving_format
     global saving_folder
+    global workers
+    global warm_start
+    global backend
+    global resample
+    global fit_cache
+    global signal_cache
 
     # Create a menu
     print("shefPPGf - a Python tool for PPG feature extraction.")
@@ -81,13 +95,20 @@ def main():
         f"Apply skewed Gaussian decomposition: {skewed}",
         f"Enable live plotting: {skewed_live_plot}",
         f"Initial parameters: {s_values}",
+        "===PERFORMANCE===",
+        f"Worker processes: {workers}",
+        f"Warm start from previous pulse: {warm_start}",
+        f"Fitting backend: {backend}",
+        f"Resample pulses to (points): {resample}",
+        f"Fit cache file: {fit_cache}",
+        f"Signal cache folder: {signal_cache}",
         "===OUTPUT OPTIONS===",
         f"Output filetype: {saving_format}",
         f"Output folder: {saving_folder}",
         "======",
         "PROCEED"
     ]
-    captions = [1,5,9,14,18,22,25]
+    captions = [1,5,9,14,18,22,29,32]
     option = cutie.select(options, captions)
 
     # Handle options
@@ -130,16 +151,35 @@ def main():
             os.system('cls')
             skewed_params()
         case 23:
+            workers = cutie.get_number("Please input the number of worker processes (1 to disable parallel processing): ", 1, None, False)
+        case 24:
+            warm_start = not warm_start
+        case 25:
+            print("Please select the fitting backend:")
+            backend_options = ["curve_fit", "batch"]
+            backend_index = cutie.select(backend_options)
+            backend = backend_options[backend_index]
+        case 26:
+            resample = cutie.get_number("Please input the number of points per pulse (0 to disable resampling): ", 0, None, False)
+            if resample == 0:
+                resample = None
+        case 27:
+            cache_path = input("Please input the file in which decomposition results will be cached (or leave empty to disable caching): ")
+            fit_cache = cache_path.strip() or None
+        case 28:
+            cache_path = input("Please input the folder in which filtered signals will be cached (or leave empty to disable caching): ")
+            signal_cache = cache_path.strip() or None
+        case 30:
             print("Please select the output format:")
-            format_options = ["csv", "mat", "both"]
+            format_options = ["csv", "mat", "both", "npz"]
             format_index = cutie.select(format_options)
             saving_format = format_options[format_index]
-        case 24:
+        case 31:
             savingfolder = input("Please input the output folder in which PPG features will be saved (or leave empty for the default folder): ")
             if not savingfolder.strip():
                 saving_folder = "results"
-        case 26:
-            process_signal(path=path, fs=fs, start=start, end=end, fL=fL, fH=fH, order=order, sm_wins={'ppg':sm_ppg, 'vpg':sm_vpg, 'apg':sm_apg, 'jpg':sm_jpg}, enable_gauss=gauss, gauss_live_plot=gauss_live_plot, g_values=g_values, enable_skewed=skewed, skewed_live_plot=skewed_live_plot, s_values=s_values, savingformat=saving_format, savingfolder=saving_folder)
+        case 33:
+            process_signal(path=path, fs=fs, start=start, end=end, fL=fL, fH=fH, order=order, sm_wins={'ppg':sm_ppg, 'vpg':sm_vpg, 'apg':sm_apg, 'jpg':sm_jpg}, enable_gauss=gauss, gauss_live_plot=gauss_live_plot, g_values=g_values, enable_skewed=skewed, skewed_live_plot=skewed_live_plot, s_values=s_values, savingformat=saving_format, savingfolder=saving_folder, workers=workers, warm_start=warm_start, backend=backend, resample=resample, fit_cache=fit_cache, signal_cache=signal_cache)
             quit(0)
 
     # Reset
@@ -317,5 +357,8 @@ def skewed_params():
             return
 
 if __name__ == '__main__':
+    # Command line arguments start the non-interactive batch mode
+    if len(sys.argv) > 1:
+        sys.exit(batch.main(sys.argv[1:]))
     os.system('cls')
     main()
\ No newline at end of file
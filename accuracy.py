@@ -0,0 +1,231 @@
+import argparse
+import inspect
+import json
+import sys
+import time
+from functools import partial
+import numpy as np
+import pandas as pd
+import batch_fit
+import gaussian
+import skewed
+import process_signal as ps
+import synthetic
+
+# This file contains a harness which compares the accuracy and speed of pulse decomposition solvers on synthetic pulses
+# with known parameters
+
+# Initial values of the parameters (as in the interactive menu)
+default_initials = {'gaussian': [0.9, 0.2, 0.01, 2/3, 0.4, 0.01, 0.5, 0.6, 0.01, 1/3, 0.8, 0.01],
+                    'skewed': [0.08, 0.2, 1/8, 1, 0.04, 0.4, 1/8, 1, 0.04, 0.6, 1/8, 1, 0.02, 0.8, 1/8, 1]}
+
+# Fitting function, model function and Jacobian of every model
+models = {'gaussian': (gaussian.find_gaussians, gaussian.gaussians, gaussian.gaussians_jacobian),
+          'skewed': (skewed.fit, skewed.skewed_gaussian4, skewed.skewed_gaussian4_jacobian)}
+
+# Solver configurations compared by default (options of make_solver)
+configurations = {'curve_fit': {},
+                  'curve_fit_warm': {'warm_start': True},
+                  'batch': {'backend': 'batch'},
+                  'batch_fast': {'backend': 'batch', 'max_iter': 100, 'ftol': 1e-6, 'xtol': 1e-6},
+                  'batch_resample_128': {'backend': 'batch', 'resample': 128}}
+
+# Derived Gaussian features compared with the ground truth
+derived_features = ['AI', 'RI', 'Sys/Dia']
+
+def make_solver(model, backend='curve_fit', warm_start=False, maxfev=None, max_iter=1000, ftol=1e-8, xtol=1e-8, resample=None):
+    '''
+    Creates a solver fitting a list of pulses with the given settings.
+
+    :param model: Name of the model - 'gaussian' or 'skewed'
+    :param backend: Fitting backend - 'curve_fit' to fit pulses one by one with SciPy, or 'batch' to fit all pulses at
+        once with the batched Levenberg-Marquardt engine
+    :param warm_start: A boolean to seed each fit with the parameters of the previous pulse (curve_fit only)
+    :param maxfev: Maximum number of function evaluations of every fit (curve_fit only, None for the default)
+    :param max_iter: Maximum number of iterations (batch only)
+    :param ftol: Relative reduction of the sum of squares at which a fit stops (batch only)
+    :param xtol: Relative change of the parameters at which a fit stops (batch only)
+    :param resample: Number of points every pulse is resampled to before fitting (None to fit the original pulses)
+    :return: A function taking a list of pulses and initial values, and returning the fitted parameters by pulse
+    '''
+    if backend not in ps.backends:
+        raise ValueError(f"Unknown fitting backend: {backend}")
+    fit, function, jacobian = models[model]
+    if maxfev is not None:
+        fit = partial(fit, maxfev=maxfev)
+    batch = partial(batch_fit.levenberg_marquardt, function, jacobian, max_iter=max_iter, ftol=ftol, xtol=xtol) if backend == 'batch' else None
+
+    def solve(pulses, initials):
+        if resample:
+            pulses = list(ps.resample_pulses(pulses, resample))
+        return ps.fit_pulses(fit, function, pulses, initials, warm_start=warm_start, batch=batch)
+    return solve
+
+def parse_configuration(text):
+    '''
+    Parses a solver configuration given on the command line.
+
+    :param text: Name and options of the configuration, e.g. "fast:backend=batch,max_iter=50"
+    :return: The name and a dictionary of options of make_solver
+    '''
+    name, _, options = text.partition(':')
+    if not name:
+        raise ValueError(f"Configuration {text} has no name")
+    allowed = [option for option in inspect.signature(make_solver).parameters if option != 'model']
+    configuration = {}
+    for option in filter(None, options.split(',')):
+        key, _, value = option.partition('=')
+        key = key.strip()
+        if key not in allowed:
+            raise ValueError(f"Unknown option {key} of configuration {name} (options: {', '.join(allowed)})")
+        try:
+            configuration[key] = json.loads(value)
+        except ValueError:
+            configuration[key] = value.strip()
+    if configuration.get('backend', 'curve_fit') not in ps.backends:
+        raise ValueError(f"Unknown fitting backend of configuration {name}: {configuration['backend']}")
+    return name, configuration
+
+def make_pulses(model, count, fs=200, heart_rate=75, noise=0.005, jitter=0.05, seed=0):
+    '''
+    Generates synthetic pulses with known parameters. Pulses are not pre-processed, so the fitted parameters can be
+    compared with the ground truth directly.
+
+    :param model: Model the pulses are generated from - 'gaussian' or 'skewed'
+    :param count: Number of pulses
+    :param fs: Sampling frequency (Hz) - with the heart rate, sets the number of samples of every pulse
+    :param heart_rate: Mean heart rate (beats per minute)
+    :param noise: Standard deviation of white noise relative to the amplitude of every pulse
+    :param jitter: Standard deviation of every pulse parameter relative to its typical value
+    :param seed: Seed of the random generator
+    :return: A dataframe of the parameters of every pulse, a list of pulses without noise and a list of pulses with noise
+    '''
+    rng = np.random.default_rng(seed)
+    lengths = synthetic.pulse_lengths(fs, 2 * count * 60 / heart_rate, heart_rate, rng=rng)[:count]
+    truth = synthetic.pulse_params(model, len(lengths), jitter=jitter, rng=rng)
+    clean = synthetic.make_pulses(model, lengths, truth)
+    noisy = [pulse + noise * np.max(np.abs(pulse)) * rng.standard_normal(len(pulse)) for pulse in clean]
+    return truth, clean, noisy
+
+def evaluate(model, truth, clean, noisy, solver, initials):
+    '''
+    Fits pulses with a solver and compares the results with the ground truth.
+
+    :param model: Name of the model - 'gaussian' or 'skewed'
+    :param truth: A dataframe of the parameters of every pulse
+    :param clean: A list of pulses without noise
+    :param noisy: A list of pulses with noise (which are fitted)
+    :param solver: A solver returned by make_solver
+    :param initials: Initial values of the parameters
+    :return: A dataframe by pulse of the relative error of every parameter, the root mean square error of the fit on the
+        fitted pulse (rmse) and on the pulse without noise (rmse_truth), and for the Gaussian model the absolute error
+        of derived features, and the fitting time per pulse (s)
+    '''
+    function = models[model][1]
+    began = time.perf_counter()
+    fitted = solver(noisy, initials)
+    time_per_pulse = (time.perf_counter() - began) / max(len(noisy), 1)
+    fitted = pd.DataFrame(np.array(fitted), columns=truth.columns).rename_axis("Pulse")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        errors = ((fitted - truth) / truth).abs()
+    errors['rmse'] = [ps.fit_residual(function, pulse, params) for pulse, params in zip(noisy, fitted.to_numpy())]
+    errors['rmse_truth'] = [ps.fit_residual(function, pulse, params) for pulse, params in zip(clean, fitted.to_numpy())]
+    if model == 'gaussian':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            derived = (ps.additional_gauss(fitted) - ps.additional_gauss(truth)).abs()
+        for feature in derived_features:
+            errors[feature] = derived[feature].to_numpy()
+    return errors, time_per_pulse
+
+def summarise(errors, time_per_pulse):
+    '''
+    Summarises the errors of a solver configuration.
+
+    :param errors: A dataframe of errors by pulse returned by evaluate
+    :param time_per_pulse: Fitting time per pulse (s)
+    :return: A dictionary of the time per pulse, median and 95th percentile of the relative parameter error, median
+        residuals and median errors of derived features
+    '''
+    params = errors.drop(columns=['rmse', 'rmse_truth'] + derived_features, errors='ignore').to_numpy().ravel()
+    summary = {'time_per_pulse': time_per_pulse,
+               'param_error': np.nanmedian(params),
+               'param_error_95': np.nanpercentile(params, 95),
+               'rmse': errors['rmse'].median(),
+               'rmse_truth': errors['rmse_truth'].median()}
+    for feature in derived_features:
+        if feature in errors:
+            summary[f"{feature}_error"] = errors[feature].median()
+    return summary
+
+def run_accuracy(model='gaussian', solvers=None, pulses=20, fs=200, heart_rate=75, noise=0.005, jitter=0.05, seed=0, initials=None):
+    '''
+    Compares solver configurations on the same synthetic pulses.
+
+    :param model: Model the pulses are generated from and fitted with - 'gaussian' or 'skewed'
+    :param solvers: A dictionary of solver configurations (options of make_solver) by name (None for configurations)
+    :param pulses: Number of pulses
+    :param fs: Sampling frequency (Hz)
+    :param heart_rate: Mean heart rate (beats per minute)
+    :param noise: Standard deviation of white noise relative to the amplitude of every pulse
+    :param jitter: Standard deviation of every pulse parameter relative to its typical value
+    :param seed: Seed of the random generator
+    :param initials: Initial values of the parameters (None for default_initials)
+    :return: A dataframe summarising every configuration (see summarise), and a dictionary of the errors by pulse of
+        every configuration (see evaluate)
+    '''
+    if model not in models:
+        raise ValueError(f"Unknown model: {model}")
+    solvers = solvers if solvers is not None else configurations
+    initials = initials if initials is not None else default_initials[model]
+    truth, clean, noisy = make_pulses(model, pulses, fs, heart_rate, noise, jitter, seed)
+
+    summaries = {}
+    details = {}
+    for name, options in solvers.items():
+        try:
+            details[name], time_per_pulse = evaluate(model, truth, clean, noisy, make_solver(model, **options), initials)
+        except RuntimeError as error:
+            # curve_fit gives up when it runs out of function evaluations
+            print(f"{name}: {error}")
+            continue
+        summaries[name] = summarise(details[name], time_per_pulse)
+    return pd.DataFrame.from_dict(summaries, orient='index').rename_axis("Configuration"), details
+
+def main(argv=None):
+    '''
+    Entry point of the harness.
+
+    :param argv: Command line arguments (default: sys.argv[1:])
+    :return: Exit code
+    '''
+    parser = argparse.ArgumentParser(prog='accuracy', description="Compare the accuracy and speed of decomposition solvers on synthetic pulses with known parameters.")
+    parser.add_argument('--model', choices=list(models), default='gaussian', help="model the pulses are generated from and fitted with (default: gaussian)")
+    parser.add_argument('--pulses', type=int, default=20, help="number of pulses (default: 20)")
+    parser.add_argument('--fs', type=int, default=200, help="sampling frequency in Hz (default: 200)")
+    parser.add_argument('--heart-rate', type=float, default=75, help="mean heart rate in beats per minute (default: 75)")
+    parser.add_argument('--noise', type=float, default=0.005, help="white noise relative to the pulse amplitude (default: 0.005)")
+    parser.add_argument('--jitter', type=float, default=0.05, help="variation of the parameters between pulses (default: 0.05)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generator (default: 0)")
+    parser.add_argument('--solver', action='append', choices=list(configurations), help="configuration to compare (default: all), can be repeated")
+    parser.add_argument('--custom', action='append', default=[], metavar='NAME:OPTION=VALUE,...',
+                        help="additional configuration, e.g. fast:backend=batch,max_iter=50 (can be repeated)")
+    parser.add_argument('-o', '--output', help="CSV file for the summary")
+    args = parser.parse_args(argv)
+
+    solvers = {name: configurations[name] for name in (args.solver or configurations)}
+    for text in args.custom:
+        try:
+            name, configuration = parse_configuration(text)
+        except ValueError as error:
+            parser.error(str(error))
+        solvers[name] = configuration
+    summary, _ = run_accuracy(args.model, solvers, args.pulses, args.fs, args.heart_rate, args.noise, args.jitter, args.seed)
+    if args.output:
+        summary.to_csv(args.output)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(summary)
+    return 0 if len(summary) == len(solvers) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from process_signal import process_signal, backends
+from chunked import process_chunked
+from custom_save import AsyncSaver
+import loaders
+
+# This file contains the non-interactive (command line) batch mode, which processes many recordings at once
+
+extensions = ['.csv', '.txt', '.mat', '.edf'] + loaders.extensions
+
+def find_recordings(inputs):
+    '''
+    Finds recordings given as files, directories (all supported files inside) or glob patterns.
+
+    :param inputs: A list of files, directories or glob patterns
+    :return: A sorted list of paths to recordings (without duplicates)
+    '''
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = [os.path.join(item, name) for name in os.listdir(item)]
+            matches = [path for path in matches if os.path.splitext(path)[1].lower() in extensions]
+        else:
+            matches = glob.glob(item, recursive=True)
+        paths.extend(path for path in matches if os.path.isfile(path))
+    return sorted(set(paths))
+
+def output_folders(paths, output):
+    '''
+    Chooses the folder in which the results of every recording are saved: the path of the recording relative to the
+    folder containing all recordings, without extension, inside the output folder. Recordings with the same name in
+    different folders therefore do not overwrite each other's results, and recordings differing only by extension get
+    the extension appended (e.g. rec_csv and rec_npy).
+
+    :param paths: A list of paths to recordings
+    :param output: Folder in which the results of all recordings are saved
+    :return: A dictionary of output folders by path
+    '''
+    if not paths:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in paths])
+    names = {path: os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0] for path in paths}
+    counts = Counter(names.values())
+    return {path: os.path.join(output, name + os.path.splitext(path)[1].replace('.', '_') if counts[name] > 1 else name)
+            for path, name in names.items()}
+
+def get_options(args):
+    '''
+    Combines options from the config file and the command line (command line options take precedence).
+
+    :param args: Parsed command line arguments
+    :return: A dictionary of process_signal parameters
+    '''
+    options = {}
+    if args.config:
+        with open(args.config) as file:
+            options.update(json.load(file))
+    overrides = {'fs': args.fs,
+                 'start': args.start,
+                 'end': args.end,
+                 'fL': args.fL,
+                 'fH': args.fH,
+                 'order': args.order,
+                 'savingformat': args.format,
+                 'workers': args.fit_workers,
+                 'backend': args.backend,
+                 'resample': args.resample,
+                 'fit_cache': args.fit_cache,
+                 'signal_cache': args.signal_cache,
+                 'stage_workers': args.stage_workers,
+                 'chunk': args.chunk,
+                 'overlap': args.overlap}
+    options.update({key: value for key, value in overrides.items() if value is not None})
+    if args.no_gauss:
+        options['enable_gauss'] = False
+    if args.no_skewed:
+        options['enable_skewed'] = False
+    if args.warm_start:
+        options['warm_start'] = True
+    if args.resample_report:
+        options['resample_report'] = True
+    if args.profile:
+        options['profile'] = True
+    if args.outputs:
+        options['outputs'] = args.outputs.split(',')
+    # No interactive plots in batch mode
+    options['gauss_live_plot'] = False
+    options['skewed_live_plot'] = False
+    return options
+
+def process_file(path, folder, options, saver=None):
+    '''
+    Processes one recording, catching any error so that the rest of the batch can continue.
+
+    :param path: Path to the recording
+    :param folder: Folder in which the results of the recording are saved (see output_folders)
+    :param options: A dictionary of process_signal parameters (with 'chunk' set, the recording is processed in windows
+        by process_chunked, and options it does not support are ignored)
+    :param saver: An AsyncSaver to save the results in the background (not used in chunked mode)
+    :return: A dictionary summarising the result (file, status, seconds, error), and a Future of the saving if the
+        results are still being saved (None otherwise)
+    '''
+    began = time.time()
+    future = None
+    try:
+        if options.get('chunk'):
+            unsupported = ['savingformat', 'signal_cache', 'resample_report', 'gauss_live_plot', 'skewed_live_plot', 'outputs', 'stage_workers', 'profile', 'cprofile']
+            process_chunked(path=path, savingfolder=folder,
+                            **{key: value for key, value in options.items() if key not in unsupported})
+        else:
+            options = {key: value for key, value in options.items() if key not in ['chunk', 'overlap']}
+            future = process_signal(path=path, savingfolder=folder, saver=saver, **options)
+        status = 'success'
+        error = ''
+    except Exception as e:
+        status = 'failure'
+        error = describe_error(e)
+    return {'file': path, 'status': status, 'seconds': round(time.time() - began, 3), 'error': error}, future
+
+def describe_error(error):
+    '''
+    :param error: An exception
+    :return: A one-line description of the exception for the summary
+    '''
+    return ''.join(traceback.format_exception_only(type(error), error)).strip()
+
+def complete_save(result, future, began, finished):
+    '''
+    Completes the summary of a recording saved in the background, once saving has finished.
+
+    :param result: Summary dictionary returned by process_file
+    :param future: Future of the saving
+    :param began: Time at which processing of the recording started
+    :param finished: A dictionary of the times at which saving finished by Future (filled by a done callback, see
+        run_batch)
+    :return: The summary dictionary, marked as a failure if saving failed
+    '''
+    error = future.exception()
+    if error is not None:
+        result['status'] = 'failure'
+        result['error'] = describe_error(error)
+    # The callback runs just after waiters are woken, so it may not have run yet
+    result['seconds'] = round(finished.pop(future, time.time()) - began, 3)
+    return result
+
+def run_batch(paths, output, options, workers=1, summary=None, async_save=True):
+    '''
+    Processes recordings, optionally in parallel, writing a summary row for every recording as soon as it is finished.
+
+    :param paths: A list of paths to recordings
+    :param output: Folder in which the results are saved (in a subfolder for every recording, see output_folders)
+    :param options: A dictionary of process_signal parameters
+    :param workers: Number of recordings processed at once (1 to process them one after another)
+    :param summary: Path to the summary CSV file (default: summary.csv in the output folder)
+    :param async_save: A boolean to save the results of each recording in the background while the next one is
+        processed (only when recordings are processed one after another)
+    :return: A list of summary dictionaries in the order the recordings were given
+    '''
+    os.makedirs(output, exist_ok=True)
+    if summary is None:
+        summary = os.path.join(output, 'summary.csv')
+    folders = output_folders(paths, output)
+
+    results = {}
+    with open(summary, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['file', 'status', 'seconds', 'error'])
+        writer.writeheader()
+
+        def record(result):
+            results[result['file']] = result
+            writer.writerow(result)
+            file.flush()
+            print(f"[{len(results)}/{len(paths)}] {result['status']}: {result['file']}")
+
+        if workers <= 1:
+            saver = AsyncSaver() if async_save else None
+            pending = []
+            finished = {}
+            for path in paths:
+                began = time.time()
+                result, future = process_file(path, folders[path], options, saver)
+                if future is None:
+                    record(result)
+                else:
+                    # Saving is only checked after the next recording is processed, so its end is recorded when it happens
+                    future.add_done_callback(lambda future: finished.setdefault(future, time.time()))
+                    pending.append((result, future, began))
+                # Record recordings saved in the meantime
+                for item in [item for item in pending if item[1].done()]:
+                    pending.remove(item)
+                    record(complete_save(*item, finished))
+            for item in pending:
+                record(complete_save(*item, finished))
+            if saver is not None:
+                try:
+                    saver.close()
+                except RuntimeError:
+                    # Failures have already been recorded for each recording
+                    pass
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(process_file, path, folders[path], options): path for path in paths}
+                for future in as_completed(futures):
+                    try:
+                        result, _ = future.result()
+                    except Exception as e:
+                        # The worker process itself failed (e.g. it was killed)
+                        result = {'file': futures[future], 'status': 'failure', 'seconds': '', 'error': repr(e)}
+                    record(result)
+
+    return [results[path] for path in paths]
+
+def main(argv=None):
+    '''
+    Entry point of the batch mode.
+
+    :param argv: Command line arguments (default: sys.argv[1:])
+    :return: Exit code (0 if all recordings were processed, 1 otherwise)
+    '''
+    parser = argparse.ArgumentParser(prog='shefPPGf', description="Extract PPG features from many recordings without the interactive menu.")
+    parser.add_argument('inputs', nargs='+', help="recordings, directories or glob patterns (quoted, e.g. 'data/**/*.csv')")
+    parser.add_argument('-c', '--config', help="JSON file of process_signal options (e.g. {\"fs\": 1000, \"g_values\": [...]})")
+    parser.add_argument('-o', '--output', default='results', help="output folder (default: results)")
+    parser.add_argument('-s', '--summary', help="summary CSV file (default: summary.csv in the output folder)")
+    parser.add_argument('-j', '--workers', type=int, default=1, help="number of recordings processed at once (default: 1)")
+    parser.add_argument('--fit-workers', type=int, help="worker processes for the decomposition of each recording")
+    parser.add_argument('--stage-workers', type=int, help="independent pipeline stages of each recording run at once")
+    parser.add_argument('--fs', type=int, help="sampling frequency in Hz")
+    parser.add_argument('--start', type=int, help="start of the signal")
+    parser.add_argument('--end', type=int, help="end of the signal (-1 for the whole signal)")
+    parser.add_argument('--fL', type=float, help="lower filter cutoff frequency in Hz")
+    parser.add_argument('--fH', type=float, help="higher filter cutoff frequency in Hz")
+    parser.add_argument('--order', type=int, help="filter order")
+    parser.add_argument('--format', choices=['csv', 'mat', 'both', 'npz'], help="output file format ('npz' for a single file per recording)")
+    parser.add_argument('--backend', choices=backends, help="fitting backend")
+    parser.add_argument('--warm-start', action='store_true', help="seed each fit with the parameters of the previous pulse")
+    parser.add_argument('--resample', type=int, help="number of points each pulse is resampled to before decomposition")
+    parser.add_argument('--resample-report', action='store_true', help="save the error introduced by resampling a sample of pulses with the results")
+    parser.add_argument('--fit-cache', help="file caching decomposition results between runs")
+    parser.add_argument('--signal-cache', help="folder caching filtered signals and fiducial points between runs")
+    parser.add_argument('--chunk', type=float, help="process each recording in windows of this many seconds (CSV output only)")
+    parser.add_argument('--overlap', type=float, help="seconds added on both sides of each window in chunked mode (default: 30)")
+    parser.add_argument('--sync-save', action='store_true', help="save each recording before processing the next one")
+    parser.add_argument('--outputs', help="comma-separated outputs to compute, e.g. gauss,gauss_stats (default: all)")
+    parser.add_argument('--profile', action='store_true', help="save a JSON report of time, memory and work of every stage next to the results")
+    parser.add_argument('--no-gauss', action='store_true', help="skip Gaussian decomposition")
+    parser.add_argument('--no-skewed', action='store_true', help="skip skewed Gaussian decomposition")
+    args = parser.parse_args(argv)
+
+    paths = find_recordings(args.inputs)
+    if not paths:
+        print("No recordings found.")
+        return 1
+
+    results = run_batch(paths, args.output, get_options(args), args.workers, args.summary, not args.sync_save)
+    failed = sum(result['status'] != 'success' for result in results)
+    print(f"Processed {len(results)} recordings, {failed} failed.")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
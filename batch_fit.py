@@ -0,0 +1,122 @@
+import numpy as np
+
+# This file contains a Levenberg-Marquardt curve fitting engine which fits many pulses at once
+
+def pad_pulses(pulses):
+    '''
+    Stacks pulses of different lengths into matrices padded with zeros
+
+    :param pulses: A list of pulses
+    :return: Normalised time, pulse values and a mask of valid samples (all as matrices with one row per pulse)
+    '''
+    lengths = np.array([len(pulse) for pulse in pulses])
+    columns = np.arange(lengths.max(initial=0))
+    mask = columns < lengths[:, np.newaxis]
+    time = np.where(mask, columns / np.maximum(lengths[:, np.newaxis], 1), 0)
+    values = np.zeros(mask.shape)
+    values[mask] = np.concatenate(pulses) if len(pulses) else []
+    return time, values, mask
+
+def levenberg_marquardt(model, jacobian, pulses, initials, lower=0, max_iter=1000, ftol=1e-8, xtol=1e-8, batch_size=1024, full_output=False):
+    '''
+    Fits a model to every pulse with damped least squares (Levenberg-Marquardt) iterations carried out on the whole batch
+
+    Each pulse keeps its own damping factor and convergence state, and only the pulses which have not converged are
+    updated in each iteration. Pulses are fitted on the same normalised time axis as gaussian.find_gaussians and
+    skewed.fit, and parameters are kept above the lower bound by projection.
+
+    :param model: Model function of time and parameters (e.g. gaussian.gaussians)
+    :param jacobian: Jacobian of the model function (e.g. gaussian.gaussians_jacobian)
+    :param pulses: A list of pre-processed pulses
+    :param initials: Initial values of the parameters
+    :param lower: Lower bound of the parameters
+    :param max_iter: Maximum number of iterations
+    :param ftol: Relative reduction of the sum of squares below which a pulse is considered converged
+    :param xtol: Relative change of the parameters below which a pulse is considered converged
+    :param batch_size: Number of pulses fitted together (limits the memory used by the Jacobian)
+    :param full_output: A boolean to also return the number of evaluations of the model (one per pulse evaluated)
+    :return: A matrix of fitted parameters with one row per pulse (and the number of evaluations of the model)
+    '''
+    params = np.tile(np.asarray(initials, dtype=float), (len(pulses), 1))
+    evaluations = 0
+    # Group pulses of similar length to limit padding
+    order = np.argsort([len(pulse) for pulse in pulses], kind='stable')
+    for start in range(0, len(pulses), batch_size):
+        batch = order[start:start + batch_size]
+        params[batch], batch_evaluations = fit_batch(model, jacobian, [pulses[i] for i in batch], params[batch], lower, max_iter, ftol, xtol)
+        evaluations += batch_evaluations
+    return (params, evaluations) if full_output else params
+
+def fit_batch(model, jacobian, pulses, params, lower, max_iter, ftol, xtol):
+    '''
+    Runs Levenberg-Marquardt iterations on one batch of pulses (see levenberg_marquardt)
+
+    :param model: Model function of time and parameters
+    :param jacobian: Jacobian of the model function
+    :param pulses: A list of pre-processed pulses
+    :param params: A matrix of initial parameters with one row per pulse
+    :param lower: Lower bound of the parameters
+    :param max_iter: Maximum number of iterations
+    :param ftol: Relative reduction of the sum of squares below which a pulse is considered converged
+    :param xtol: Relative change of the parameters below which a pulse is considered converged
+    :return: A matrix of fitted parameters with one row per pulse, and the number of evaluations of the model (one per
+        pulse evaluated)
+    '''
+    time, values, mask = pad_pulses(pulses)
+    params = params.copy()
+
+    def residuals(index, p):
+        # Model minus pulse, zero outside each pulse
+        return np.where(mask[index], model(time[index], *p.T[:, :, np.newaxis]) - values[index], 0)
+
+    def normal_equations(index, p, r):
+        # Jacobian as (pulse x parameter x time), zero outside each pulse
+        J = np.moveaxis(jacobian(time[index], *p.T[:, :, np.newaxis]), -1, 1)
+        J = np.where(mask[index, np.newaxis, :], J, 0)
+        return J @ J.transpose(0, 2, 1), (J @ r[:, :, np.newaxis])[:, :, 0]
+
+    with np.errstate(all='ignore'):
+        everything = np.arange(len(pulses))
+        r = residuals(everything, params)
+        cost = np.sum(r ** 2, axis=1)
+        JtJ, Jtr = normal_equations(everything, params, r)
+        damping = np.full(len(pulses), 1e-3)
+        active = np.isfinite(cost)
+        evaluations = len(pulses)
+
+        for i in range(max_iter):
+            index = np.flatnonzero(active)
+            if index.size == 0:
+                break
+
+            # Damped Gauss-Newton step, scaled by the diagonal of the normal matrix
+            diagonal = np.diagonal(JtJ[index], axis1=1, axis2=2)
+            A = JtJ[index] + (damping[index, np.newaxis] * diagonal + 1e-12)[:, :, np.newaxis] * np.eye(params.shape[1])
+            try:
+                step = -np.linalg.solve(A, Jtr[index][:, :, np.newaxis])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = -np.stack([np.linalg.lstsq(a, g, rcond=None)[0] for a, g in zip(A, Jtr[index])])
+            candidate = np.maximum(params[index] + step, lower)
+            candidate_r = residuals(index, candidate)
+            candidate_cost = np.sum(candidate_r ** 2, axis=1)
+            evaluations += index.size
+
+            # Accept improving steps and relax the damping, otherwise increase the damping
+            improved = candidate_cost < cost[index]
+            reduction = cost[index] - candidate_cost
+            change = np.abs(candidate - params[index])
+            accepted = index[improved]
+            params[accepted] = candidate[improved]
+            cost[accepted] = candidate_cost[improved]
+            damping[accepted] = np.maximum(damping[accepted] / 10, 1e-12)
+            damping[index[~improved]] *= 10
+            if accepted.size:
+                JtJ[accepted], Jtr[accepted] = normal_equations(accepted, params[accepted], candidate_r[improved])
+
+            # Per-pulse convergence
+            converged = improved & ((reduction <= ftol * cost[index])
+                                    | np.all(change <= xtol * (xtol + np.abs(params[index])), axis=1))
+            stuck = ~improved & (damping[index] > 1e16)
+            active[index[converged | stuck]] = False
+
+    return params, evaluations
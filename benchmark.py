@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from dotmap import DotMap
+from pyPPG import PPG, Fiducials
+import process_signal as ps
+import custom_save
+import profiling
+import synthetic
+import vpg
+import ppg
+from pulses import PulseStore
+
+# This file contains a benchmark of the feature extraction stages on synthetic recordings, with a stored baseline against
+# which speed, memory and results are compared
+
+# Parameters between which the dicrotic notch of a synthetic pulse is placed (means of the second and third waves)
+notch_params = {'gaussian': ('m2', 'm3'), 'skewed': ('loc2', 'loc3')}
+
+def synthetic_signal(signal, fs, name='synthetic'):
+    '''
+    Wraps a synthetic recording into a PPG object (the derivatives are calculated without filtering).
+
+    :param signal: Synthetic PPG signal
+    :param fs: Sampling frequency (Hz)
+    :param name: Name of the recording (used in the names of saved files)
+    :return: A PPG object
+    '''
+    s = DotMap()
+    s.v = signal
+    s.ppg = signal
+    s.vpg = np.gradient(signal)
+    s.apg = np.gradient(s.vpg)
+    s.jpg = np.gradient(s.apg)
+    s.fs = fs
+    s.name = name
+    s.start_sig = 0
+    s.end_sig = len(signal)
+    s.filtering = False
+    s.fL = 0
+    s.fH = 0
+    s.order = 0
+    s.sm_wins = {}
+    s.correction = pd.DataFrame()
+    return PPG(s=s, check_ppg_len=False)
+
+def synthetic_fiducials(onsets, length, truth, model):
+    '''
+    Creates the fiducial points of a synthetic recording - onsets and dicrotic notches (half way between the second and
+    third waves of every pulse).
+
+    :param onsets: Onsets of the pulses
+    :param length: Length of the signal (end of the last pulse)
+    :param truth: A dataframe of the parameters of every pulse
+    :param model: Model the pulses were generated from - 'gaussian' or 'skewed'
+    :return: A Fiducials object
+    '''
+    first, second = notch_params[model]
+    lengths = np.diff(np.append(onsets, length))
+    notches = onsets + np.round((truth[first] + truth[second]).to_numpy() / 2 * lengths).astype(int)
+    return Fiducials(fp=pd.DataFrame({'on': onsets, 'dn': np.clip(notches, onsets, onsets + lengths - 1)}))
+
+def measure(name, function, pulses, repeat=3, min_time=0.2, memory=True):
+    '''
+    Measures a stage - the fastest of repeated runs, and peak memory in a separate run (tracing memory slows it down).
+
+    :param name: Name of the stage
+    :param function: Function running the stage (without arguments)
+    :param pulses: Number of pulses processed by the stage
+    :param repeat: Least number of timed runs
+    :param min_time: Least total time of the timed runs (s) - fast stages are run more often to reduce timing noise
+    :param memory: A boolean to measure peak memory
+    :return: Result of the stage and a dictionary of measurements
+    '''
+    profiler = profiling.Profiler(memory=False)
+    while len(profiler.stages) < max(repeat, 1) or sum(record['wall_time'] for record in profiler.stages) < min_time:
+        with profiler.stage(name):
+            result = function()
+    wall_time = min(record['wall_time'] for record in profiler.stages)
+    stats = {'pulses': pulses,
+             'wall_time': wall_time,
+             'cpu_time': min(record['cpu_time'] for record in profiler.stages),
+             'pulses_per_second': pulses / max(wall_time, 1e-9),
+             'runs': len(profiler.stages)}
+    if memory:
+        profiler = profiling.Profiler(memory=True)
+        try:
+            with profiler.stage(name):
+                function()
+        finally:
+            profiler.close()
+        stats['peak_memory'] = profiler.stages[-1]['peak_memory']
+    return result, stats
+
+def result_summary(result):
+    '''
+    Summarises the result of a stage for comparison with the baseline.
+
+    :param result: Result of a stage
+    :return: A dictionary of the mean of every column for dataframes (NaN as None), or None for other results
+    '''
+    if not isinstance(result, pd.DataFrame):
+        return None
+    means = result.select_dtypes('number').mean()
+    return {str(column): None if pd.isna(value) else float(value) for column, value in means.items()}
+
+def run_benchmark(fs=200, duration=60, heart_rate=75, model='gaussian', noise=0.005, seed=0, backend='batch', workers=1, savingformat='csv', repeat=3, memory=True):
+    '''
+    Generates a synthetic recording and measures every stage of feature extraction on its pulses.
+
+    :param fs: Sampling frequency (Hz)
+    :param duration: Length of the recording (s)
+    :param heart_rate: Mean heart rate (beats per minute)
+    :param model: Model the pulses are generated from - 'gaussian' or 'skewed'
+    :param noise: Standard deviation of white noise relative to the highest pulse amplitude
+    :param seed: Seed of the random generator
+    :param backend: Fitting backend of the decompositions - 'curve_fit' or 'batch'
+    :param workers: Number of worker processes used for fitting
+    :param savingformat: Format passed to custom_save.save_data ('csv', 'mat', 'both' or 'npz')
+    :param repeat: Number of timed runs of every stage
+    :param memory: A boolean to measure peak memory of every stage
+    :return: A dictionary of the settings, measurements of every stage and summaries of the results
+    '''
+    settings = {'fs': fs, 'duration': duration, 'heart_rate': heart_rate, 'model': model, 'noise': noise, 'seed': seed,
+                'backend': backend, 'workers': workers, 'savingformat': savingformat}
+    signal, onsets, truth = synthetic.generate(fs, duration, heart_rate, model, noise=noise, seed=seed)
+    s = synthetic_signal(signal, fs)
+    fp = synthetic_fiducials(onsets, len(signal), truth, model)
+    ppgPulses = PulseStore.from_onsets(s.ppg, onsets[1:])
+
+    results = {}
+    report = {'settings': settings, 'platform': platform.platform(), 'python': platform.python_version(),
+              'stages': {}, 'results': {}}
+    with tempfile.TemporaryDirectory() as folder:
+        stages = [('preprocess_pulses', lambda: ps.preprocess_pulses(ppgPulses)),
+                  ('get_gaussians', lambda: ps.get_gaussians(results['preprocess_pulses'], workers=workers, backend=backend, preprocess=False)),
+                  ('gaussian_stats', lambda: ps.gaussian_stats(results['get_gaussians'])),
+                  ('additional_gauss', lambda: ps.additional_gauss(results['get_gaussians'])),
+                  ('get_skewed', lambda: ps.get_skewed(results['preprocess_pulses'], workers=workers, backend=backend, preprocess=False)),
+                  ('skewed_stats', lambda: ps.skewed_stats(results['get_skewed'])),
+                  ('vpg_features', lambda: vpg.features(s.vpg, fp)),
+                  ('vpg_stats', lambda: vpg.stats(results['vpg_features'])),
+                  ('ppg_features', lambda: ppg.features(ppgPulses)),
+                  ('ppg_stats', lambda: ppg.ppg_stats(results['ppg_features'])),
+                  ('save_data', lambda: custom_save.save_data(savingformat, os.path.join(folder, 'results'), print_flag=False, s=s, fp=fp, bm=None,
+                                                              gauss=results['get_gaussians'], gauss_stats=results['gaussian_stats'], gauss_additional=results['additional_gauss'],
+                                                              skewed=results['get_skewed'], skewed_stats=results['skewed_stats'], vpg=results['vpg_features'], vpg_stats=results['vpg_stats'],
+                                                              ppg_extra=results['ppg_features'], ppg_extra_stats=results['ppg_stats']))]
+        for name, function in stages:
+            results[name], report['stages'][name] = measure(name, function, len(ppgPulses), repeat=repeat, memory=memory)
+            summary = result_summary(results[name])
+            if summary is not None:
+                report['results'][name] = summary
+    return report
+
+def compare(report, baseline, speed_tolerance=0.25, memory_tolerance=0.25, result_tolerance=1e-6):
+    '''
+    Compares a benchmark report with a baseline.
+
+    :param report: A report returned by run_benchmark
+    :param baseline: A report of an earlier run
+    :param speed_tolerance: Largest accepted drop of pulses per second relative to the baseline
+    :param memory_tolerance: Largest accepted increase of peak memory relative to the baseline
+    :param result_tolerance: Relative tolerance of the result summaries
+    :return: A list of regressions (empty if there are none)
+    '''
+    if report['settings'] != baseline.get('settings'):
+        return [f"baseline settings {baseline.get('settings')} differ from {report['settings']}"]
+
+    regressions = []
+    for name, stats in report['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            continue
+        if stats['pulses_per_second'] < base['pulses_per_second'] * (1 - speed_tolerance):
+            regressions.append(f"{name}: {stats['pulses_per_second']:.1f} pulses/s, baseline {base['pulses_per_second']:.1f} pulses/s")
+        if 'peak_memory' in stats and 'peak_memory' in base and stats['peak_memory'] > base['peak_memory'] * (1 + memory_tolerance) + 65536:
+            regressions.append(f"{name}: peak memory {stats['peak_memory']} bytes, baseline {base['peak_memory']} bytes")
+
+    for name, summary in report['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for column, value in summary.items():
+            expected = base.get(column)
+            if column not in base:
+                regressions.append(f"{name}: column {column} is not in the baseline")
+            elif (value is None) != (expected is None) or (value is not None and not np.isclose(value, expected, rtol=result_tolerance, atol=1e-12)):
+                regressions.append(f"{name}: mean {column} is {value}, baseline {expected}")
+        for column in base:
+            if column not in summary:
+                regressions.append(f"{name}: column {column} is missing")
+    return regressions
+
+def print_report(report, baseline=None):
+    '''
+    Prints the measurements of every stage (and their change relative to the baseline).
+
+    :param report: A report returned by run_benchmark
+    :param baseline: A report of an earlier run (None to print the measurements only)
+    '''
+    print(f"{'stage':<20}{'pulses/s':>12}{'time (ms)':>12}{'memory (MiB)':>14}{'vs baseline':>14}")
+    for name, stats in report['stages'].items():
+        memory = f"{stats['peak_memory'] / 2 ** 20:.2f}" if 'peak_memory' in stats else '-'
+        change = ''
+        if baseline is not None and name in baseline.get('stages', {}):
+            change = f"{stats['pulses_per_second'] / baseline['stages'][name]['pulses_per_second'] - 1:+.1%}"
+        print(f"{name:<20}{stats['pulses_per_second']:>12.1f}{stats['wall_time'] * 1000:>12.2f}{memory:>14}{change:>14}")
+
+def main(argv=None):
+    '''
+    Entry point of the benchmark.
+
+    :param argv: Command line arguments (default: sys.argv[1:])
+    :return: Exit code (1 if there are regressions against the baseline)
+    '''
+    parser = argparse.ArgumentParser(prog='benchmark', description="Benchmark the feature extraction stages on a synthetic recording and compare them with a baseline.")
+    parser.add_argument('--fs', type=int, default=200, help="sampling frequency in Hz (default: 200)")
+    parser.add_argument('--duration', type=float, default=60, help="length of the recording in seconds (default: 60)")
+    parser.add_argument('--heart-rate', type=float, default=75, help="mean heart rate in beats per minute (default: 75)")
+    parser.add_argument('--model', choices=list(synthetic.models), default='gaussian', help="model the pulses are generated from (default: gaussian)")
+    parser.add_argument('--noise', type=float, default=0.005, help="white noise relative to the highest pulse amplitude (default: 0.005)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generator (default: 0)")
+    parser.add_argument('--backend', choices=ps.backends, default='batch', help="fitting backend (default: batch)")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes used for fitting (default: 1)")
+    parser.add_argument('--format', choices=['csv', 'mat', 'both', 'npz'], default='csv', help="format of saved results (default: csv)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs of every stage (default: 3)")
+    parser.add_argument('--no-memory', action='store_true', help="skip measuring peak memory")
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help="baseline file (default: benchmark_baseline.json)")
+    parser.add_argument('--save-baseline', action='store_true', help="save this run as the baseline instead of comparing with it")
+    parser.add_argument('--speed-tolerance', type=float, default=0.25, help="accepted drop of pulses per second (default: 0.25)")
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help="accepted increase of peak memory (default: 0.25)")
+    parser.add_argument('--result-tolerance', type=float, default=1e-6, help="relative tolerance of results (default: 1e-6)")
+    parser.add_argument('-o', '--output', help="JSON file for the report of this run")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.fs, args.duration, args.heart_rate, args.model, args.noise, args.seed, args.backend,
+                           args.workers, args.format, args.repeat, not args.no_memory)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        print_report(report)
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    print_report(report, baseline)
+    regressions = compare(report, baseline, args.speed_tolerance, args.memory_tolerance, args.result_tolerance)
+    for regression in regressions:
+        print(f"Regression - {regression}")
+    if not regressions:
+        print("No regressions against the baseline.")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
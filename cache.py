@@ -0,0 +1,194 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import numpy as np
+import pandas as pd
+from dotmap import DotMap
+import loaders
+
+# This file contains persistent caches of pulse decomposition results and of pre-processed signals
+
+class FitCache:
+    '''
+    On-disk (SQLite) cache of fitted parameters by pulse.
+
+    Entries are addressed by a hash of the pre-processed pulse, the model, the initial values and the solver settings,
+    so a pulse is only fitted again if any of these change. The number of entries is limited, and the least recently
+    used entries are removed first.
+    '''
+
+    def __init__(self, path='fit_cache.sqlite', max_entries=1000000):
+        '''
+        :param path: Path to the cache file (created if it does not exist)
+        :param max_entries: Maximum number of fits kept in the cache
+        '''
+        self.path = path
+        self.max_entries = max_entries
+        # Wait for other processes (e.g. in batch mode) instead of failing when the cache is locked
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # Pipeline stages running in other threads share the connection
+        self.lock = threading.RLock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, params BLOB, used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS fits_used ON fits (used)")
+        self.connection.commit()
+
+    @staticmethod
+    def key(pulse, model, initials, settings=''):
+        '''
+        Calculates the cache key of a fit.
+
+        :param pulse: Pre-processed pulse
+        :param model: Name of the model (e.g. 'gaussian' or 'skewed')
+        :param initials: Initial values of the parameters
+        :param settings: Description of the solver settings which affect the result
+        :return: A hexadecimal SHA-256 hash
+        '''
+        hash = hashlib.sha256()
+        hash.update(np.ascontiguousarray(pulse, dtype=np.float64).tobytes())
+        hash.update(model.encode())
+        hash.update(np.asarray(initials, dtype=np.float64).tobytes())
+        hash.update(str(settings).encode())
+        return hash.hexdigest()
+
+    def get_many(self, keys):
+        '''
+        Looks up fits in the cache and marks them as recently used.
+
+        :param keys: A list of cache keys
+        :return: A dictionary of fitted parameters (as arrays) by key, containing only the keys found in the cache
+        '''
+        found = {}
+        with self.lock:
+            # Stay below the SQLite limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self.connection.execute(f"SELECT key, params FROM fits WHERE key IN ({','.join('?' * len(part))})", part)
+                for key, params in rows:
+                    found[key] = np.frombuffer(params, dtype=np.float64).copy()
+            if found:
+                now = time.time()
+                self.connection.executemany("UPDATE fits SET used = ? WHERE key = ?", [(now, key) for key in found])
+                self.connection.commit()
+        return found
+
+    def put_many(self, fits):
+        '''
+        Stores fits in the cache, removing the least recently used entries if the cache is full.
+
+        :param fits: A dictionary of fitted parameters by key
+        '''
+        now = time.time()
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO fits (key, params, used) VALUES (?, ?, ?)",
+                                        [(key, np.asarray(params, dtype=np.float64).tobytes(), now) for key, params in fits.items()])
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries above the size limit.
+        '''
+        with self.lock:
+            count = self.connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute("DELETE FROM fits WHERE key IN (SELECT key FROM fits ORDER BY used LIMIT ?)",
+                                        (count - self.max_entries,))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+class SignalCache:
+    '''
+    On-disk cache of loaded and filtered signals with their fiducial points, stored in a folder as a .npz file of the
+    signal arrays and a pickle of the remaining signal attributes and fiducial points.
+
+    Entries are addressed by a hash of the signal file (path, modification time and size, and the same for the data files
+    of a WFDB record) and the loading, filtering and smoothing parameters, so a signal is processed again whenever the
+    files or any of these parameters change.
+    '''
+
+    arrays = ['v', 'ppg', 'vpg', 'apg', 'jpg']
+    fields = ['start_sig', 'end_sig', 'fs', 'name', 'filtering', 'fL', 'fH', 'order', 'sm_wins', 'correction']
+
+    def __init__(self, folder='signal_cache'):
+        '''
+        :param folder: Folder in which cached signals are stored (created if it does not exist)
+        '''
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(path, **settings):
+        '''
+        Calculates the cache key of a signal.
+
+        :param path: Path to the signal file (the .hea header of a WFDB record)
+        :param settings: Loading, filtering and smoothing parameters
+        :return: A hexadecimal SHA-256 hash
+        '''
+        hash = hashlib.sha256()
+        hash.update(os.path.abspath(path).encode())
+        for file_name in loaders.recording_files(path):
+            stat = os.stat(file_name)
+            hash.update(f"{stat.st_mtime_ns} {stat.st_size}".encode())
+        for name in sorted(settings):
+            value = settings[name]
+            if isinstance(value, pd.DataFrame):
+                value = value.to_json()
+            elif isinstance(value, dict):
+                value = sorted(value.items())
+            hash.update(f"{name}={value!r};".encode())
+        return hash.hexdigest()
+
+    def paths(self, key):
+        '''
+        :param key: Cache key of a signal
+        :return: Paths to the array file and the attribute file of the signal
+        '''
+        return os.path.join(self.folder, key + '.npz'), os.path.join(self.folder, key + '.pkl')
+
+    def load(self, key):
+        '''
+        Loads a signal from the cache.
+
+        :param key: Cache key of the signal
+        :return: The signal (as a DotMap to create a PPG object from) and a dataframe of fiducial points, or None if the
+            signal is not in the cache
+        '''
+        arrays_path, data_path = self.paths(key)
+        if not os.path.exists(arrays_path) or not os.path.exists(data_path):
+            return None
+        signal = DotMap()
+        with np.load(arrays_path) as arrays:
+            for name in self.arrays:
+                signal[name] = arrays[name]
+        with open(data_path, 'rb') as file:
+            data = pickle.load(file)
+        for name in self.fields:
+            signal[name] = data['signal'][name]
+        return signal, data['fiducials']
+
+    def save(self, key, s, fiducials):
+        '''
+        Stores a signal in the cache.
+
+        :param key: Cache key of the signal
+        :param s: PPG object containing the signal data
+        :param fiducials: A dataframe of fiducial points
+        '''
+        arrays_path, data_path = self.paths(key)
+        # Write to temporary files first so that an interrupted run never leaves a partial entry
+        with open(arrays_path + '.tmp', 'wb') as file:
+            np.savez(file, **{name: getattr(s, name) for name in self.arrays})
+        os.replace(arrays_path + '.tmp', arrays_path)
+        with open(data_path + '.tmp', 'wb') as file:
+            pickle.dump({'signal': {name: getattr(s, name) for name in self.fields}, 'fiducials': fiducials}, file)
+        os.replace(data_path + '.tmp', data_path)
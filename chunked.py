@@ -0,0 +1,269 @@
+import os
+import numpy as np
+import pandas as pd
+from dotmap import DotMap
+from pyPPG import Fiducials
+import pyPPG.biomarkers as BM
+import pyPPG.ppg_sqi as SQI
+# Import internal
+import process_signal as ps
+import feature_stats
+from cache import FitCache
+import loaders
+import vpg
+import ppg
+
+# This file contains the chunked processing mode, which processes long recordings window by window
+
+class TableWriter:
+    '''
+    Appends per-pulse rows of a table to a CSV file, so that the table never has to be kept in memory, and keeps
+    running statistics of the rows, so that the table does not have to be read again either.
+    '''
+
+    def __init__(self, file_name, exclude=[]):
+        '''
+        :param file_name: Path to the CSV file (overwritten)
+        :param exclude: Columns which are left out of the statistics
+        '''
+        self.file_name = file_name
+        self.exclude = exclude
+        self.rows = 0
+        self.statistics = feature_stats.RunningSummary()
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    def append(self, table):
+        '''
+        :param table: A dataframe of rows to be added to the file
+        '''
+        table.to_csv(self.file_name, mode='a', header=self.rows == 0)
+        self.statistics.update(table.drop(columns=self.exclude, errors='ignore'))
+        self.rows += len(table)
+
+    def summary(self):
+        '''
+        :return: A dataframe of statistics by feature of all rows (as feature_stats.summary)
+        '''
+        return self.statistics.summary()
+
+def windows(length, chunk, overlap):
+    '''
+    Divides a signal into windows - cores which cover the signal without overlapping, extended on both sides by the
+    overlap (so that filtering and fiducial detection are not affected by the edges of the window).
+
+    :param length: Length of the signal (in samples)
+    :param chunk: Length of the core of each window (in samples), the last core can be up to 1.5 times longer
+    :param overlap: Length of the extension on each side of the core (in samples)
+    :return: A list of (window start, core start, core end, window end) tuples
+    '''
+    result = []
+    core_start = 0
+    while core_start < length:
+        core_end = core_start + chunk
+        # A short remainder is added to the last window rather than processed on its own
+        if length - core_end < chunk // 2:
+            core_end = length
+        result.append((max(core_start - overlap, 0), core_start, core_end, min(core_end + overlap, length)))
+        core_start = core_end
+    return result
+
+def owned_pulses(onsets, handoff, core_end, is_last, tolerance):
+    '''
+    Selects pulses which belong to the current window. Pulses start at the onset where the previous window handed off
+    and continue up to the last onset in the core of the window, so every pulse is processed by exactly one window.
+
+    :param onsets: Onsets of the pulses detected in the window (in samples from the start of the recording)
+    :param handoff: Onset at which the previous window stopped (in samples from the start of the recording)
+    :param core_end: End of the core of the window (in samples from the start of the recording)
+    :param is_last: A boolean indicating that the window reaches the end of the recording
+    :param tolerance: Maximum difference between onsets of the same pulse detected in neighbouring windows
+    :return: Indices of the first and last pulse belonging to the window (inclusive), or None if there are none
+    '''
+    candidates = np.flatnonzero((onsets >= handoff - tolerance) & (onsets < core_end))
+    if not is_last:
+        # A pulse is only complete if the next onset was detected within the window
+        candidates = candidates[candidates < len(onsets) - 1]
+    if len(candidates) == 0:
+        return None
+    return candidates[0], candidates[-1]
+
+def process_chunked(path="",
+                    fs=200,
+                    start=0,
+                    end=-1,
+                    fL=0.5,
+                    fH=12,
+                    order=4,
+                    sm_wins={'ppg':50, 'vpg':10, 'apg':10, 'jpg':10},
+                    correction=None,
+                    enable_gauss=True,
+                    g_values=[0.9, 0.2, 10, 2/3, 0.4, 10, 0.5, 0.6, 10, 1/3, 0.8, 10],
+                    enable_skewed=True,
+                    s_values=[0.08, 0.2, 1/8, 1, 0.04, 0.4, 1/8, 1, 0.04, 0.6, 1/8, 1, 0.02, 0.8, 1/8, 1],
+                    savingfolder='results',
+                    workers=1,
+                    warm_start=False,
+                    backend='curve_fit',
+                    resample=None,
+                    fit_cache=None,
+                    chunk=600,
+                    overlap=30):
+    '''
+    Processes a long recording in overlapping windows, so that memory use depends on the window length rather than on
+    the length of the recording. Per-pulse tables are written to CSV files window by window (in the same folders and
+    with the same names as process_signal), and statistics are merged from partial statistics of every window.
+
+    :param path: Path of a file containing the PPG signal to be analysed
+    :param fs: Sampling frequency of the PPG signal
+    :param start: Start of the signal
+    :param end: End of the signal (-1 for the whole signal)
+    :param fL: Lower filter cutoff frequency in Hz
+    :param fH: Higher filter cutoff frequency in Hz
+    :param order: Filter order
+    :param sm_wins: Dictionary of smoothing windows (in ms) for the PPG and its derivatives
+    :param correction: A dataframe of fiducial point corrections (None for the default corrections)
+    :param enable_gauss: Boolean value to enable Gaussian decomposition
+    :param g_values: Initial values for Gaussian decomposition parameters
+    :param enable_skewed: Boolean value to enable Skewed Gaussian decomposition
+    :param s_values: Initial values for Skewed Gaussian decomposition parameters
+    :param savingfolder: Folder in which the output will be saved (CSV only)
+    :param workers: Number of worker processes used for pulse decomposition (1 to disable, None for one per CPU)
+    :param warm_start: Boolean value to seed the decomposition of each pulse with the parameters of the previous one
+    :param backend: Fitting backend for decomposition ('curve_fit' for SciPy per pulse, 'batch' for all pulses at once)
+    :param resample: Number of points every pulse is resampled to before decomposition (None to fit the original samples)
+    :param fit_cache: Path to a file caching decomposition results between runs (None to disable)
+    :param chunk: Length of the part of the recording processed in each window (in seconds)
+    :param overlap: Length of the signal added on both sides of each window (in seconds), which has to be longer than
+        any pulse
+    '''
+    # Load the raw signal only - filtering and everything after it is done window by window (binary recordings are
+    # memory-mapped, so only the samples of the current window are read and converted)
+    signal = loaders.load(path, fs, start, end, lazy=True)
+    fs = signal.fs
+    length = len(signal.v)
+    chunk = int(chunk * fs)
+    overlap = int(overlap * fs)
+    if overlap <= 0 or chunk <= 0:
+        raise ValueError("Chunk and overlap have to be positive")
+
+    # Output files
+    savingfolder = savingfolder.replace('/', os.sep)
+    folders = {'fiducials': os.path.join(savingfolder, 'Fiducial_points'),
+               'vals': os.path.join(savingfolder, 'Biomarker_vals'),
+               'stats': os.path.join(savingfolder, 'Biomarker_stats'),
+               'defs': os.path.join(savingfolder, 'Biomarker_defs'),
+               'additional': os.path.join(savingfolder, 'Additional')}
+    for folder in folders.values():
+        os.makedirs(folder, exist_ok=True)
+    suffix = f"_btwn_{signal.start_sig}-{signal.end_sig}.csv"
+    prefix = signal.name + '_'
+    writers = {'Fiducials': TableWriter(os.path.join(folders['fiducials'], prefix + 'Fiducials' + suffix)),
+               'VPG': TableWriter(os.path.join(folders['additional'], prefix + 'VPG' + suffix)),
+               'PPG_extra': TableWriter(os.path.join(folders['additional'], prefix + 'PPG_extra' + suffix))}
+    if enable_gauss:
+        writers['Gaussians'] = TableWriter(os.path.join(folders['additional'], prefix + 'Gaussians' + suffix))
+        writers['Gaussian_additional'] = TableWriter(os.path.join(folders['additional'], prefix + 'Gaussian_additional' + suffix))
+    if enable_skewed:
+        writers['Skewed'] = TableWriter(os.path.join(folders['additional'], prefix + 'Skewed' + suffix))
+    bm_writers = {}
+    bm_defs = None
+    sqi = []
+
+    cache = FitCache(fit_cache) if fit_cache and (enable_gauss or enable_skewed) else None
+    handoff = 0
+    pulses = 0
+    for window_start, core_start, core_end, window_end in windows(length, chunk, overlap):
+        # Filter the window and detect its fiducial points
+        window = DotMap()
+        window.start_sig = signal.start_sig + window_start
+        window.end_sig = signal.start_sig + window_end
+        window.v = signal.v[window_start:window_end]
+        window.fs = fs
+        window.name = signal.name
+        s, fiducials = ps.prepare_loaded_signal(window, fL, fH, order, sm_wins, correction)
+        if len(fiducials) == 0:
+            continue
+
+        # Pulses belonging to this window
+        onsets = fiducials['on'].to_numpy(dtype=float) + window_start
+        owned = owned_pulses(onsets, handoff, core_end, window_end == length, tolerance=int(0.1 * fs))
+        if owned is None:
+            continue
+        first, last = owned
+        handoff = onsets[last + 1] if last + 1 < len(onsets) else core_end
+        index = pd.RangeIndex(pulses, pulses + last - first + 1)
+
+        fp = Fiducials(fp=fiducials)
+        ppgPulses, vpgPulses, apgPulses, jpgPulses = ps.get_pulses(s, fp)
+        ownedPulses = ppgPulses[first:last + 1]
+
+        # Fiducial points (relative to the start of the recording, as saved by process_signal)
+        owned_fiducials = fiducials.iloc[first:last + 1] + window.start_sig
+        owned_fiducials.index = pd.RangeIndex(pulses + 1, pulses + len(index) + 1, name=fiducials.index.name)
+        writers['Fiducials'].append(owned_fiducials)
+
+        # Decomposition of the pulses of this window only
+        if enable_gauss or enable_skewed:
+            decompPulses = ps.preprocess_pulses(ownedPulses)
+            if resample:
+                decompPulses = ps.resample_pulses(decompPulses, resample)
+        if enable_gauss:
+            gauss = ps.get_gaussians(decompPulses, g_values=g_values, workers=workers, warm_start=warm_start, backend=backend, preprocess=False, cache=cache)
+            gauss_additional = ps.additional_gauss(gauss)
+            gauss.index = index
+            gauss_additional.index = index
+            writers['Gaussians'].append(gauss)
+            writers['Gaussian_additional'].append(gauss_additional)
+        if enable_skewed:
+            skew = ps.get_skewed(decompPulses, initials=s_values, workers=workers, warm_start=warm_start, backend=backend, preprocess=False, cache=cache)
+            skew.index = index
+            writers['Skewed'].append(skew)
+
+        # VPG and PPG features
+        vpg_features = vpg.features(s.vpg, fp).iloc[first:last + 1]
+        vpg_features.index = index
+        writers['VPG'].append(vpg_features)
+        ppg_features = ppg.features(ownedPulses)
+        ppg_features.index = index
+        writers['PPG_extra'].append(ppg_features)
+
+        # Signal quality of the beats of this window
+        beat_sqi = SQI.get_ppgSQI(ppg=s.ppg, fs=s.fs, annotation=fp.sp)
+        sqi.append(beat_sqi[first:min(last + 1, len(beat_sqi))])
+
+        # Biomarkers (rows are indexed by pulse, time stamps are relative to the loaded signal as in process_signal)
+        bmex = BM.BmCollection(s=s, fp=fp)
+        defs, vals, stats = bmex.get_biomarkers()
+        bm_defs = defs if bm_defs is None else bm_defs
+        for key, table in vals.items():
+            table = table[(table.index >= first) & (table.index <= last)].copy()
+            table.index = pd.Index(table.index - first + pulses + 1, name=table.index.name)
+            table['TimeStamp'] = table['TimeStamp'] + window_start
+            if key not in bm_writers:
+                bm_writers[key] = TableWriter(os.path.join(folders['vals'], prefix + key + suffix), exclude=['TimeStamp'])
+            bm_writers[key].append(table)
+
+        pulses += len(index)
+        print(f"Processed {window.end_sig - signal.start_sig} of {length} samples ({pulses} pulses)")
+
+    if cache is not None:
+        cache.close()
+
+    # Statistics across all pulses, merged from the statistics of every window
+    stats_names = {'Gaussians': 'Gaussian_stats', 'Skewed': 'Skewed_stats', 'VPG': 'VPG_stats', 'PPG_extra': 'PPG_extra_stats'}
+    for name, stats_name in stats_names.items():
+        if name in writers and writers[name].rows:
+            writers[name].summary().to_csv(os.path.join(folders['additional'], prefix + stats_name + suffix))
+    for key, writer in bm_writers.items():
+        stats = writer.summary()
+        stats.index.name = 'Statistics'
+        stats.to_csv(os.path.join(folders['stats'], prefix + key + suffix))
+    if bm_defs is not None:
+        for key, table in bm_defs.items():
+            table.index = table.index + 1
+            table.to_csv(os.path.join(folders['defs'], prefix + key + suffix))
+
+    if sqi:
+        print(f"ppgSQI: {round(np.mean(np.concatenate(sqi)) * 100, 2)}")
+    print(f"Results have been saved into the \"{savingfolder}\".")
@@ -5,15 +5,20 @@ import numpy as np
 import pandas as pd
 from dotmap import DotMap
 import os
+import atexit
+import queue
+import threading
+from concurrent.futures import Future
 from scipy.io import savemat
 
 # Modified save_data function from pyPPG to save additional features
 
-def save_data(savingformat: str, savingfolder: str, print_flag=True, s={}, fp=pd.DataFrame(), bm=pd.DataFrame(), gauss=None, gauss_stats=None, gauss_additional=None, skewed=None, skewed_stats=None, vpg=pd.DataFrame(), vpg_stats=pd.DataFrame() ,ppg_extra=pd.DataFrame(), ppg_extra_stats=pd.DataFrame()):
+def save_data(savingformat: str, savingfolder: str, print_flag=True, s={}, fp=pd.DataFrame(), bm=pd.DataFrame(), gauss=None, gauss_stats=None, gauss_additional=None, skewed=None, skewed_stats=None, vpg=None, vpg_stats=None, ppg_extra=None, ppg_extra_stats=None, gauss_resampling_error=None, skewed_resampling_error=None):
     """
     Save the results of the filtered PPG analysis.
 
-    :param savingformat: file format of the saved date, the provided file formats .mat and .csv
+    :param savingformat: file format of the saved date, the provided file formats .mat and .csv, or "npz" to save
+        everything into a single compressed .npz file (see load_tables)
     :type savingformat: str
     :param savingfolder: location of the saved data
     :type savingfolder: str
@@ -30,12 +35,17 @@ def save_data(savingformat: str, savingfolder: str, print_flag=True, s={}, fp=pd
     :type gauss: pd.DataFrame
     :param gauss_stats: a DataFrame of Gaussian statistics
     :type gauss_stats: pd.DataFrame
+    :param gauss_resampling_error: a DataFrame of the error introduced by resampling pulses before Gaussian decomposition
+    :type gauss_resampling_error: pd.DataFrame
+    :param skewed_resampling_error: a DataFrame of the error introduced by resampling pulses before skewed Gaussian
+        decomposition
+    :type skewed_resampling_error: pd.DataFrame
 
     :return: file_names: dictionary of the saved file names
     """
 
     # Set up directories
-    savingfolder = savingfolder.replace('/', '\\')
+    savingfolder = savingfolder.replace('/', os.sep)
 
     if not(':' in savingfolder) and savingfolder[0]!='/':
         relative_path=r'.'+os.sep
@@ -45,6 +55,18 @@ def save_data(savingformat: str, savingfolder: str, print_flag=True, s={}, fp=pd
     tmp_dir = savingfolder
     os.makedirs(tmp_dir, exist_ok=True)
 
+    file_names = {}
+    if savingformat=="npz":
+        file_name = (relative_path+tmp_dir+os.sep+s.name+'_btwn_%s-%s.npz')%(s.start_sig,s.end_sig)
+        file_names['npz'] = file_name
+        tables = {'Gaussians': gauss, 'Gaussian_stats': gauss_stats, 'Gaussian_additional': gauss_additional,
+                  'Skewed': skewed, 'Skewed_stats': skewed_stats, 'VPG': vpg, 'VPG_stats': vpg_stats,
+                  'PPG_extra': ppg_extra, 'PPG_extra_stats': ppg_extra_stats,
+                  'Gaussian_resampling_error': gauss_resampling_error, 'Skewed_resampling_error': skewed_resampling_error}
+        save_npz(file_name, s, fp, bm, tables)
+        if print_flag: print('Results have been saved into the "'+file_name+'".')
+        return file_names
+
     temp_dirs = ['Fiducial_points', 'Biomarker_vals', 'Biomarker_stats', 'Biomarker_defs', 'PPG_struct', 'Biomarker_defs_and_stats', 'Additional']
     for i in temp_dirs:
         temp_dir = tmp_dir + os.sep + i + os.sep
@@ -56,7 +78,6 @@ def save_data(savingformat: str, savingfolder: str, print_flag=True, s={}, fp=pd
     for i in keys_list:
         exec('sc.'+i+' = s.'+i)
 
-    file_names = {}
     file_name = (relative_path + tmp_dir + os.sep + temp_dirs[4] + os.sep + s.name + '_data_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
     file_names ['data_struct_mat']= file_name
     scipy.io.savemat(file_name, sc)
@@ -111,19 +132,32 @@ def save_data(savingformat: str, savingfolder: str, print_flag=True, s={}, fp=pd
             file_names['skewed_stats_csv'] = file_name
             skewed_stats.to_csv(file_name)
         # VPG
-        file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'VPG_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
-        file_names['vpg_csv'] = file_name
-        vpg.to_csv(file_name)
-        file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'VPG_stats_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
-        file_names['vpg_stats_csv'] = file_name
-        vpg_stats.to_csv(file_name)
+        if vpg is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'VPG_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
+            file_names['vpg_csv'] = file_name
+            vpg.to_csv(file_name)
+        if vpg_stats is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'VPG_stats_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
+            file_names['vpg_stats_csv'] = file_name
+            vpg_stats.to_csv(file_name)
         # PPG
-        file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'PPG_extra_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
-        file_names['ppg_extra_csv'] = file_name
-        ppg_extra.to_csv(file_name)
-        file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'PPG_extra_stats_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
-        file_names['ppg_extra_stats_csv'] = file_name
-        ppg_extra_stats.to_csv(file_name)
+        if ppg_extra is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'PPG_extra_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
+            file_names['ppg_extra_csv'] = file_name
+            ppg_extra.to_csv(file_name)
+        if ppg_extra_stats is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'PPG_extra_stats_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
+            file_names['ppg_extra_stats_csv'] = file_name
+            ppg_extra_stats.to_csv(file_name)
+        # Resampling
+        if gauss_resampling_error is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'Gaussian_resampling_error_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
+            file_names['gaussian_resampling_error_csv'] = file_name
+            gauss_resampling_error.to_csv(file_name)
+        if skewed_resampling_error is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'Skewed_resampling_error_btwn_%s-%s.csv')%(s.start_sig,s.end_sig)
+            file_names['skewed_resampling_error_csv'] = file_name
+            skewed_resampling_error.to_csv(file_name)
 
     if savingformat=="mat"  or savingformat=="both":
         file_name = (relative_path+tmp_dir+os.sep+temp_dirs[0]+os.sep+s.name+'_'+'Fiducials_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
@@ -183,22 +217,218 @@ def save_data(savingformat: str, savingfolder: str, print_flag=True, s={}, fp=pd
             file_names['skewed_stats_mat']=file_name
             savemat(file_name, {'Skewed_stats': gauss_stats.to_records(index=True)})
         # VPG
-        file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'VPG_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
-        file_names['vpg_mat']=file_name
-        savemat(file_name, {'VPG': vpg.to_records(index=True)})
-        file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'VPG_stats_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
-        file_names['vpg_stats_mat']=file_name
-        savemat(file_name, {'VPG stats': vpg_stats.to_records(index=True)})
+        if vpg is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'VPG_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
+            file_names['vpg_mat']=file_name
+            savemat(file_name, {'VPG': vpg.to_records(index=True)})
+        if vpg_stats is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'VPG_stats_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
+            file_names['vpg_stats_mat']=file_name
+            savemat(file_name, {'VPG stats': vpg_stats.to_records(index=True)})
         # PPG
-        file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'PPG_extra_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
-        file_names['ppg_extra_mat']=file_name
-        savemat(file_name, {'ppg_extra': ppg_extra.to_records(index=True)})
-        file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'PPG_extra_stats_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
-        file_names['ppg_extra_stats_mat']=file_name
-        savemat(file_name, {'ppg_extra_stats': ppg_extra_stats.to_records(index=True)})
+        if ppg_extra is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'PPG_extra_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
+            file_names['ppg_extra_mat']=file_name
+            savemat(file_name, {'ppg_extra': ppg_extra.to_records(index=True)})
+        if ppg_extra_stats is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'PPG_extra_stats_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
+            file_names['ppg_extra_stats_mat']=file_name
+            savemat(file_name, {'ppg_extra_stats': ppg_extra_stats.to_records(index=True)})
+        # Resampling
+        if gauss_resampling_error is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'Gaussian_resampling_error_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
+            file_names['gaussian_resampling_error_mat']=file_name
+            savemat(file_name, {'Gaussian_resampling_error': gauss_resampling_error.to_records(index=True)})
+        if skewed_resampling_error is not None:
+            file_name = (relative_path+tmp_dir+os.sep+temp_dirs[6]+os.sep+s.name+'_'+'Skewed_resampling_error_btwn_%s-%s.mat')%(s.start_sig,s.end_sig)
+            file_names['skewed_resampling_error_mat']=file_name
+            savemat(file_name, {'Skewed_resampling_error': skewed_resampling_error.to_records(index=True)})
     if savingformat != "csv" and savingformat != "mat" and savingformat != "both" and savingformat!="none":
-        raise('The file format is not suported for data saving! You can use "mat" or "csv" file formats.')
+        raise ValueError('The file format is not suported for data saving! You can use "mat", "csv" or "npz" file formats.')
 
     if print_flag: print('Results have been saved into the "'+tmp_dir+'".')
 
-    return file_names
\ No newline at end of file
+    return file_names
+
+def table_arrays(name, table):
+    '''
+    Converts a dataframe into arrays for an .npz file - one array per column (so that columns can be read separately),
+    the index and the names of the index and the columns. Text columns are stored as unicode arrays.
+
+    :param name: Name of the table in the file
+    :param table: A dataframe
+    :return: A dictionary of arrays by name in the file
+    '''
+    def column_array(values):
+        values = np.asarray(values)
+        if values.dtype == object:
+            values = np.array([str(value) for value in values], dtype=str)
+        return values
+
+    arrays = {name + '/__columns__': np.array([str(column) for column in table.columns], dtype=str),
+              name + '/__index__': column_array(table.index),
+              name + '/__index_name__': np.array('' if table.index.name is None else str(table.index.name))}
+    for i, column in enumerate(table.columns):
+        arrays['%s/%d' % (name, i)] = column_array(table[column])
+    return arrays
+
+def save_npz(file_name, s, fp, bm, tables):
+    '''
+    Saves the signal, fiducial points, biomarkers and feature tables of a recording into a single compressed .npz file.
+    Indices are shifted as in the CSV files (fiducial points, biomarker values and definitions start from 1).
+
+    :param file_name: Path to the .npz file
+    :param s: a struct of PPG signal
+    :param fp: a struct of fiducial points
+    :param bm: a dictionary of biomarkers
+    :param tables: A dictionary of feature tables by name (tables which are None are not saved)
+    '''
+    all_tables = {}
+
+    # Signal - the signal arrays as columns, and other attributes (numbers and text) in a table of one row
+    signal_names = [name for name in ['v', 'ppg', 'vpg', 'apg', 'jpg'] if name in s.__dict__]
+    all_tables['PPG_struct'] = pd.DataFrame({name: np.asarray(getattr(s, name)) for name in signal_names})
+    attributes = {name: value for name, value in s.__dict__.items()
+                  if name not in signal_names and isinstance(value, (int, float, str, bool, np.number))}
+    all_tables['PPG_struct_info'] = pd.DataFrame([attributes])
+
+    tmp_fp = fp.get_fp()
+    tmp_fp.index = tmp_fp.index + 1
+    all_tables['Fiducials'] = tmp_fp
+
+    try:
+        BM_keys = bm.bm_vals.keys()
+    except:
+        BM_keys = {}
+    for key in BM_keys:
+        vals = bm.bm_vals[key].copy()
+        vals.index = vals.index + 1
+        all_tables[key + '_vals'] = vals
+        all_tables[key + '_stats'] = bm.bm_stats[key]
+        defs = bm.bm_defs[key].copy()
+        defs.index = defs.index + 1
+        all_tables[key + '_defs'] = defs
+
+    all_tables.update({name: table for name, table in tables.items() if table is not None})
+
+    arrays = {'__tables__': np.array(list(all_tables), dtype=str)}
+    for name, table in all_tables.items():
+        arrays.update(table_arrays(name, table))
+    # Write to a temporary file first so that an interrupted run never leaves a partial file
+    with open(file_name + '.tmp', 'wb') as file:
+        np.savez_compressed(file, **arrays)
+    os.replace(file_name + '.tmp', file_name)
+
+def load_tables(file_name, tables=None, columns=None):
+    '''
+    Loads tables from an .npz file saved by save_data. Only the requested tables and columns are read and decompressed.
+
+    :param file_name: Path to the .npz file
+    :param tables: Name of a table, or a list of names (None for all tables)
+    :param columns: A list of columns to be read from every table (None for all columns)
+    :return: A dataframe if a single table name was given, otherwise a dictionary of dataframes by name
+    '''
+    with np.load(file_name, allow_pickle=False) as data:
+        names = list(data['__tables__']) if tables is None else [tables] if isinstance(tables, str) else tables
+        result = {}
+        for name in names:
+            if name + '/__columns__' not in data:
+                raise KeyError('Table "%s" is not in the file' % name)
+            all_columns = list(data[name + '/__columns__'])
+            selected = all_columns if columns is None else [column for column in all_columns if column in columns]
+            index = pd.Index(data[name + '/__index__'], name=str(data[name + '/__index_name__']) or None)
+            result[name] = pd.DataFrame({column: data['%s/%d' % (name, all_columns.index(column))] for column in selected},
+                                        index=index, columns=selected)
+    return result[tables] if isinstance(tables, str) else result
+
+class AsyncSaver:
+    '''
+    Saves results with save_data in a background thread, so that the next recording can be processed while the
+    previous one is being written.
+
+    The queue of results waiting to be saved is bounded: submit() blocks while it is full, which limits the number of
+    results kept in memory. Pending results are saved before the program exits, and every failure is reported by the
+    Future of the failed result as well as by flush() and close().
+    '''
+
+    def __init__(self, max_pending=2):
+        '''
+        :param max_pending: Maximum number of results waiting to be saved
+        '''
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='AsyncSaver', daemon=True)
+        self.thread.start()
+        # Save whatever is still pending if the program exits without closing the saver
+        atexit.register(self.close)
+
+    def submit(self, **kwargs):
+        '''
+        Adds results to the queue (waiting if it is full).
+
+        :param kwargs: Arguments of save_data
+        :return: A Future of the dictionary of saved file names (raising the error if saving failed)
+        '''
+        if self.closed:
+            raise RuntimeError("The saver has been closed")
+        future = Future()
+        self.queue.put((future, kwargs))
+        return future
+
+    def run(self):
+        '''
+        Saves queued results one by one until the saver is closed (runs in the background thread).
+        '''
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                future, kwargs = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(save_data(**kwargs))
+                except Exception as e:
+                    self.errors.append((kwargs.get('savingfolder'), e))
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''
+        Waits until all submitted results are saved.
+
+        :raises RuntimeError: If saving of any result failed since the previous flush
+        '''
+        self.queue.join()
+        errors, self.errors = self.errors, []
+        if errors:
+            message = "; ".join(f"{folder}: {error!r}" for folder, error in errors)
+            raise RuntimeError(f"Saving failed for {len(errors)} result(s): {message}") from errors[0][1]
+
+    def close(self):
+        '''
+        Saves all pending results and stops the background thread.
+
+        :raises RuntimeError: If saving of any result failed since the previous flush
+        '''
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+            atexit.unregister(self.close)
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except RuntimeError as e:
+            if exc_type is None:
+                raise
+            # Do not hide the error which ended the block
+            print(e)
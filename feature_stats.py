@@ -0,0 +1,314 @@
+import numpy as np
+import pandas as pd
+
+# This file contains the statistics engine shared by all feature tables
+
+index = ['mean', 'median', 'std', 'percentile_25', 'percentile_75', 'iqr', 'skew', 'kurtosis', 'mad']
+
+def quantile(ordered, count, q):
+    '''
+    Calculates a quantile of each row of a sorted matrix with linear interpolation (as numpy.percentile and pandas)
+
+    :param ordered: A matrix with one feature per row, sorted along the rows with missing values at the end
+    :param count: Number of valid (not missing) values in each row
+    :param q: Quantile to calculate (between 0 and 1)
+    :return: The quantile of each row
+    '''
+    position = q * (count - 1)
+    previous = np.maximum(np.floor(position), 0).astype(int)
+    following = np.maximum(np.minimum(previous + 1, count - 1), 0).astype(int)
+    gamma = position - previous
+    a = np.take_along_axis(ordered, previous[:, np.newaxis], axis=1)[:, 0]
+    b = np.take_along_axis(ordered, following[:, np.newaxis], axis=1)[:, 0]
+    # Same interpolation formula as numpy, which is exact at both ends of the interval
+    difference = b - a
+    result = np.where(gamma >= 0.5, b - difference * (1 - gamma), a + difference * gamma)
+    return np.where(count > 0, result, np.nan)
+
+def median(ordered, count):
+    '''
+    Calculates the median of each row of a sorted matrix as the mean of the middle values (as numpy.median and pandas)
+
+    :param ordered: A matrix with one feature per row, sorted along the rows with missing values at the end
+    :param count: Number of valid (not missing) values in each row
+    :return: The median of each row
+    '''
+    lower = np.maximum((count - 1) // 2, 0).astype(int)
+    upper = np.maximum(count // 2, 0).astype(int)
+    a = np.take_along_axis(ordered, lower[:, np.newaxis], axis=1)[:, 0]
+    b = np.take_along_axis(ordered, upper[:, np.newaxis], axis=1)[:, 0]
+    return np.where(count > 0, np.where(lower == upper, a, (a + b) / 2), np.nan)
+
+def zero_out_fperr(values):
+    '''
+    Treats values too small to be distinguished from floating point error as zero (as pandas does for skew/kurtosis)
+
+    :param values: An array of values
+    :return: The array with values below 1e-14 in magnitude replaced by zero
+    '''
+    return np.where(np.abs(values) < 1e-14, 0, values)
+
+def summary(features):
+    '''
+    Calculates statistics of every feature (column) of a feature table across all pulses.
+
+    All statistics are computed from a single sort (median and percentiles) and one set of central moments (standard
+    deviation, skewness, kurtosis and mean absolute deviation), skipping missing values and giving the same results as
+    the corresponding pandas methods.
+
+    :param features: A dataframe of features by pulse
+    :return: A dataframe of statistics (mean, median, std, percentile_25, percentile_75, iqr, skew, kurtosis, mad) by feature
+    '''
+    # One row per feature so that every reduction runs over contiguous memory
+    values = np.ascontiguousarray(features.to_numpy(dtype=float).T)
+    missing = np.isnan(values)
+    count = np.sum(~missing, axis=1).astype(float)
+    if values.shape[1] == 0:
+        return pd.DataFrame(np.nan, index=index, columns=features.columns)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Median and percentiles from one sort (missing values are sorted to the end)
+        ordered = np.sort(values, axis=1)
+        medians = median(ordered, count)
+        percentile_25 = quantile(ordered, count, 0.25)
+        percentile_75 = quantile(ordered, count, 0.75)
+
+        # Central moments
+        mean = np.where(missing, 0, values).sum(axis=1) / count
+        adjusted = np.where(missing, 0, values - mean[:, np.newaxis])
+        adjusted2 = adjusted ** 2
+        m2 = adjusted2.sum(axis=1)
+        m3 = (adjusted2 * adjusted).sum(axis=1)
+        m4 = (adjusted2 ** 2).sum(axis=1)
+        # Deviations of infinite values from an infinite mean are undefined and skipped (as pandas), so that the mean
+        # absolute deviation of a feature with infinite values is infinite
+        deviation = np.abs(values - mean[:, np.newaxis])
+        defined = ~np.isnan(deviation)
+        mad = np.where(defined, deviation, 0).sum(axis=1) / defined.sum(axis=1)
+
+    return statistics(features.columns, count, mean, m2, m3, m4, mad, medians, percentile_25, percentile_75)
+
+def statistics(columns, count, mean, m2, m3, m4, mad, medians, percentile_25, percentile_75):
+    '''
+    Calculates the statistics of summary from the number of values, central moments and quantiles of every feature.
+
+    :param columns: Names of the features
+    :param count: Number of valid (not missing) values of every feature
+    :param mean: Mean of every feature
+    :param m2: Sum of squared deviations from the mean of every feature
+    :param m3: Sum of cubed deviations from the mean of every feature
+    :param m4: Sum of deviations from the mean to the fourth power of every feature
+    :param mad: Mean absolute deviation of every feature
+    :param medians: Median of every feature
+    :param percentile_25: 25th percentile of every feature
+    :param percentile_75: 75th percentile of every feature
+    :return: A dataframe of statistics (see summary) by feature
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Sample standard deviation
+        std = np.where(count > 1, np.sqrt(m2 / (count - 1)), np.nan)
+
+        # Bias-corrected skewness
+        skew_m2 = zero_out_fperr(m2)
+        skew_m3 = zero_out_fperr(m3)
+        skew = (count * (count - 1) ** 0.5 / (count - 2)) * (skew_m3 / skew_m2 ** 1.5)
+        skew = np.where(skew_m2 == 0, 0, skew)
+        skew = np.where(count < 3, np.nan, skew)
+
+        # Bias-corrected excess kurtosis
+        adj = 3 * (count - 1) ** 2 / ((count - 2) * (count - 3))
+        numerator = zero_out_fperr(count * (count + 1) * (count - 1) * m4)
+        denominator = zero_out_fperr((count - 2) * (count - 3) * m2 ** 2)
+        kurtosis = numerator / denominator - adj
+        kurtosis = np.where(denominator == 0, 0, kurtosis)
+        kurtosis = np.where(count < 4, np.nan, kurtosis)
+
+    stats = np.vstack([mean, medians, std, percentile_25, percentile_75, percentile_75 - percentile_25, skew, kurtosis, mad])
+    return pd.DataFrame(stats, index=index, columns=columns)
+
+def merge_moments(a, b):
+    '''
+    Combines the number of values, mean and central moments of two parts of the same features (Pebay's formulas), so
+    that they can be calculated part by part.
+
+    :param a: A tuple of the count, mean, m2, m3 and m4 (see statistics) of every feature in the first part
+    :param b: The same tuple for the second part
+    :return: The same tuple for both parts together
+    '''
+    count_a, mean_a, m2_a, m3_a, m4_a = a
+    count_b, mean_b, m2_b, m3_b, m4_b = b
+    count = count_a + count_b
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(count_b > 0, mean_b - np.where(count_a > 0, mean_a, 0), 0)
+        share = np.where(count > 0, count_b / count, 0)
+        mean = np.where(count_a > 0, mean_a, 0) + delta * share
+        # The difference of the means is undefined if a part has infinite values, whose mean is that of the sums
+        total = np.where(count_a > 0, count_a * mean_a, 0) + np.where(count_b > 0, count_b * mean_b, 0)
+        mean = np.where(np.isfinite(mean), mean, total / count)
+        mean = np.where(count > 0, mean, np.nan)
+        product = np.where(count > 0, count_a * count_b / count, 0)
+        m2 = m2_a + m2_b + delta ** 2 * product
+        m3 = (m3_a + m3_b + delta ** 3 * product * np.where(count > 0, (count_a - count_b) / count, 0)
+              + 3 * delta * np.where(count > 0, (count_a * m2_b - count_b * m2_a) / count, 0))
+        m4 = (m4_a + m4_b
+              + delta ** 4 * product * np.where(count > 0, (count_a ** 2 - count_a * count_b + count_b ** 2) / count ** 2, 0)
+              + 6 * delta ** 2 * np.where(count > 0, (count_a ** 2 * m2_b + count_b ** 2 * m2_a) / count ** 2, 0)
+              + 4 * delta * np.where(count > 0, (count_a * m3_b - count_b * m3_a) / count, 0))
+    return count, mean, m2, m3, m4
+
+class QuantileSketch:
+    '''
+    Mergeable summary of the distribution of one feature for quantiles (a compactor sketch, as KLL). Values are kept
+    exactly until there are more than the capacity, then the kept values are sorted and every other one is kept with
+    twice the weight, level by level, so that memory grows only with the logarithm of the number of values. The rank of
+    a quantile is off by at most a few parts in the capacity.
+    '''
+
+    def __init__(self, capacity=10000):
+        '''
+        :param capacity: Number of values kept at every level
+        '''
+        self.capacity = capacity
+        self.levels = [np.empty(0)]
+        self.offsets = [0]
+
+    def update(self, values):
+        '''
+        :param values: An array of values (without missing values)
+        '''
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self.compact()
+
+    def merge(self, other):
+        '''
+        :param other: A QuantileSketch of other values of the same feature
+        '''
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+                self.offsets.append(0)
+            self.levels[level] = np.concatenate((self.levels[level], values))
+        self.compact()
+
+    def compact(self):
+        '''
+        Halves every level which holds more values than the capacity, moving the kept values to the next level.
+        '''
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self.capacity:
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self.offsets.append(0)
+                # Compact an even number of values, alternating between odd and even positions to avoid a bias
+                values = np.sort(values)
+                even = len(values) - len(values) % 2
+                self.levels[level + 1] = np.concatenate((self.levels[level + 1], values[self.offsets[level]:even:2]))
+                self.levels[level] = values[even:]
+                self.offsets[level] = 1 - self.offsets[level]
+            level += 1
+
+    def sorted(self):
+        '''
+        :return: The kept values in ascending order and their weights (the number of values each stands for)
+        '''
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(values), 2 ** level) for level, values in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        return values[order], weights[order]
+
+def weighted_value(values, weights, positions):
+    '''
+    Finds the values at positions of the sorted values, every value repeated by its weight.
+
+    :param values: Values in ascending order
+    :param weights: Weights of the values
+    :param positions: Positions (integers) in the repeated values
+    :return: The value at every position
+    '''
+    last = np.cumsum(weights) - 1
+    return values[np.minimum(np.searchsorted(last, positions), len(values) - 1)]
+
+class RunningSummary:
+    '''
+    Statistics of a feature table which is built block by block (see summary), calculated from partial statistics of
+    every block rather than from the whole table: the number of values and central moments of every feature are merged
+    exactly, and its median and percentiles come from a QuantileSketch (exact until there are more values than the
+    capacity of the sketch). Summaries of parts of a table can be merged.
+    '''
+
+    def __init__(self, capacity=10000):
+        '''
+        :param capacity: Number of values of every feature kept exactly by its QuantileSketch
+        '''
+        self.capacity = capacity
+        self.columns = None
+        self.moments = None
+        self.sketches = None
+
+    def start(self, columns):
+        '''
+        :param columns: Names of the features
+        '''
+        self.columns = pd.Index(columns)
+        zeros = np.zeros(len(columns))
+        self.moments = (zeros, np.full(len(columns), np.nan), zeros, zeros, zeros)
+        self.sketches = [QuantileSketch(self.capacity) for _ in columns]
+
+    def update(self, features):
+        '''
+        :param features: A dataframe of features by pulse (the rows added to the table)
+        '''
+        if self.columns is None:
+            self.start(features.columns)
+        values = np.ascontiguousarray(features.reindex(columns=self.columns).to_numpy(dtype=float).T)
+        missing = np.isnan(values)
+        count = np.sum(~missing, axis=1).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(missing, 0, values).sum(axis=1) / count
+            adjusted = np.where(missing, 0, values - mean[:, np.newaxis])
+            adjusted2 = adjusted ** 2
+            moments = (count, mean, adjusted2.sum(axis=1), (adjusted2 * adjusted).sum(axis=1), (adjusted2 ** 2).sum(axis=1))
+        self.moments = merge_moments(self.moments, moments)
+        for sketch, row, row_missing in zip(self.sketches, values, missing):
+            sketch.update(row[~row_missing])
+
+    def merge(self, other):
+        '''
+        :param other: A RunningSummary of other rows of the same table
+        '''
+        if other.columns is None:
+            return
+        if self.columns is None:
+            self.start(other.columns)
+        self.moments = merge_moments(self.moments, other.moments)
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+
+    def summary(self):
+        '''
+        :return: A dataframe of statistics by feature (as summary)
+        '''
+        if self.columns is None:
+            return pd.DataFrame(index=index)
+        count, mean, m2, m3, m4 = self.moments
+        medians, percentile_25, percentile_75, mad = np.full((4, len(self.columns)), np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for column, sketch in enumerate(self.sketches):
+                if count[column] == 0:
+                    continue
+                values, weights = sketch.sorted()
+                n = count[column]
+                medians[column] = np.mean(weighted_value(values, weights, [(n - 1) // 2, n // 2]))
+                # Linear interpolation between the values around a position (as quantile)
+                for result, q in [(percentile_25, 0.25), (percentile_75, 0.75)]:
+                    position = q * (n - 1)
+                    a, b = weighted_value(values, weights, [np.floor(position), np.floor(position) + 1])
+                    gamma = position - np.floor(position)
+                    result[column] = b - (b - a) * (1 - gamma) if gamma >= 0.5 else a + (b - a) * gamma
+                # Undefined deviations are skipped (as summary)
+                deviation = np.abs(values - mean[column])
+                defined = ~np.isnan(deviation)
+                mad[column] = np.sum(weights[defined] * deviation[defined]) / np.sum(weights[defined])
+        return statistics(self.columns, count, mean, m2, m3, m4, mad, medians, percentile_25, percentile_75)
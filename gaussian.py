@@ -1,9 +1,12 @@
 import numpy as np
-from scipy.optimize import curve_fit, fmin
-from scipy.integrate import quad
+from scipy.optimize import curve_fit
+import batch_fit
 
 # This file contains functions to perform Gaussian decomposition
 
+# Names of the parameters of the four Gaussian model (as columns of the decomposition results)
+names = ['a1', 'm1', 'sd1', 'a2', 'm2', 'sd2', 'a3', 'm3', 'sd3', 'a4', 'm4', 'sd4']
+
 def gaussian(time, amp, mean, var):
     '''
     Calculates the value of a Gaussian function with given parameters at given time
@@ -40,6 +43,47 @@ def gaussians(t, a1, m1, v1, a2, m2, v2, a3, m3, v3, a4, m4, v4):
              (a3 * np.exp(-(t - m3) ** 2 / (2 * (v3 ** 2)))) +
              (a4 * np.exp(-(t - m4) ** 2 / (2 * (v4 ** 2)))))
 
+def gaussian_derivatives(time, amp, mean, var):
+    '''
+    Calculates the partial derivatives of a Gaussian function with respect to its parameters at given time
+
+    :param time: Time at which the derivatives should be evaluated
+    :param amp: Amplitude of the Gaussian function
+    :param mean: Mean of the Gaussian function
+    :param var: Variance of the Gaussian function
+    :return: Derivatives with respect to the amplitude, mean and variance (in this order)
+    '''
+    exponential = np.exp(-(time - mean) ** 2 / (2 * (var ** 2)))
+    d_amp = exponential
+    d_mean = amp * exponential * (time - mean) / (var ** 2)
+    d_var = amp * exponential * (time - mean) ** 2 / (var ** 3)
+    return d_amp, d_mean, d_var
+
+def gaussians_jacobian(t, a1, m1, v1, a2, m2, v2, a3, m3, v3, a4, m4, v4):
+    '''
+    Calculates the Jacobian of the sum of four Gaussian functions (see gaussians) with respect to its parameters
+
+    :param t: Time at which the Jacobian should be evaluated
+    :param a1: Amplitude of the first Gaussian function
+    :param m1: Mean of the first Gaussian function
+    :param v1: Variance of the first Gaussian function
+    :param a2: Amplitude of the second Gaussian function
+    :param m2: Mean of the second Gaussian function
+    :param v2: Variance of the second Gaussian function
+    :param a3: Amplitude of the third Gaussian function
+    :param m3: Mean of the third Gaussian function
+    :param v3: Variance of the third Gaussian function
+    :param a4: Amplitude of the fourth Gaussian function
+    :param m4: Mean of the fourth Gaussian function
+    :param v4: Variance of the fourth Gaussian function
+    :return: An array with one row per time point and one column per parameter
+    '''
+    # Stack parameter-major so that each derivative is contiguous and return a (time x parameter) view
+    return np.moveaxis(np.stack(gaussian_derivatives(t, a1, m1, v1)
+                    + gaussian_derivatives(t, a2, m2, v2)
+                    + gaussian_derivatives(t, a3, m3, v3)
+                    + gaussian_derivatives(t, a4, m4, v4), axis=0), 0, -1)
+
 def gaussians2(t, a1, m1, v1, a2, m2, v2):
     '''
     Calculates the value of a sum of two Gaussian functions with given parameters at given time
@@ -66,25 +110,154 @@ def gaussian_array(amp, mean, var):
     :return: An array representing the Gaussian function
     '''
     time = np.arange(0, 1, 0.01)
-    return [gaussian(t, amp, mean, var) for t in time]
+    return gaussian(time, amp, mean, var)
 
-def find_gaussians(pulse, initials):
+def gaussian_mean(amp, mean, var):
+    '''
+    Calculates the mean value of Gaussian functions over the normalised pulse duration (the mean of gaussian_array)
+
+    :param amp: Amplitude(s) of the Gaussian function(s)
+    :param mean: Mean(s) of the Gaussian function(s)
+    :param var: Variance(s) of the Gaussian function(s)
+    :return: Mean value of each Gaussian function over the normalised pulse duration
+    '''
+    time = np.arange(0, 1, 0.01)
+    amp, mean, var = (np.asarray(x, dtype=float)[..., np.newaxis] for x in (amp, mean, var))
+    return np.mean(gaussian(time, amp, mean, var), axis=-1)
+
+def gaussian_area(amp, var):
+    '''
+    Calculates the area under Gaussian functions in closed form (the integral over the whole real line)
+
+    :param amp: Amplitude(s) of the Gaussian function(s)
+    :param var: Variance(s) of the Gaussian function(s)
+    :return: Area under each Gaussian function
+    '''
+    return amp * np.abs(var) * np.sqrt(2 * np.pi)
+
+def find_gaussians(pulse, initials, maxfev=100000, full_output=False):
     '''
     Performs decomposition of a pulse into four Gaussian function by curve fitting
 
     :param pulse: Pulse to be decomposed
     :param initials: Initial values of the parameters (amplitude, mean, standard deviation for 4 Gaussian functions in an array)
-    :return: Parameters of the four Gaussian functions fitting the pulse
+    :param maxfev: Maximum number of function evaluations
+    :param full_output: A boolean to also return the number of function evaluations of the fit
+    :return: Parameters of the four Gaussian functions fitting the pulse (and the number of function evaluations)
     '''
     time = np.arange(pulse.size)
     # Normalise time
     time = time / pulse.size
-    opt, covar = curve_fit(gaussians, time, pulse, p0=initials, maxfev=100000, bounds=(0,np.inf))
-    return opt
+    opt, covar, info, message, status = curve_fit(gaussians, time, pulse, p0=initials, maxfev=maxfev, bounds=(0,np.inf), jac=gaussians_jacobian, full_output=True)
+    return (opt, info['nfev']) if full_output else opt
+
+def find_gaussians_batch(pulses, initials, max_iter=1000, ftol=1e-8, xtol=1e-8, full_output=False):
+    '''
+    Performs decomposition of many pulses into four Gaussian functions at once with the batched Levenberg-Marquardt engine
+
+    :param pulses: A list of pulses to be decomposed
+    :param initials: Initial values of the parameters (amplitude, mean, standard deviation for 4 Gaussian functions in an array)
+    :param max_iter: Maximum number of iterations
+    :param ftol: Relative reduction of the sum of squares at which a fit stops
+    :param xtol: Relative change of the parameters at which a fit stops
+    :param full_output: A boolean to also return the number of evaluations of the model (one per pulse evaluated)
+    :return: A matrix of parameters of the four Gaussian functions with one row per pulse (and the number of evaluations)
+    '''
+    return batch_fit.levenberg_marquardt(gaussians, gaussians_jacobian, pulses, initials, max_iter=max_iter, ftol=ftol, xtol=xtol, full_output=full_output)
+
+def systolic_maximum(a1, m1, v1, a2, m2, v2, xtol=1e-4, ftol=1e-4, maxfun=200):
+    '''
+    Finds the maximum of the sum of the first two Gaussian functions (the systolic wave) for many pulses at once
+
+    This is the one-dimensional Nelder-Mead search of scipy.optimize.fmin started from t=0 (same coefficients,
+    tolerances and evaluation limit), carried out for all pulses simultaneously with a mask of pulses still searching.
+
+    :param a1: Amplitude(s) of the first Gaussian function
+    :param m1: Mean(s) of the first Gaussian function
+    :param v1: Variance(s) of the first Gaussian function
+    :param a2: Amplitude(s) of the second Gaussian function
+    :param m2: Mean(s) of the second Gaussian function
+    :param v2: Variance(s) of the second Gaussian function
+    :param xtol: Absolute error in time acceptable for convergence
+    :param ftol: Absolute error in the maximum acceptable for convergence
+    :param maxfun: Maximum number of function evaluations per pulse
+    :return: The maximum value of the systolic wave of each pulse
+    '''
+    params = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (a1, m1, v1, a2, m2, v2)))
+    shape = params[0].shape
+    params = [x.ravel() for x in params]
+    fcalls = np.zeros(shape, dtype=int).ravel()
+
+    def evaluate(index, time):
+        # Negative of the systolic wave, as the search minimises
+        fcalls[index] += 1
+        return -gaussians2(time, *(x[index] for x in params))
+
+    with np.errstate(all='ignore'):
+        # Initial simplex: t=0 and t=0.00025
+        x0 = np.zeros_like(params[0])
+        x1 = np.full_like(params[0], 0.00025)
+        index = np.arange(x0.size)
+        f0 = evaluate(index, x0)
+        f1 = evaluate(index, x1)
+        iterations = np.ones_like(fcalls)
+
+        while True:
+            # Keep the best vertex first
+            swap = (f1 < f0) | (np.isnan(f0) & ~np.isnan(f1))
+            x0, x1 = np.where(swap, x1, x0), np.where(swap, x0, x1)
+            f0, f1 = np.where(swap, f1, f0), np.where(swap, f0, f1)
+
+            searching = ((fcalls < maxfun) & (iterations < maxfun)
+                         & ~((np.abs(x1 - x0) <= xtol) & (np.abs(f0 - f1) <= ftol)))
+            index = np.flatnonzero(searching)
+            if index.size == 0:
+                break
+
+            # Reflection
+            xr = 2.0 * x0[index] - 1.0 * x1[index]
+            fxr = evaluate(index, xr)
+            new_x = x1[index]
+            new_f = f1[index]
+
+            # Expansion
+            expand = fxr < f0[index]
+            allowed = expand & (fcalls[index] < maxfun)
+            xe = 3.0 * x0[index] - 2.0 * x1[index]
+            fxe = np.full_like(fxr, np.inf)
+            fxe[allowed] = evaluate(index[allowed], xe[allowed])
+            use_xe = allowed & (fxe < fxr)
+            use_xr = allowed & ~use_xe
+            new_x = np.where(use_xe, xe, np.where(use_xr, xr, new_x))
+            new_f = np.where(use_xe, fxe, np.where(use_xr, fxr, new_f))
+
+            # Outside contraction when the reflection improved on the worst vertex, inside contraction otherwise
+            contract = ~expand & (fcalls[index] < maxfun)
+            outside = fxr < f1[index]
+            xc = np.where(outside, 1.5 * x0[index] - 0.5 * x1[index], 0.5 * x0[index] + 0.5 * x1[index])
+            fxc = np.full_like(fxr, np.inf)
+            fxc[contract] = evaluate(index[contract], xc[contract])
+            accept = contract & np.where(outside, fxc <= fxr, fxc < f1[index])
+            new_x = np.where(accept, xc, new_x)
+            new_f = np.where(accept, fxc, new_f)
+
+            # Shrink towards the best vertex
+            shrink = contract & ~accept & (fcalls[index] < maxfun)
+            xs = x0[index] + 0.5 * (x1[index] - x0[index])
+            fxs = np.full_like(fxr, np.inf)
+            fxs[shrink] = evaluate(index[shrink], xs[shrink])
+            new_x = np.where(shrink, xs, new_x)
+            new_f = np.where(shrink, fxs, new_f)
+
+            x1[index] = new_x
+            f1[index] = new_f
+            iterations[index] += 1
+
+    return -np.fmin(f0, f1).reshape(shape)
 
 def augmentation_index(a1, m1, v1, a2, m2, v2, a3):
     '''
-    Calculates augmentation index of a decomposed pulse
+    Calculates augmentation index of decomposed pulses (works on single values or whole parameter columns)
 
     :param a1: Amplitude of the first Gaussian function
     :param m1: Mean of the first Gaussian function
@@ -95,7 +268,7 @@ def augmentation_index(a1, m1, v1, a2, m2, v2, a3):
     :param a3: Amplitude of the third Gaussian function
     :return: The augmentation index of the decomposed pulse
     '''
-    sysMax = -fmin(lambda t, a1, m1, v1, a2, m2, v2: -gaussians2(t, a1, m1, v1, a2, m2, v2), 0, (a1, m1, v1, a2, m2, v2), full_output=True, disp=False)[1]
+    sysMax = systolic_maximum(a1, m1, v1, a2, m2, v2)
     return sysMax / a3
 
 def reflection_index(a1, m1, v1, a2, m2, v2, a3, m3, v3):
@@ -113,8 +286,8 @@ def reflection_index(a1, m1, v1, a2, m2, v2, a3, m3, v3):
     :param v3: Variance of the third Gaussian function
     :return: The reflection index of the decomposed pulse
     '''
-    sys_integral = quad(gaussians2, -np.inf, np.inf, (a1, m1, v1, a2, m2, v2))[0]
-    three_integral = quad(gaussian, -np.inf, np.inf, (a3, m3, v3))[0]
+    sys_integral = gaussian_area(a1, v1) + gaussian_area(a2, v2)
+    three_integral = gaussian_area(a3, v3)
     return sys_integral - three_integral
 
 def sys_dia(a1, m1, v1, a2, m2, v2, a3, m3, v3, a4, m4, v4):
@@ -135,6 +308,6 @@ def sys_dia(a1, m1, v1, a2, m2, v2, a3, m3, v3, a4, m4, v4):
     :param v4: Variance of the fourth Gaussian function
     :return: The ratio of areas under the Gaussian functions representing the systolic phase to diastolic phase
     '''
-    sys_integral = quad(gaussians2, -np.inf, np.inf, (a1, m1, v1, a2, m2, v2))[0]
-    dia_integral = quad(gaussians2, -np.inf, np.inf, (a3, m3, v3, a4, m4, v4))[0]
+    sys_integral = gaussian_area(a1, v1) + gaussian_area(a2, v2)
+    dia_integral = gaussian_area(a3, v3) + gaussian_area(a4, v4)
     return sys_integral / dia_integral
\ No newline at end of file
@@ -0,0 +1,195 @@
+import os
+import numpy as np
+import wfdb
+from dotmap import DotMap
+from pyPPG.datahandling import load_data
+
+# This file contains loaders which memory-map large binary recordings (.npy, raw int16/float32 and WFDB) instead of
+# reading them into memory
+
+# Sample types of raw binary recordings (headerless, little-endian) by file extension
+raw_types = {'.i16': '<i2', '.int16': '<i2', '.f32': '<f4', '.float32': '<f4'}
+
+# Sample types of WFDB signal formats which can be memory-mapped (other formats are read with wfdb)
+wfdb_types = {'16': '<i2', '61': '>i2', '32': '<i4', '80': 'u1'}
+
+# Extensions of the recordings loaded by this module
+extensions = ['.npy', '.hea'] + list(raw_types)
+
+class ScaledSignal:
+    '''
+    Digital samples (e.g. a memory-mapped array) converted to physical units only when they are accessed, so that parts
+    of a long recording can be taken without converting the whole recording.
+    '''
+
+    def __init__(self, samples, gain=1.0, baseline=0):
+        '''
+        :param samples: Digital samples
+        :param gain: Number of digital units per physical unit
+        :param baseline: Digital value corresponding to 0 physical units
+        '''
+        self.samples = samples
+        self.gain = gain
+        self.baseline = baseline
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, key):
+        '''
+        :param key: Index or slice of samples
+        :return: The samples in physical units (a new array)
+        '''
+        return (np.asarray(self.samples[key], dtype=np.float64) - self.baseline) / self.gain
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+def load(path, fs=200, start=0, end=-1, channel=None, lazy=False):
+    '''
+    Loads a PPG signal as pyPPG's load_data does. Binary recordings (see extensions) are memory-mapped and the signal is
+    a view of the requested segment, so only the samples which are used are read from the disk (when they are used).
+
+    :param path: Path to the signal file (the .hea header of a WFDB record)
+    :param fs: Sampling frequency (Hz) - the sampling frequency in the header of a WFDB record takes precedence
+    :param start: Start of the signal (in samples)
+    :param end: End of the signal (in samples, -1 or any value not above start for the end of the recording)
+    :param channel: Channel of multi-channel recordings (index of the column of a 2-d .npy file, or index or name of a
+        WFDB signal - None for the first channel, or for WFDB the first one named like a PPG)
+    :param lazy: A boolean to convert memory-mapped WFDB signals to physical units only when parts of them are taken
+        (the signal is then a ScaledSignal rather than an array)
+    :return: Loaded signal (DotMap with start_sig, end_sig, v, fs and name, as returned by load_data)
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        samples = load_npy(path, channel)
+    elif extension in raw_types:
+        samples = load_raw(path, raw_types[extension])
+    elif extension == '.hea':
+        return load_wfdb(path, start, end, channel, lazy)
+    else:
+        return load_data(data_path=path, fs=fs, start_sig=start, end_sig=end)
+    return segment(samples, path, fs, start, end)
+
+def segment(samples, path, fs, start, end):
+    '''
+    Selects a segment of a signal without copying it.
+
+    :param samples: The whole signal (e.g. a memory-mapped array)
+    :param path: Path to the signal file (the name of the recording is the file name without extension)
+    :param fs: Sampling frequency (Hz)
+    :param start: Start of the segment (in samples)
+    :param end: End of the segment (in samples, any value not above start for the end of the signal)
+    :return: Loaded signal (DotMap as returned by load_data) containing a view of the segment
+    '''
+    s = DotMap()
+    s.start_sig = start
+    s.end_sig = end if start < end else len(samples)
+    s.v = samples[s.start_sig:s.end_sig]
+    if len(s.v) == 0:
+        raise ValueError(f"There is no signal between samples {start} and {end} of {path}")
+    s.fs = fs
+    s.name = os.path.splitext(os.path.basename(path))[0]
+    return s
+
+def load_npy(path, channel=None):
+    '''
+    Memory-maps a .npy file.
+
+    :param path: Path to the .npy file (a 1-d array, or a 2-d array with one column per channel)
+    :param channel: Column of a 2-d array (None for the first column)
+    :return: A read-only memory-mapped array of the signal
+    '''
+    samples = np.load(path, mmap_mode='r')
+    if samples.ndim == 2:
+        samples = samples[:, channel or 0]
+    elif samples.ndim != 1:
+        raise ValueError(f"{path} is not a 1-d or 2-d array")
+    return samples
+
+def load_raw(path, dtype, offset=0, channels=1, channel=0):
+    '''
+    Memory-maps a headerless binary file.
+
+    :param path: Path to the binary file
+    :param dtype: Type of the samples (e.g. '<i2' for little-endian int16)
+    :param offset: Number of bytes before the first sample
+    :param channels: Number of interleaved channels
+    :param channel: Channel of the signal
+    :return: A read-only memory-mapped array of the signal (a strided view for interleaved channels)
+    '''
+    dtype = np.dtype(dtype)
+    frames = (os.path.getsize(path) - offset) // (dtype.itemsize * channels)
+    samples = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(frames, channels))
+    return samples[:, channel]
+
+def load_wfdb(path, start=0, end=-1, channel=None, lazy=False):
+    '''
+    Loads a signal of a WFDB record. Signals stored in a single file in a format of wfdb_types are memory-mapped, others
+    are read with wfdb (only the requested segment is read). Digital values are converted to physical units, which
+    copies the segment, unless the conversion is left until parts of the signal are taken.
+
+    :param path: Path to the .hea header of the record
+    :param start: Start of the signal (in samples)
+    :param end: End of the signal (in samples, any value not above start for the end of the record)
+    :param channel: Index or name of the signal (None for the first signal named like a PPG, or the first signal)
+    :param lazy: A boolean to return a memory-mapped signal as a ScaledSignal (converted when parts of it are taken)
+    :return: Loaded signal (DotMap as returned by load_data, with the sampling frequency of the record)
+    '''
+    record = os.path.splitext(path)[0]
+    header = wfdb.rdheader(record)
+    index = wfdb_channel(header.sig_name or [], channel)
+    end = end if start < end else header.sig_len
+
+    file_name = header.file_name[index]
+    fmt = header.fmt[index]
+    if fmt in wfdb_types and all(name == file_name for name in header.file_name) and len(set(header.fmt)) == 1:
+        offset = (header.byte_offset[index] or 0) if header.byte_offset else 0
+        samples = load_raw(os.path.join(os.path.dirname(path), file_name), wfdb_types[fmt], offset, header.n_sig, index)
+        # Format 80 stores samples as offset binary
+        baseline = header.baseline[index] + (128 if fmt == '80' else 0)
+        v = ScaledSignal(samples[start:end], header.adc_gain[index] or 200, baseline)
+        if not lazy:
+            v = v[:]
+    else:
+        v = wfdb.rdrecord(record, sampfrom=start, sampto=end, channels=[index]).p_signal[:, 0]
+
+    s = DotMap()
+    s.start_sig = start
+    s.end_sig = end
+    s.v = v
+    s.fs = header.fs
+    s.name = os.path.basename(record)
+    return s
+
+def recording_files(path):
+    '''
+    Lists the files a recording is read from.
+
+    :param path: Path to the signal file (the .hea header of a WFDB record)
+    :return: A list of paths - the signal file, and for a WFDB record the data files named in its header
+    '''
+    if os.path.splitext(path)[1].lower() != '.hea':
+        return [path]
+    header = wfdb.rdheader(os.path.splitext(path)[0])
+    folder = os.path.dirname(path)
+    return [path] + [os.path.join(folder, name) for name in dict.fromkeys(header.file_name or [])]
+
+def wfdb_channel(names, channel=None):
+    '''
+    Finds the index of a signal of a WFDB record.
+
+    :param names: Names of the signals of the record
+    :param channel: Index or name of the signal (None for the first signal named like a PPG, or the first signal)
+    :return: Index of the signal
+    '''
+    if isinstance(channel, str):
+        if channel not in names:
+            raise ValueError(f"There is no signal named {channel} (signals: {', '.join(names)})")
+        return names.index(channel)
+    if channel is not None:
+        return channel
+    for index, name in enumerate(names):
+        if any(label in name.upper() for label in ['PLETH', 'PPG']):
+            return index
+    return 0
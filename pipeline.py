@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import profiling
+
+# This file contains a pipeline of named stages which only runs the stages needed for the requested outputs
+
+class Pipeline:
+    '''
+    A dependency graph of named stages. Every stage is a function called with the results of the stages it requires
+    (as arguments, in the order the stages are listed), so that asking for some outputs runs only these stages and their
+    dependencies, each at most once.
+    '''
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, function, requires=[]):
+        '''
+        Adds a stage to the pipeline.
+
+        :param name: Name of the stage (and of its result)
+        :param function: Function computing the result of the stage from the results of the required stages
+        :param requires: Names of the stages whose results the function takes
+        '''
+        self.stages[name] = (function, list(requires))
+
+    def plan(self, outputs):
+        '''
+        Finds the stages needed for the given outputs.
+
+        :param outputs: Names of the requested stages
+        :return: A list of stage names in an order in which they can be run (every stage after its requirements)
+        '''
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name not in self.stages:
+                raise ValueError(f"Unknown pipeline stage: {name}")
+            if name in visiting:
+                raise ValueError(f"Pipeline stage {name} depends on itself")
+            visiting.add(name)
+            for requirement in self.stages[name][1]:
+                visit(requirement)
+            visiting.remove(name)
+            order.append(name)
+
+        for name in outputs:
+            visit(name)
+        return order
+
+    def call(self, name, results, profiler=None):
+        '''
+        Runs a single stage.
+
+        :param name: Name of the stage
+        :param results: A dictionary of results by stage name containing the results of the required stages
+        :param profiler: A Profiler measuring the stage (None to disable)
+        :return: Result of the stage
+        '''
+        function, requires = self.stages[name]
+        args = [results[requirement] for requirement in requires]
+        with profiling.stage(profiler, name):
+            return function(*args)
+
+    def run(self, outputs, workers=1, profiler=None):
+        '''
+        Runs the stages needed for the given outputs.
+
+        :param outputs: Names of the requested stages
+        :param workers: Number of stages run at once in a pool of threads (1 to run them one after another) - a stage
+            starts as soon as all stages it requires are finished
+        :param profiler: A Profiler measuring every stage (None to disable)
+        :return: A dictionary of results by stage name (including the stages the outputs depend on)
+        '''
+        order = self.plan(outputs)
+        results = {}
+        if workers is not None and workers <= 1:
+            for name in order:
+                results[name] = self.call(name, results, profiler)
+            return results
+
+        waiting = list(order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while waiting or running:
+                # Start every stage whose requirements are finished
+                for name in [name for name in waiting if all(requirement in results for requirement in self.stages[name][1])]:
+                    running[executor.submit(self.call, name, results, profiler)] = name
+                    waiting.remove(name)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # An error in any stage stops the pipeline (after the running stages finish)
+                    results[running.pop(future)] = future.result()
+        return results
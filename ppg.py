@@ -1,5 +1,8 @@
+import numpy as np
 import pandas as pd
 from scipy.stats import skew, kurtosis
+import feature_stats
+from pulses import PulseStore
 
 # This file contains functions which process additional PPG features.
 
@@ -7,9 +10,14 @@ def features(ppg):
     '''
     Extracts additional features (skeweness and kurtosis) from PPG pulses.
 
-    :param ppg: PPG signal to be processed
+    :param ppg: PPG pulses to be processed (a PulseStore or a list of pulses)
     :return: A dataframe of skeweness and kurtosis by pulse
     '''
+    if isinstance(ppg, PulseStore) and ppg.is_monotonic():
+        skewness, kurt = shape_statistics(ppg)
+        return pd.DataFrame({'Skewness': skewness,
+                             'Kurtosis': kurt})
+
     dict = {'Skewness': [],
             'Kurtosis': []}
     for pulse in ppg:
@@ -17,6 +25,27 @@ def features(ppg):
         dict['Kurtosis'].append(kurtosis(pulse))
     return pd.DataFrame(dict)
 
+def shape_statistics(pulses):
+    '''
+    Calculates skewness and kurtosis of all pulses at once from central moments of each pulse. The results match
+    scipy.stats.skew and scipy.stats.kurtosis with default (biased, Fisher) settings, including NaN for constant pulses.
+
+    :param pulses: A monotonic PulseStore of PPG pulses
+    :return: Two arrays - skewness and kurtosis of every pulse
+    '''
+    means = pulses.mean()
+    deviations = pulses.deviations(means)
+    squares = deviations ** 2
+    m2 = pulses.mean(squares)
+    m3 = pulses.mean(squares * deviations)
+    m4 = pulses.mean(squares ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Pulses with variance indistinguishable from floating point error are treated as constant (as in SciPy)
+        constant = m2 <= (np.finfo(float).resolution * means) ** 2
+        skewness = np.where(constant, np.nan, m3 / m2 ** 1.5)
+        kurt = np.where(constant, np.nan, m4 / m2 ** 2) - 3
+    return skewness, kurt
+
 def ppg_stats(ppg_features):
     '''
     Calculates statistics for additional PPG features.
@@ -24,28 +53,4 @@ def ppg_stats(ppg_features):
     :param ppg_features: A dataframe of PPG features
     :return: Statistics for additional PPG features across all pulses
     '''
-    index = ['mean', 'median', 'std', 'percentile_25', 'percentile_75', 'iqr', 'skew', 'kurtosis', 'mad']
-    dict = {"Skewness": [],
-            "Kurtosis": []}
-    for key, value in ppg_features.mean().items():
-        dict[key].append(value)
-    for key, value in ppg_features.median().items():
-        dict[key].append(value)
-    for key, value in ppg_features.std().items():
-        dict[key].append(value)
-    for key, value in ppg_features.quantile(q=0.25).items():
-        dict[key].append(value)
-    for key, value in ppg_features.quantile(q=0.75).items():
-        dict[key].append(value)
-    # Subtract 75th (last item) from 25th percentile (2nd to last item) to get IQR
-    for key in dict:
-        dict[key].append(dict[key][-1] - dict[key][-2])
-    for key, value in ppg_features.skew().items():
-        dict[key].append(value)
-    for key, value in ppg_features.kurtosis().items():
-        dict[key].append(value)
-    # Mean absolute deviation
-    for key in dict:
-        dict[key].append((ppg_features[key] - ppg_features[key].mean()).abs().mean())
-
-    return pd.DataFrame(dict, index=index)
+    return feature_stats.summary(ppg_features)
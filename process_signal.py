@@ -1,11 +1,17 @@
 # Import PPG
 from pyPPG import PPG, Fiducials, Biomarkers
-from pyPPG.datahandling import load_data, save_data
+from pyPPG.datahandling import save_data
 import pyPPG.preproc as PP
 import pyPPG.fiducials as FP
 import pyPPG.biomarkers as BM
 import pyPPG.ppg_sqi as SQI
 # Import other
+import os
+import math
+import inspect
+from itertools import repeat
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
@@ -15,9 +21,27 @@ import custom_save
 import vpg
 import ppg
 import skewed
+import feature_stats
+from pulses import PulseStore
+from cache import FitCache, SignalCache
+from pipeline import Pipeline
+import profiling
+from profiling import Profiler
+import loaders
 
 # This file contains functions encompassing the processing pipeline of a PPG signal, extracting the features
 
+# Outputs of the pipeline which can be requested from process_signal
+gauss_outputs = ['gauss', 'gauss_stats', 'gauss_additional']
+skewed_outputs = ['skewed', 'skewed_stats']
+pipeline_outputs = gauss_outputs + skewed_outputs + ['vpg', 'vpg_stats', 'ppg_extra', 'ppg_extra_stats', 'sqi', 'biomarkers']
+
+# Fitting backends of the decompositions
+backends = ['curve_fit', 'batch']
+
+# Stages estimating the error introduced by resampling pulses (see resampling_error), saved as tables of the same name
+resampling_reports = ['gauss_resampling_error', 'skewed_resampling_error']
+
 def process_signal(path="",
                    fs=200,
                    start=0,
@@ -26,7 +50,7 @@ def process_signal(path="",
                    fH=12,
                    order=4,
                    sm_wins={'ppg':50, 'vpg':10, 'apg':10, 'jpg':10},
-                   correction=pd.DataFrame(),
+                   correction=None,
                    enable_gauss=True,
                    gauss_live_plot=False,
                    g_values=[0.9, 0.2, 10, 2/3, 0.4, 10, 0.5, 0.6, 10, 1/3, 0.8, 10],
@@ -34,12 +58,25 @@ def process_signal(path="",
                    skewed_live_plot=False,
                    s_values=[0.08, 0.2, 1/8, 1, 0.04, 0.4, 1/8, 1, 0.04, 0.6, 1/8, 1, 0.02, 0.8, 1/8, 1],
                    savingformat='csv',
-                   savingfolder='results'):
+                   savingfolder='results',
+                   workers=1,
+                   warm_start=False,
+                   backend='curve_fit',
+                   resample=None,
+                   resample_report=False,
+                   fit_cache=None,
+                   signal_cache=None,
+                   saver=None,
+                   outputs=None,
+                   stage_workers=1,
+                   profile=False,
+                   cprofile=None):
     '''
     This function is responsible for the PPG signal processing pipeline, taking signal path and configuration options as
     parameters and saving the output to the specified folder.
 
-    :param path: Path of the input signal
+    :param path: Path of the input signal (binary .npy, raw .i16/.f32 and WFDB .hea recordings are memory-mapped, see
+        loaders)
     :param fs: Sampling frequency
     :param start: Beginning of the signal in sample
     :param end: End of the signal in sample
@@ -47,20 +84,220 @@ def process_signal(path="",
     :param fH: Higher cutoff frequency in Hz
     :param order: Order of the filter to be applied
     :param sm_wins: Smoothing windows in ms for each derivative (dictionary)
-    :param correction: DataFrame where the key is the name of the fiducial points and the value is bool
+    :param correction: DataFrame where the key is the name of the fiducial points and the value is bool (None for the
+        default corrections)
     :param enable_gauss: Boolean value to enable Gaussian decomposition (True to enable, False to disable)
     :param gauss_live_plot: Boolean value to display a plot of Gaussian decomposition for each pulse during processing
     :param g_values: Initial values for Gaussian decomposition parameters
     :param enable_skewed: Boolean value to enable Skewed Gaussian decomposition (True to enable, False to disable)
     :param skewed_live_plot: Boolean value to display a plot of Gaussian decomposition for each pulse during processing
     :param s_values: Initial values for Skewed Gaussian decomposition parameters
-    :param savingformat: File format for the output ('csv', 'mat', or 'both')
+    :param savingformat: File format for the output ('csv', 'mat', 'both', or 'npz' for a single file)
     :param savingfolder: Folder in which the output will be saved
+    :param workers: Number of worker processes used for pulse decomposition (1 to disable, None for one per CPU)
+    :param warm_start: Boolean value to seed the decomposition of each pulse with the parameters of the previous one
+    :param backend: Fitting backend for decomposition ('curve_fit' for SciPy per pulse, 'batch' for all pulses at once)
+    :param resample: Number of points every pulse is resampled to before decomposition (None to fit the original samples)
+    :param resample_report: Boolean value to save the error introduced by resampling a sample of pulses (see
+        resampling_error) with the other tables (Gaussian_resampling_error and Skewed_resampling_error), when pulses
+        are resampled
+    :param fit_cache: Path to a file caching decomposition results between runs (None to disable)
+    :param signal_cache: Folder caching filtered signals and fiducial points between runs (None to disable)
+    :param saver: A custom_save.AsyncSaver to save the output in the background (None to save it before returning)
+    :param outputs: Names of the outputs to be computed and saved (from pipeline_outputs, None for all) - only the
+        stages these outputs depend on are run
+    :param stage_workers: Number of independent stages (e.g. decompositions, features, SQI and biomarkers) run at
+        once in threads (1 to run them one after another, always 1 with live plots)
+    :param profile: Boolean value to save a JSON report of wall time, CPU time, peak memory, pulse counts and model
+        evaluations of every stage next to the output (<name>_profile_btwn_<start>-<end>.json)
+    :param cprofile: Names of stages to be run under cProfile (statistics are saved into the Profile folder of the output)
+    :return: A Future of the saved file names if a saver is given
+    '''
+
+    # Requested outputs (decomposition outputs are left out if the decomposition is disabled)
+    if outputs is None:
+        outputs = pipeline_outputs
+    outputs = [name for name in outputs if (enable_gauss or name not in gauss_outputs) and (enable_skewed or name not in skewed_outputs)]
+
+    decompose = any(name in gauss_outputs or name in skewed_outputs for name in outputs)
+    reports = []
+    if resample and resample_report:
+        reports = [name for name, enabled in zip(resampling_reports, [enable_gauss, enable_skewed]) if enabled]
+    cache = FitCache(fit_cache) if fit_cache and decompose else None
+    savingfolder = savingfolder.replace('/', os.sep)
+    profiler = Profiler(cprofile=cprofile, folder=os.path.join(savingfolder, 'Profile')) if profile or cprofile else None
+    try:
+        pipeline = build_pipeline(path, fs, start, end, fL, fH, order, sm_wins, correction, gauss_live_plot, g_values, skewed_live_plot, s_values, workers, warm_start, backend, resample, signal_cache, cache, profiler)
+        # Plots can only be drawn from the main thread
+        if gauss_live_plot or skewed_live_plot:
+            stage_workers = 1
+        # The signal and fiducial points are always saved
+        results = pipeline.run(['signal'] + outputs + reports, stage_workers, profiler)
+    except BaseException:
+        if profiler is not None:
+            profiler.close()
+        raise
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if 'sqi' in results:
+        print(f"ppgSQI: {results['sqi']}")
+
+    # Save data (tables which were not computed are not saved)
+    s, fp = results['signal']
+    fp_new = Fiducials(fp=fp.get_fp() + s.start_sig)
+    results = dict(savingformat=savingformat, savingfolder=savingfolder,s=s, fp=fp_new, bm=results.get('biomarkers'), gauss=results.get('gauss'), gauss_stats=results.get('gauss_stats'), gauss_additional=results.get('gauss_additional'), skewed=results.get('skewed'), skewed_stats=results.get('skewed_stats'), vpg=results.get('vpg'), vpg_stats=results.get('vpg_stats'), ppg_extra=results.get('ppg_extra'), ppg_extra_stats=results.get('ppg_extra_stats'), gauss_resampling_error=results.get('gauss_resampling_error'), skewed_resampling_error=results.get('skewed_resampling_error'))
+    if saver is not None:
+        future = saver.submit(**results)
+    else:
+        # Saving in the background is not measured
+        with profiling.stage(profiler, 'save'):
+            custom_save.save_data(**results)
+        future = None
+
+    if profiler is not None:
+        profiler.save(os.path.join(savingfolder, f"{s.name}_profile_btwn_{s.start_sig}-{s.end_sig}.json"),
+                      path=path, outputs=outputs, stage_workers=stage_workers, workers=workers, backend=backend)
+        profiler.close()
+    return future
+
+def build_pipeline(path, fs, start, end, fL, fH, order, sm_wins, correction, gauss_live_plot, g_values, skewed_live_plot, s_values, workers, warm_start, backend, resample, signal_cache, cache, profiler=None):
+    '''
+    Builds the processing pipeline of process_signal as a graph of named stages (see process_signal for the parameters).
+
+    :param cache: A FitCache for decomposition results (None to disable)
+    :param profiler: A Profiler to which stages add pulse counts and model evaluations (None to disable)
+    :return: A Pipeline - stages 'signal' (PPG object and Fiducials object), 'pulses', 'decomp_pulses', the outputs
+        listed in pipeline_outputs and, if pulses are resampled, the stages of resampling_reports
+    '''
+    pipeline = Pipeline()
+    def record(name, **details):
+        if profiler is not None:
+            profiler.record(name, **details)
+
+    def signal():
+        s, fp = load_signal(path, fs, start, end, fL, fH, order, sm_wins, correction, signal_cache, profiler)
+        record('signal', samples=len(s.ppg), pulses=len(fp.get_fp()))
+        return s, fp
+    pipeline.add('signal', signal)
+
+    def pulses(signal):
+        ppgPulses = get_pulses(*signal)[0]
+        record('pulses', pulses=len(ppgPulses))
+        return ppgPulses
+    pipeline.add('pulses', pulses, ['signal'])
+
+    # Pre-process pulses once for both decompositions
+    def decomp_pulses(pulses):
+        decompPulses = preprocess_pulses(pulses)
+        if resample:
+            decompPulses = resample_pulses(decompPulses, resample)
+        return decompPulses
+    pipeline.add('decomp_pulses', decomp_pulses, ['pulses'])
+
+    # Gaussian decomposition
+    def gauss(decomp_pulses):
+        gauss, evaluations = get_gaussians(decomp_pulses, live_plot=gauss_live_plot, g_values=g_values, workers=workers, warm_start=warm_start, backend=backend, preprocess=False, cache=cache, full_output=True)
+        record('gauss', pulses=len(gauss), evaluations=evaluations)
+        return gauss
+    pipeline.add('gauss', gauss, ['decomp_pulses'])
+    pipeline.add('gauss_stats', gaussian_stats, ['gauss'])
+    pipeline.add('gauss_additional', additional_gauss, ['gauss'])
+
+    # Skewed Gaussian decomposition
+    def skew(decomp_pulses):
+        skew, evaluations = get_skewed(decomp_pulses, live_plot=skewed_live_plot, initials=s_values, workers=workers, warm_start=warm_start, backend=backend, preprocess=False, cache=cache, full_output=True)
+        record('skewed', pulses=len(skew), evaluations=evaluations)
+        return skew
+    pipeline.add('skewed', skew, ['decomp_pulses'])
+    pipeline.add('skewed_stats', skewed_stats, ['skewed'])
+
+    # Error introduced by resampling, on a sample of pulses fitted at their original length and resampled
+    if resample:
+        pipeline.add('gauss_resampling_error', lambda pulses: resampling_error(preprocess_pulses(pulses), resample, gaussian.find_gaussians, gaussian.gaussians, g_values, gaussian.names), ['pulses'])
+        pipeline.add('skewed_resampling_error', lambda pulses: resampling_error(preprocess_pulses(pulses), resample, skewed.fit, skewed.skewed_gaussian4, s_values, skewed.names), ['pulses'])
+
+    # VPG features
+    pipeline.add('vpg', lambda signal: vpg.features(signal[0].vpg, signal[1]), ['signal'])
+    pipeline.add('vpg_stats', vpg.stats, ['vpg'])
+
+    # Additional PPG features
+    pipeline.add('ppg_extra', ppg.features, ['pulses'])
+    pipeline.add('ppg_extra_stats', ppg.ppg_stats, ['ppg_extra'])
+
+    # SQI
+    pipeline.add('sqi', lambda signal: round(np.mean(SQI.get_ppgSQI(ppg=signal[0].ppg, fs=signal[0].fs, annotation=signal[1].sp)) * 100, 2), ['signal'])
+
+    # Biomarkers
+    def biomarkers(signal):
+        bmex = BM.BmCollection(s=signal[0], fp=signal[1])
+        bm_defs, bm_vals, bm_stats = bmex.get_biomarkers()
+        record('biomarkers', pulses=max([len(vals) for vals in bm_vals.values()], default=0))
+        return Biomarkers(bm_defs=bm_defs, bm_vals=bm_vals, bm_stats=bm_stats)
+    pipeline.add('biomarkers', biomarkers, ['signal'])
+    return pipeline
+
+def load_signal(path, fs, start, end, fL, fH, order, sm_wins, correction, signal_cache=None, profiler=None):
+    '''
+    Loads and filters a PPG signal and gets its fiducial points, or reuses them from the cache.
+
+    :param signal_cache: Folder caching filtered signals and fiducial points between runs (None to disable)
+    :param profiler: A Profiler measuring loading, filtering and fiducial point detection (None to disable)
+    :return: PPG object containing the signal data and Fiducials object containing the fiducial points (see
+        prepare_signal for the other parameters)
+    '''
+    # Key the cache by the corrections which are actually applied
+    correction = fiducial_correction(correction)
+    if signal_cache:
+        sig_cache = SignalCache(signal_cache)
+        key = sig_cache.key(path, fs=fs, start=start, end=end, fL=fL, fH=fH, order=order, sm_wins=sm_wins, correction=correction)
+        with profiling.stage(profiler, 'signal_cache'):
+            cached = sig_cache.load(key)
+        if cached is None:
+            s, fiducials = prepare_signal(path, fs, start, end, fL, fH, order, sm_wins, correction, profiler)
+            sig_cache.save(key, s, fiducials)
+        else:
+            signal, fiducials = cached
+            s = PPG(s=signal)
+    else:
+        s, fiducials = prepare_signal(path, fs, start, end, fL, fH, order, sm_wins, correction, profiler)
+    return s, Fiducials(fp=fiducials)
+
+def prepare_signal(path, fs, start, end, fL, fH, order, sm_wins, correction, profiler=None):
     '''
+    Loads a PPG signal, filters it, obtains its derivatives and detects fiducial points.
 
+    :param path: Path to the signal file (binary recordings are memory-mapped and only the segment is read)
+    :param fs: Sampling frequency
+    :param start: Start of the signal (in samples)
+    :param end: End of the signal (in samples)
+    :param fL: Lower cutoff frequency
+    :param fH: Upper cutoff frequency
+    :param order: Filter order
+    :param sm_wins: Dictionary of smoothing windows (in ms) for the PPG and its derivatives
+    :param correction: A dataframe of fiducial point corrections
+    :param profiler: A Profiler measuring loading, filtering and fiducial point detection (None to disable)
+    :return: PPG object containing the signal data and a dataframe of fiducial points
+    '''
     # Load a PPG signal
-    signal = load_data(data_path=path, fs=fs, start_sig=start, end_sig=end)
+    with profiling.stage(profiler, 'load'):
+        signal = loaders.load(path, fs, start, end)
+    return prepare_loaded_signal(signal, fL, fH, order, sm_wins, correction, profiler)
 
+def prepare_loaded_signal(signal, fL, fH, order, sm_wins, correction, profiler=None):
+    '''
+    Filters a loaded PPG signal, obtains its derivatives and detects fiducial points.
+
+    :param signal: Loaded signal (DotMap as returned by load_data)
+    :param fL: Lower cutoff frequency
+    :param fH: Upper cutoff frequency
+    :param order: Filter order
+    :param sm_wins: Dictionary of smoothing windows (in ms) for the PPG and its derivatives
+    :param correction: A dataframe of fiducial point corrections
+    :param profiler: A Profiler measuring filtering and fiducial point detection (None to disable)
+    :return: PPG object containing the signal data and a dataframe of fiducial points
+    '''
     # Pre-processing - filter the signal and obtain derivatives
     prep = PP.Preprocess(fL=fL, fH=fH, order=order)
     signal.filtering = True
@@ -68,77 +305,48 @@ def process_signal(path="",
     signal.fH = fH
     signal.order = order
     signal.sm_wins = sm_wins
-    signal.ppg, signal.vpg, signal.apg, signal.jpg = prep.get_signals(s=signal)
+    with profiling.stage(profiler, 'filter'):
+        signal.ppg, signal.vpg, signal.apg, signal.jpg = prep.get_signals(s=signal)
 
-    # Initialise correction
-    corr_on = ['on', 'dn', 'dp', 'v', 'w', 'f']
-    correction.loc[0, corr_on] = True
-    signal.correction = correction
+    signal.correction = fiducial_correction(correction)
 
     # Create PPG class
     s = PPG(s=signal)
 
     # Get fiducial points
-    fpex = FP.FpCollection(s=s)
-    fiducials = fpex.get_fiducials(s=s)
-    fiducials = fiducials.applymap(lambda x: np.nan if pd.isna(x) else x)
-    fp = Fiducials(fp=fiducials)
-
-    # Split into pulses
-    ppgPulses, vpgPulses, apgPulses, jpgPulses = get_pulses(s, fp)
-
-    if enable_gauss:
-        # Gaussian decomposition
-        gauss = get_gaussians(ppgPulses, live_plot=gauss_live_plot, g_values=g_values)
-        gauss_stats = gaussian_stats(gauss)
-        gauss_additional = additional_gauss(gauss)
-    else:
-        gauss = None
-        gauss_stats = None
-        gauss_additional = None
-
-    if enable_skewed:
-        # Skewed Gaussian decomposition
-        skew = get_skewed(ppgPulses, live_plot=skewed_live_plot, initials=s_values)
-        skew_stats = skewed_stats(skew)
-    else:
-        skew = None
-        skew_stats = None
-
-    # Get VPG stats
-    vpg_features = vpg.features(s.vpg, fp)
-    vpg_stats = vpg.stats(vpg_features)
-
-    # Get additional PPG stats
-    ppg_features = ppg.features(ppgPulses)
-    ppg_stats = ppg.ppg_stats(ppg_features)
+    with profiling.stage(profiler, 'fiducials'):
+        fpex = FP.FpCollection(s=s)
+        fiducials = fpex.get_fiducials(s=s)
+        fiducials = fiducials.applymap(lambda x: np.nan if pd.isna(x) else x)
+    return s, fiducials
 
-    # Calculate SQI
-    ppgSQI = round(np.mean(SQI.get_ppgSQI(ppg=s.ppg, fs=s.fs, annotation=fp.sp)) * 100, 2)
-    print(f"ppgSQI: {ppgSQI}")
-
-    # Get biomarkers
-    bmex = BM.BmCollection(s=s, fp=fp)
-    bm_defs, bm_vals, bm_stats = bmex.get_biomarkers()
-    bm = Biomarkers(bm_defs=bm_defs, bm_vals=bm_vals, bm_stats=bm_stats)
+def fiducial_correction(correction=None):
+    '''
+    Initialises the fiducial point corrections, enabling the correction of onsets, dicrotic notches, diastolic peaks and
+    the v, w and f points of the derivatives. The given dataframe is not modified.
 
-    # Save data
-    fp_new = Fiducials(fp=fp.get_fp() + s.start_sig)
-    custom_save.save_data(savingformat=savingformat, savingfolder=savingfolder,s=s, fp=fp_new, bm=bm, gauss=gauss, gauss_stats=gauss_stats, gauss_additional=gauss_additional, skewed=skew, skewed_stats=skew_stats, vpg=vpg_features, vpg_stats=vpg_stats, ppg_extra=ppg_features, ppg_extra_stats=ppg_stats)
+    :param correction: A dataframe of fiducial point corrections (None for no other corrections)
+    :return: A new dataframe of fiducial point corrections
+    '''
+    correction = pd.DataFrame() if correction is None else correction.copy()
+    corr_on = ['on', 'dn', 'dp', 'v', 'w', 'f']
+    correction.loc[0, corr_on] = True
+    return correction
 
 def get_pulses(s, fp):
     '''
-    Splits the signal into arrays of individual pulses.
+    Splits the signal into individual pulses. The signals are not copied - pulses are views created when accessed.
 
     :param s: PPG object containing the signal data
     :param fp: Fiducials object containing the fiducial points data
-    :return: 4 arrays of individual pulses (as arrays) - PPG, VPG, APG, and JPG
+    :return: 4 stores of individual pulses (as PulseStore) - PPG, VPG, APG, and JPG
     '''
     onsets = fp.get_fp().on[1:]
-    ppgPulses = np.split(s.ppg, onsets)
-    vpgPulses = np.split(s.vpg, onsets)
-    apgPulses = np.split(s.apg, onsets)
-    jpgPulses = np.split(s.jpg, onsets)
+    ppgPulses = PulseStore.from_onsets(s.ppg, onsets)
+    # All derivatives share the same pulse boundaries
+    vpgPulses = PulseStore(s.vpg, ppgPulses.indptr)
+    apgPulses = PulseStore(s.apg, ppgPulses.indptr)
+    jpgPulses = PulseStore(s.jpg, ppgPulses.indptr)
     return ppgPulses, vpgPulses, apgPulses, jpgPulses
 
 def make_positive(pulse):
@@ -166,25 +374,264 @@ def linear_correction(pulse):
     '''
     Applies linear correction on the pulse to remove skew (equalises the initial and end amplitudes of the pulse).
     :param pulse: Pulse to be corrected
-    :return: Corrected pulse
+    :return: Corrected pulse (a new array, the original pulse is not modified)
     '''
     # Get gradient and intercept
     gradient = (pulse[-1] - pulse[0]) / (len(pulse) - 1)
     intercept = pulse[0]
 
     # Apply linear correction
-    for i in range(len(pulse)):
-        pulse[i] = pulse[i] - (gradient * i + intercept)
-    return pulse
+    return pulse - (gradient * np.arange(len(pulse)) + intercept)
+
+def preprocess_pulses(ppgPulses):
+    '''
+    Pre-processes PPG pulses for decomposition - makes them positive, applies linear correction and normalises their
+    amplitude. Pulses in a PulseStore are processed all at once into a new buffer, so the signal is not modified.
+
+    :param ppgPulses: PPG pulses to be pre-processed (a PulseStore or a list of pulses)
+    :return: Pre-processed pulses (a PulseStore, or a list if a list was given)
+    '''
+    if not isinstance(ppgPulses, PulseStore) or not ppgPulses.is_monotonic() or np.any(ppgPulses.lengths == 0):
+        return [normalise_amplitude(linear_correction(make_positive(pulse))) for pulse in ppgPulses]
+
+    start = ppgPulses.indptr[0]
+    indptr = ppgPulses.indptr - start
+    starts = indptr[:-1]
+    lengths = ppgPulses.lengths
+    pulses = PulseStore(ppgPulses.signal[start:ppgPulses.indptr[-1]], indptr)
+
+    # Make positive
+    minimums = pulses.min()
+    pulses = PulseStore(pulses.signal - pulses.expand(np.where(minimums < 0, minimums, 0)), indptr)
+
+    # Linear correction (sample index within each pulse as the time axis)
+    first = pulses.signal[starts]
+    last = pulses.signal[starts + lengths - 1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        gradient = (last - first) / (lengths - 1)
+    index = np.arange(len(pulses.signal)) - pulses.expand(starts)
+    pulses = PulseStore(pulses.signal - (pulses.expand(gradient) * index + pulses.expand(first)), indptr)
+
+    # Normalise amplitude
+    return PulseStore(pulses.signal / pulses.expand(pulses.max()), indptr)
+
+def resample_pulses(ppgPulses, points):
+    '''
+    Resamples every pulse to the same number of points on the normalised time axis used for decomposition (sample i
+    of a pulse of length n lies at time i/n), with linear interpolation between samples.
+
+    :param ppgPulses: Pre-processed PPG pulses (a PulseStore or a list of pulses)
+    :param points: Number of points of every resampled pulse
+    :return: A matrix of resampled pulses with one row per pulse
+    '''
+    if not isinstance(ppgPulses, PulseStore) or not ppgPulses.is_monotonic():
+        pulses = list(ppgPulses)
+        lengths = [len(pulse) for pulse in pulses]
+        ppgPulses = PulseStore(np.concatenate(pulses) if pulses else np.empty(0), np.concatenate(([0], np.cumsum(lengths))))
+
+    lengths = ppgPulses.lengths[:, np.newaxis]
+    # Position of every new point in samples of the original pulse
+    position = np.arange(points) / points * lengths
+    previous = np.minimum(np.floor(position).astype(int), lengths - 1)
+    following = np.minimum(previous + 1, lengths - 1)
+    fraction = position - previous
+    starts = ppgPulses.starts[:, np.newaxis]
+    signal = ppgPulses.signal
+    return signal[starts + previous] * (1 - fraction) + signal[starts + following] * fraction
+
+def resampling_error(ppgPulses, points, fit, model, initials, names=None, sample=20):
+    '''
+    Estimates the error introduced by resampling pulses before decomposition, by fitting a sample of pulses both at
+    their original length and resampled.
+
+    :param ppgPulses: Pre-processed PPG pulses (a PulseStore or a list of pulses)
+    :param points: Number of points of every resampled pulse
+    :param fit: Fitting function taking a pulse and initial values (gaussian.find_gaussians or skewed.fit)
+    :param model: Model function matching the fitting function (gaussian.gaussians or skewed.skewed_gaussian4)
+    :param initials: Initial values of the parameters
+    :param names: Names of the parameters (used as column names)
+    :param sample: Number of pulses (spread evenly over the recording) to be fitted
+    :return: A dataframe by pulse of the absolute error of each parameter and the root mean square error of both fits
+        on the original pulse (rmse_original, rmse_resampled)
+    '''
+    pulses = list(ppgPulses)
+    selected = np.unique(np.linspace(0, len(pulses) - 1, min(sample, len(pulses))).astype(int))
+    resampled = resample_pulses([pulses[i] for i in selected], points)
+    if names is None:
+        names = [f"p{i + 1}" for i in range(len(initials))]
+
+    dict = {name: [] for name in names}
+    dict['rmse_original'] = []
+    dict['rmse_resampled'] = []
+    for i, resampled_pulse in zip(selected, resampled):
+        original_params = fit(pulses[i], initials)
+        resampled_params = fit(resampled_pulse, initials)
+        for name, error in zip(names, np.abs(resampled_params - original_params)):
+            dict[name].append(error)
+        dict['rmse_original'].append(fit_residual(model, pulses[i], original_params))
+        dict['rmse_resampled'].append(fit_residual(model, pulses[i], resampled_params))
+    return pd.DataFrame(dict, index=pd.Index(selected, name='Pulse'))
+
+def fit_residual(model, pulse, params):
+    '''
+    Calculates the root mean square error between a pulse and the model fitted to it.
+
+    :param model: Model function of normalised time and parameters (gaussian.gaussians or skewed.skewed_gaussian4)
+    :param pulse: Pre-processed pulse
+    :param params: Fitted parameters of the model
+    :return: Root mean square error of the fit
+    '''
+    time = np.arange(pulse.size) / pulse.size
+    return np.sqrt(np.mean((model(time, *params) - pulse) ** 2))
+
+def fit_chunk(pulses, fit, model, initials, warm_start=False, residual_jump=2.0, warm_maxfev=1000):
+    '''
+    Fits a chunk of pulses one after another. This is the unit of work sent to each worker process.
+
+    :param pulses: A list of pre-processed pulses
+    :param fit: Fitting function taking a pulse, initial values, maxfev and full_output (gaussian.find_gaussians or
+        skewed.fit)
+    :param model: Model function matching the fitting function (gaussian.gaussians or skewed.skewed_gaussian4)
+    :param initials: Initial values of the parameters
+    :param warm_start: A boolean to seed each fit with the parameters of the previous pulse
+    :param residual_jump: Factor by which the residual may grow from one pulse to the next before a warm-started
+        fit is repeated from the initial values
+    :param warm_maxfev: Maximum number of function evaluations of a warm-started fit before it is abandoned
+    :return: A list of fitted parameters by pulse, and the number of function evaluations of the fits which converged
+    '''
+    results = []
+    evaluations = 0
+    seed = None
+    seed_residual = None
+    for pulse in pulses:
+        params = None
+        if seed is not None:
+            try:
+                params, nfev = fit(pulse, seed, maxfev=warm_maxfev, full_output=True)
+                evaluations += nfev
+                residual = fit_residual(model, pulse, params)
+            except RuntimeError:
+                params = None
+        if params is None or residual > seed_residual * residual_jump:
+            # Cold start from the initial values, keeping the warm-started fit only if it is still better
+            cold_params, nfev = fit(pulse, initials, full_output=True)
+            evaluations += nfev
+            cold_residual = fit_residual(model, pulse, cold_params)
+            if params is None or cold_residual <= residual:
+                params = cold_params
+                residual = cold_residual
+        if warm_start:
+            seed = params
+            seed_residual = residual
+        results.append(params)
+    return results, evaluations
+
+def map_chunks(function, pulses, workers, *args):
+    '''
+    Applies a function to contiguous chunks of pulses, optionally spreading the chunks over a pool of processes.
+
+    :param function: Function taking a list of pulses (and the additional arguments) and returning one result per pulse
+        and the number of model evaluations it made
+    :param pulses: A list of pre-processed pulses
+    :param workers: Number of worker processes (1 to run in the current process, None for one per CPU)
+    :param args: Additional arguments passed to the function
+    :return: A list of results by pulse, in the same order as the pulses, and the number of model evaluations
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1 or len(pulses) < 2:
+        results, evaluations = function(pulses, *args)
+        return list(results), evaluations
+
+    # Send contiguous chunks rather than single pulses to keep inter-process communication low
+    chunk_size = math.ceil(len(pulses) / (workers * 4))
+    chunks = [pulses[i:i + chunk_size] for i in range(0, len(pulses), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map() returns the chunks in submission order, so the pulse order is preserved
+        results = []
+        evaluations = 0
+        for chunk, chunk_evaluations in executor.map(function, chunks, *(repeat(arg) for arg in args)):
+            results.extend(chunk)
+            evaluations += chunk_evaluations
+        return results, evaluations
+
+def fit_pulses(fit, model, pulses, initials, workers=1, warm_start=False, batch=None, cache=None, name='', full_output=False):
+    '''
+    Fits every pulse with the given fitting function, optionally spreading the pulses over a pool of processes.
+
+    :param fit: Fitting function taking a pulse, initial values, maxfev and full_output (gaussian.find_gaussians or
+        skewed.fit)
+    :param model: Model function matching the fitting function (gaussian.gaussians or skewed.skewed_gaussian4)
+    :param pulses: A list of pre-processed pulses
+    :param initials: Initial values of the parameters
+    :param workers: Number of worker processes (1 to fit in the current process, None for one per CPU)
+    :param warm_start: A boolean to seed each fit with the parameters of the previous pulse (within each chunk)
+    :param batch: Batched fitting function taking all pulses, initial values and full_output
+        (gaussian.find_gaussians_batch or skewed.fit_batch), used instead of the per-pulse fitting function if given
+    :param cache: A FitCache - pulses found in the cache are not fitted again, and new fits are added to it (not used
+        with per-pulse warm start, as a warm-started fit also depends on the pulses fitted before it). Fits are keyed
+        by the fitting function and its settings (see solver_settings)
+    :param name: Name of the model in the cache ('gaussian' or 'skewed')
+    :param full_output: A boolean to also return the number of model evaluations of the fits (none for cached fits)
+    :return: A list of fitted parameters by pulse, in the same order as the pulses (and the number of model evaluations)
+    '''
+    if cache is not None and (batch is not None or not warm_start):
+        # The batched engine ignores warm start, and per-pulse fits are only cached without it
+        settings = solver_settings(batch if batch is not None else fit)
+        keys = [cache.key(pulse, name, initials, settings) for pulse in pulses]
+        fits = cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in fits]
+        evaluations = 0
+        if missing:
+            fitted, evaluations = fit_pulses(fit, model, [pulses[i] for i in missing], initials, workers, warm_start, batch, full_output=True)
+            new_fits = {keys[i]: params for i, params in zip(missing, fitted)}
+            cache.put_many(new_fits)
+            fits.update(new_fits)
+        fitted = [fits[key] for key in keys]
+    elif batch is not None:
+        fitted, evaluations = map_chunks(partial(batch, full_output=True), pulses, workers, initials)
+    else:
+        fitted, evaluations = map_chunks(fit_chunk, pulses, workers, fit, model, initials, warm_start)
+    return (fitted, evaluations) if full_output else fitted
+
+def solver_settings(function):
+    '''
+    Describes a fitting function with the keyword arguments it is called with - its defaults, overridden by those bound
+    with functools.partial - so that fits made with different settings are told apart in the cache.
 
-def get_gaussians(ppgPulses, live_plot=False, g_values=[0.9, 0.2, 0.01, 2/3, 0.4, 0.01, 0.5, 0.6, 10, 1/3, 0.8, 0.01]):
+    :param function: A fitting function, optionally wrapped in functools.partial
+    :return: A description of the function and its settings (e.g. "skewed.fit(maxfev=100000)")
+    '''
+    bound = []
+    keywords = {}
+    while isinstance(function, partial):
+        bound = list(function.args) + bound
+        keywords = {**function.keywords, **keywords}
+        function = function.func
+    settings = {name: parameter.default for name, parameter in inspect.signature(function).parameters.items()
+                if parameter.default is not parameter.empty}
+    settings.update(keywords)
+    # Neither the initial values (keyed separately) nor the output format change the fit
+    settings = {name: value for name, value in settings.items() if name not in ['initials', 'full_output']}
+    describe = lambda value: f"{value.__module__}.{value.__qualname__}" if callable(value) else repr(value)
+    arguments = [describe(value) for value in bound] + [f"{name}={describe(settings[name])}" for name in sorted(settings)]
+    return f"{describe(function)}({', '.join(arguments)})"
+
+def get_gaussians(ppgPulses, live_plot=False, g_values=[0.9, 0.2, 0.01, 2/3, 0.4, 0.01, 0.5, 0.6, 10, 1/3, 0.8, 0.01], workers=1, warm_start=False, backend='curve_fit', preprocess=True, cache=None, full_output=False):
     '''
     Performs Gaussian decomposition on PPG pulses.
 
-    :param ppgPulses: An array of PPG pulses to be decomposed
+    :param ppgPulses: PPG pulses to be decomposed (a PulseStore or a list of pulses)
     :param live_plot: A boolean to enable (True) or disable (False) plot display for every pulse
     :param g_values: Initial values of the parameters (amplitude, mean, standard deviation for 4 Gaussian functions in an array)
-    :return: A DataFrame of Gaussian parameters by pulse
+    :param workers: Number of worker processes used for fitting (1 to disable, None for one per CPU)
+    :param warm_start: A boolean to seed each fit with the parameters of the previous pulse
+    :param backend: Fitting backend - 'curve_fit' to fit pulses one by one with SciPy, or 'batch' to fit all pulses at
+        once with the batched Levenberg-Marquardt engine (warm start does not apply)
+    :param preprocess: A boolean to pre-process the pulses with preprocess_pulses (False if they already are)
+    :param cache: A FitCache to reuse fits of pulses decomposed before (None to fit all pulses)
+    :param full_output: A boolean to also return the number of model evaluations of the fits
+    :return: A DataFrame of Gaussian parameters by pulse (and the number of model evaluations)
     '''
     dict = {"a1": [],
             "m1": [],
@@ -199,14 +646,17 @@ def get_gaussians(ppgPulses, live_plot=False, g_values=[0.9, 0.2, 0.01, 2/3, 0.4
             "m4": [],
             "sd4": []}
 
-    for pulse in ppgPulses:
-        # Pre-process pulse
-        pulse = make_positive(pulse)
-        pulse = linear_correction(pulse)
-        pulse = normalise_amplitude(pulse)
+    if preprocess:
+        ppgPulses = preprocess_pulses(ppgPulses)
+    pulses = list(ppgPulses)
+
+    if backend not in backends:
+        raise ValueError(f"Unknown fitting backend: {backend}")
+    batch = gaussian.find_gaussians_batch if backend == 'batch' else None
+    gauss_arrays, evaluations = fit_pulses(gaussian.find_gaussians, gaussian.gaussians, pulses, g_values, workers, warm_start, batch, cache, 'gaussian', full_output=True)
 
+    for pulse, gauss_array in zip(pulses, gauss_arrays):
         # Add parameters to dictionary
-        gauss_array = gaussian.find_gaussians(pulse, g_values)
         dict['a1'].append(gauss_array[0])
         dict['m1'].append(gauss_array[1])
         dict['sd1'].append(gauss_array[2])
@@ -243,7 +693,7 @@ def get_gaussians(ppgPulses, live_plot=False, g_values=[0.9, 0.2, 0.01, 2/3, 0.4
     # Convert dictionary to dataframe
     gaussians = pd.DataFrame(dict)
     gaussians = gaussians.rename_axis("Pulse")
-    return gaussians
+    return (gaussians, evaluations) if full_output else gaussians
 
 def gaussian_stats(gauss):
     '''
@@ -252,41 +702,7 @@ def gaussian_stats(gauss):
     :param gauss: A dataframe of Gaussian parameters by pulse
     :return: A dataframe of statistics of Gaussian parameters across all pulses
     '''
-    index = ['mean', 'median', 'std', 'percentile_25', 'percentile_75', 'iqr', 'skew', 'kurtosis', 'mad']
-    dict = {"a1": [],
-            "m1": [],
-            "sd1": [],
-            "a2": [],
-            "m2": [],
-            "sd2": [],
-            "a3": [],
-            "m3": [],
-            "sd3": [],
-            "a4": [],
-            "m4": [],
-            "sd4": []}
-    for key, value in gauss.mean().items():
-        dict[key].append(value)
-    for key, value in gauss.median().items():
-        dict[key].append(value)
-    for key, value in gauss.std().items():
-        dict[key].append(value)
-    for key, value in gauss.quantile(q=0.25).items():
-        dict[key].append(value)
-    for key, value in gauss.quantile(q=0.75).items():
-        dict[key].append(value)
-    # Subtract 75th (last item) from 25th percentile (2nd to last item) to get IQR
-    for key in dict:
-        dict[key].append(dict[key][-1] - dict[key][-2])
-    for key, value in gauss.skew().items():
-        dict[key].append(value)
-    for key, value in gauss.kurtosis().items():
-        dict[key].append(value)
-    # Mean absolute deviation
-    for key in dict:
-        dict[key].append((gauss[key] - gauss[key].mean()).abs().mean())
-
-    return pd.DataFrame(dict, index=index)
+    return feature_stats.summary(gauss)
 
 def additional_gauss(gauss):
     '''
@@ -295,37 +711,40 @@ def additional_gauss(gauss):
     :param gauss: A dataframe of Gaussian parameters by pulse
     :return: A dataframe of derived features from Gaussian parameters
     '''
-    dict = {"AI": [],
-            "RI": [],
-            "RTT": [],
-            "AIr": [],
-            "RIr": [],
-            "Sys/Dia": [],
-            "A4/A1": [],
-            "sd4/A1": []}
-
-    for index, row in gauss.iterrows():
-        dict['AI'].append(gaussian.augmentation_index(row['a1'], row['m1'], row['sd1'], row['a2'], row['m2'], row['sd2'], row['a3']))
-        dict['RI'].append(gaussian.reflection_index(row['a1'], row['m1'], row['sd1'], row['a2'], row['m2'], row['sd2'], row['a3'], row['m3'], row['sd3']))
-        dict['RTT'].append(np.mean(gaussian.gaussian_array(row['a3'], row['m3'], row['sd3'])) - np.mean(gaussian.gaussian_array(row['a1'], row['m1'], row['sd1'])))
-        dict['AIr'].append((row['a1'] - row['a2'])/row['a1'])
-        dict['RIr'].append((row['a3'] / row['a1']))
-        dict['Sys/Dia'].append(gaussian.sys_dia(row['a1'], row['m1'], row['sd1'], row['a2'], row['m2'], row['sd2'], row['a3'], row['m3'], row['sd3'], row['a4'], row['m4'], row['sd4']))
-        dict['A4/A1'].append(row['a4'] / row['a1'])
-        dict['sd4/A1'].append(row['sd4'] / row['a1'])
+    # Work on whole columns rather than row by row
+    a1, m1, sd1 = gauss['a1'].to_numpy(), gauss['m1'].to_numpy(), gauss['sd1'].to_numpy()
+    a2, m2, sd2 = gauss['a2'].to_numpy(), gauss['m2'].to_numpy(), gauss['sd2'].to_numpy()
+    a3, m3, sd3 = gauss['a3'].to_numpy(), gauss['m3'].to_numpy(), gauss['sd3'].to_numpy()
+    a4, m4, sd4 = gauss['a4'].to_numpy(), gauss['m4'].to_numpy(), gauss['sd4'].to_numpy()
+
+    dict = {"AI": gaussian.augmentation_index(a1, m1, sd1, a2, m2, sd2, a3),
+            "RI": gaussian.reflection_index(a1, m1, sd1, a2, m2, sd2, a3, m3, sd3),
+            "RTT": gaussian.gaussian_mean(a3, m3, sd3) - gaussian.gaussian_mean(a1, m1, sd1),
+            "AIr": (a1 - a2) / a1,
+            "RIr": a3 / a1,
+            "Sys/Dia": gaussian.sys_dia(a1, m1, sd1, a2, m2, sd2, a3, m3, sd3, a4, m4, sd4),
+            "A4/A1": a4 / a1,
+            "sd4/A1": sd4 / a1}
 
     additional = pd.DataFrame(dict)
     additional.rename_axis("Pulse")
     return additional
 
-def get_skewed(ppgPulses, live_plot=False, initials=[0.08, 0.2, 1/8, 1, 0.04, 0.4, 1/8, 1, 0.04, 0.6, 1/8, 1, 0.02, 0.8, 1/8, 1]):
+def get_skewed(ppgPulses, live_plot=False, initials=[0.08, 0.2, 1/8, 1, 0.04, 0.4, 1/8, 1, 0.04, 0.6, 1/8, 1, 0.02, 0.8, 1/8, 1], workers=1, warm_start=False, backend='curve_fit', preprocess=True, cache=None, full_output=False):
     '''
     Performes skewed Gaussian Decomposition on PPG pulses.
 
-    :param ppgPulses: An array of PPG pulses to be decomposed
+    :param ppgPulses: PPG pulses to be decomposed (a PulseStore or a list of pulses)
     :param live_plot: A boolean to enable (True) or disable (False) plot display for every pulse
     :param initials: Initial values of the parameters (amplitude, location, scale, shape for 4 skewed Gaussian functions in an array)
-    :return: A dataframe of skewed Gaussian parameters by pulse
+    :param workers: Number of worker processes used for fitting (1 to disable, None for one per CPU)
+    :param warm_start: A boolean to seed each fit with the parameters of the previous pulse
+    :param backend: Fitting backend - 'curve_fit' to fit pulses one by one with SciPy, or 'batch' to fit all pulses at
+        once with the batched Levenberg-Marquardt engine (warm start does not apply)
+    :param preprocess: A boolean to pre-process the pulses with preprocess_pulses (False if they already are)
+    :param cache: A FitCache to reuse fits of pulses decomposed before (None to fit all pulses)
+    :param full_output: A boolean to also return the number of model evaluations of the fits
+    :return: A dataframe of skewed Gaussian parameters by pulse (and the number of model evaluations)
     '''
     dict = {"a1": [],
             "loc1": [],
@@ -344,13 +763,17 @@ def get_skewed(ppgPulses, live_plot=False, initials=[0.08, 0.2, 1/8, 1, 0.04, 0.
             "scale4": [],
             "shape4": []}
 
-    for pulse in ppgPulses:
-        # Pre-process pulse
-        pulse = make_positive(pulse)
-        pulse = linear_correction(pulse)
-        pulse = normalise_amplitude(pulse)
+    if preprocess:
+        ppgPulses = preprocess_pulses(ppgPulses)
+    pulses = list(ppgPulses)
+
+    if backend not in backends:
+        raise ValueError(f"Unknown fitting backend: {backend}")
+    batch = skewed.fit_batch if backend == 'batch' else None
+    skewed_arrays, evaluations = fit_pulses(skewed.fit, skewed.skewed_gaussian4, pulses, initials, workers, warm_start, batch, cache, 'skewed', full_output=True)
+
+    for pulse, skewed_array in zip(pulses, skewed_arrays):
         # Add parameters to dictionary
-        skewed_array = skewed.fit(pulse, initials)
         dict['a1'].append(skewed_array[0])
         dict['loc1'].append(skewed_array[1])
         dict['scale1'].append(skewed_array[2])
@@ -392,7 +815,7 @@ def get_skewed(ppgPulses, live_plot=False, initials=[0.08, 0.2, 1/8, 1, 0.04, 0.
     # Convert dictionary to dataframe
     skew = pd.DataFrame(dict)
     skew = skew.rename_axis("Pulse")
-    return skew
+    return (skew, evaluations) if full_output else skew
 
 def skewed_stats(skew):
     '''
@@ -401,42 +824,4 @@ def skewed_stats(skew):
     :param skew: A dataframe of skewed Gaussian parameters by pulse
     :return: A dataframe of statistics of skewed Gaussian parameters across all pulses
     '''
-    index = ['mean', 'median', 'std', 'percentile_25', 'percentile_75', 'iqr', 'skew', 'kurtosis', 'mad']
-    dict = {"a1": [],
-            "loc1": [],
-            "scale1": [],
-            "shape1": [],
-            "a2": [],
-            "loc2": [],
-            "scale2": [],
-            "shape2": [],
-            "a3": [],
-            "loc3": [],
-            "scale3": [],
-            "shape3": [],
-            "a4": [],
-            "loc4": [],
-            "scale4": [],
-            "shape4": []}
-    for key, value in skew.mean().items():
-        dict[key].append(value)
-    for key, value in skew.median().items():
-        dict[key].append(value)
-    for key, value in skew.std().items():
-        dict[key].append(value)
-    for key, value in skew.quantile(q=0.25).items():
-        dict[key].append(value)
-    for key, value in skew.quantile(q=0.75).items():
-        dict[key].append(value)
-    # Subtract 75th (last item) from 25th percentile (2nd to last item) to get IQR
-    for key in dict:
-        dict[key].append(dict[key][-1] - dict[key][-2])
-    for key, value in skew.skew().items():
-        dict[key].append(value)
-    for key, value in skew.kurtosis().items():
-        dict[key].append(value)
-    # Mean absolute deviation
-    for key in dict:
-        dict[key].append((skew[key] - skew[key].mean()).abs().mean())
-
-    return pd.DataFrame(dict, index=index)
\ No newline at end of file
+    return feature_stats.summary(skew)
\ No newline at end of file
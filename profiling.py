@@ -0,0 +1,146 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# This file contains the instrumentation which measures time, memory and work of every stage of the pipeline
+
+class Profiler:
+    '''
+    Records wall time, CPU time, peak memory and details (e.g. pulse counts and solver function evaluations) of named
+    stages, optionally running chosen stages under cProfile.
+
+    Peak memory is measured with tracemalloc as the highest traced memory while a stage runs, above the memory traced
+    when it started. CPU time is the time of the thread running the stage, and the CPU time of worker processes
+    finished during the stage is recorded separately. When stages run concurrently, peak memory and worker CPU time
+    are shared by the stages running at the same time.
+    '''
+
+    def __init__(self, memory=True, cprofile=None, folder='.'):
+        '''
+        :param memory: A boolean to measure peak memory (tracing memory slows down processing)
+        :param cprofile: Names of stages to be run under cProfile (their statistics are saved as <stage>.prof files)
+        :param folder: Folder in which cProfile statistics are saved
+        '''
+        self.memory = memory
+        self.cprofile = cprofile or []
+        self.folder = folder
+        self.stages = []
+        self.active = []
+        self.lock = threading.Lock()
+        self.began = time.perf_counter()
+        self.started_tracing = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def update_peaks(self):
+        '''
+        Adds the peak traced memory since the last update to all running stages and starts a new measurement.
+        '''
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            for record in self.active:
+                record['peak'] = max(record['peak'], peak)
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Measures a stage (a context manager).
+
+        :param name: Name of the stage
+        :return: A dictionary to which details of the stage can be added
+        '''
+        record = {'stage': name}
+        with self.lock:
+            self.update_peaks()
+            record['start'] = time.perf_counter() - self.began
+            record['base'] = tracemalloc.get_traced_memory()[0] if self.memory else 0
+            record['peak'] = record['base']
+            self.active.append(record)
+            self.stages.append(record)
+        children = os.times()
+        cpu = time.thread_time()
+        wall = time.perf_counter()
+        profile = cProfile.Profile() if name in self.cprofile else None
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+                os.makedirs(self.folder, exist_ok=True)
+                record['cprofile'] = os.path.join(self.folder, name + '.prof')
+                profile.dump_stats(record['cprofile'])
+            record['wall_time'] = time.perf_counter() - wall
+            record['cpu_time'] = time.thread_time() - cpu
+            finished = os.times()
+            record['worker_cpu_time'] = (finished.children_user + finished.children_system) - (children.children_user + children.children_system)
+            with self.lock:
+                self.update_peaks()
+                self.active.remove(record)
+            base = record.pop('base')
+            peak = record.pop('peak')
+            if self.memory:
+                record['peak_memory'] = peak - base
+
+    def record(self, name, **details):
+        '''
+        Adds details to the most recent stage of the given name.
+
+        :param name: Name of the stage
+        :param details: Values to be added (e.g. pulses=100)
+        '''
+        for record in reversed(self.stages):
+            if record['stage'] == name:
+                record.update(details)
+                return
+
+    def report(self):
+        '''
+        :return: A dictionary of the measurements (total wall time and a list of stages in the order they started)
+        '''
+        return {'wall_time': time.perf_counter() - self.began,
+                'memory_traced': self.memory,
+                'stages': sorted(self.stages, key=lambda record: record['start'])}
+
+    def save(self, file_name, **info):
+        '''
+        Saves the measurements as a JSON file.
+
+        :param file_name: Path to the JSON file
+        :param info: Additional information to be saved (e.g. path of the recording)
+        '''
+        report = dict(info)
+        report.update(self.report())
+        os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+        with open(file_name, 'w') as file:
+            json.dump(report, file, indent=2, default=str)
+
+    def close(self):
+        '''
+        Stops tracing memory if the profiler started it.
+        '''
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+@contextmanager
+def stage(profiler, name):
+    '''
+    Measures a stage with a profiler, or does nothing if there is no profiler (a context manager).
+
+    :param profiler: A Profiler or None
+    :param name: Name of the stage
+    :return: A dictionary to which details of the stage can be added
+    '''
+    if profiler is None:
+        yield {}
+    else:
+        with profiler.stage(name) as record:
+            yield record
@@ -0,0 +1,159 @@
+import numpy as np
+
+# This file contains a container which stores the pulses of a signal without splitting it into separate arrays
+
+class PulseStore:
+    '''
+    Pulses of a signal stored as the signal itself plus the boundaries of the pulses (onsets).
+
+    Pulse i covers signal[indptr[i]:indptr[i + 1]], so pulses are only created (as views of the signal, without copying)
+    when they are accessed. Statistics of all pulses can be calculated at once with segment reductions.
+    '''
+
+    def __init__(self, signal, indptr):
+        '''
+        :param signal: Signal containing the pulses
+        :param indptr: Boundaries of the pulses (the start of every pulse followed by the end of the last pulse)
+        '''
+        self.signal = np.asarray(signal)
+        self.indptr = np.asarray(indptr, dtype=int)
+
+    @classmethod
+    def from_onsets(cls, signal, onsets):
+        '''
+        Creates a store of pulses split at the given onsets (as numpy.split). The first pulse starts at the beginning of
+        the signal and the last one ends at the end of the signal.
+
+        :param signal: Signal to be split into pulses
+        :param onsets: Indices at which new pulses start
+        :return: A PulseStore of the pulses
+        '''
+        onsets = np.clip(np.asarray(onsets, dtype=int), 0, len(signal))
+        return cls(signal, np.concatenate(([0], onsets, [len(signal)])))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, key):
+        '''
+        :param key: Index of a pulse, or a slice of pulses
+        :return: The pulse as a view of the signal, or a PulseStore of the selected pulses
+        '''
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("Pulses can only be sliced contiguously")
+            return PulseStore(self.signal, self.indptr[start:max(stop, start) + 1])
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Pulse index out of range")
+        return self.signal[self.indptr[key]:self.indptr[key + 1]]
+
+    def __iter__(self):
+        signal = self.signal
+        indptr = self.indptr.tolist()
+        for start, end in zip(indptr[:-1], indptr[1:]):
+            yield signal[start:end]
+
+    @property
+    def starts(self):
+        '''
+        :return: Index of the first sample of every pulse
+        '''
+        return self.indptr[:-1]
+
+    @property
+    def lengths(self):
+        '''
+        :return: Number of samples in every pulse
+        '''
+        return np.maximum(np.diff(self.indptr), 0)
+
+    def is_monotonic(self):
+        '''
+        :return: True if the pulses follow each other (boundaries never decrease), which allows segment reductions
+        '''
+        return bool(np.all(np.diff(self.indptr) >= 0))
+
+    def reduce(self, ufunc, values=None, empty=np.nan):
+        '''
+        Reduces every pulse to a single value with a numpy ufunc (e.g. np.add for the sum of each pulse).
+
+        :param ufunc: A numpy ufunc used for the reduction (np.add, np.maximum, np.minimum, ...)
+        :param values: Values aligned with the signal to be reduced instead of the signal itself (e.g. its square)
+        :param empty: Result for pulses which contain no samples
+        :return: An array with the reduction of each pulse
+        '''
+        values = self.signal if values is None else np.asarray(values)
+        result = np.full(len(self), empty, dtype=np.result_type(values, float))
+        lengths = self.lengths
+        filled = lengths > 0
+        if not filled.any():
+            return result
+        if self.is_monotonic():
+            # reduceat reduces from each start to the next one, so empty pulses are left out and the values are cut at
+            # the end of the last pulse
+            result[filled] = ufunc.reduceat(values[:self.indptr[-1]], self.starts[filled])
+        else:
+            for i in np.flatnonzero(filled):
+                result[i] = ufunc.reduce(values[self.indptr[i]:self.indptr[i + 1]])
+        return result
+
+    def sum(self, values=None):
+        '''
+        :param values: Values aligned with the signal to be summed instead of the signal itself
+        :return: Sum of every pulse (0 for empty pulses)
+        '''
+        return self.reduce(np.add, values, empty=0)
+
+    def min(self):
+        '''
+        :return: Minimum of every pulse (NaN for empty pulses)
+        '''
+        return self.reduce(np.minimum)
+
+    def max(self):
+        '''
+        :return: Maximum of every pulse (NaN for empty pulses)
+        '''
+        return self.reduce(np.maximum)
+
+    def mean(self, values=None):
+        '''
+        :param values: Values aligned with the signal to be averaged instead of the signal itself
+        :return: Mean of every pulse (NaN for empty pulses)
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(values) / self.lengths
+
+    def expand(self, per_pulse):
+        '''
+        Repeats one value per pulse for every sample of the pulse, so that it can be combined with the samples of
+        consecutive pulses (signal[indptr[0]:indptr[-1]]).
+
+        :param per_pulse: An array with one value per pulse
+        :return: An array with the value of each pulse repeated for all its samples
+        '''
+        return np.repeat(per_pulse, self.lengths)
+
+    def deviations(self, means=None):
+        '''
+        Subtracts the mean of each pulse from its samples (for central moments of all pulses at once). Only valid for
+        monotonic stores.
+
+        :param means: Mean of every pulse (calculated if not given)
+        :return: An array aligned with the signal containing deviations from the pulse means (zero outside the pulses)
+        '''
+        if means is None:
+            means = self.mean()
+        start, end = self.indptr[0], self.indptr[-1]
+        deviations = np.zeros(len(self.signal))
+        deviations[start:end] = self.signal[start:end] - self.expand(means)
+        return deviations
+
+    def to_list(self):
+        '''
+        :return: A list of the pulses (as views of the signal)
+        '''
+        return list(self)
@@ -1,9 +1,14 @@
 from scipy.special import erf
 from scipy.optimize import curve_fit
 import numpy as np
+import batch_fit
 
 # This file contains functions to perform skewed Gaussian decomposition
 
+# Names of the parameters of the four skewed Gaussian model (as columns of the decomposition results)
+names = ['a1', 'loc1', 'scale1', 'shape1', 'a2', 'loc2', 'scale2', 'shape2',
+         'a3', 'loc3', 'scale3', 'shape3', 'a4', 'loc4', 'scale4', 'shape4']
+
 def skewed_gaussian(t, a, loc, scale, shape):
     '''
     Calculates the value of a skewed Gaussian function with given parameters at the given time
@@ -17,6 +22,61 @@ def skewed_gaussian(t, a, loc, scale, shape):
     '''
     return (a / (scale * np.sqrt(2 * np.pi))) * np.exp(-np.square(t - loc)/(2 * np.square(scale))) * (1 + erf(shape * (t - loc)/np.sqrt(2) * scale))
 
+def skewed_gaussian_derivatives(t, a, loc, scale, shape):
+    '''
+    Calculates the partial derivatives of a skewed Gaussian function with respect to its parameters at the given time
+
+    :param t: Time to evaluate the derivatives at
+    :param a: Amplitude of the skewed Gaussian function
+    :param loc: Location parameter of the skewed Gaussian function
+    :param scale: Scale parameter of the skewed Gaussian function
+    :param shape: Shape parameter of the skewed Gaussian function
+    :return: Derivatives with respect to the amplitude, location, scale and shape (in this order)
+    '''
+    # Split the function into normalisation, exponential and skewing factors (see skewed_gaussian)
+    x = t - loc
+    norm = 1 / (scale * np.sqrt(2 * np.pi))
+    exponential = np.exp(-np.square(x) / (2 * np.square(scale)))
+    z = shape * x / np.sqrt(2) * scale
+    skewing = 1 + erf(z)
+    # Derivative of erf(z) with respect to z
+    d_erf = 2 / np.sqrt(np.pi) * np.exp(-np.square(z))
+
+    d_a = norm * exponential * skewing
+    d_loc = a * norm * exponential * (x / np.square(scale) * skewing - d_erf * shape * scale / np.sqrt(2))
+    d_scale = a * norm * exponential * ((np.square(x) / np.power(scale, 3) - 1 / scale) * skewing + d_erf * shape * x / np.sqrt(2))
+    d_shape = a * norm * exponential * d_erf * x * scale / np.sqrt(2)
+    return d_a, d_loc, d_scale, d_shape
+
+def skewed_gaussian4_jacobian(t, a1, loc1, scale1, shape1, a2, loc2, scale2, shape2, a3, loc3, scale3, shape3, a4, loc4, scale4, shape4):
+    '''
+    Calculates the Jacobian of the sum of four skewed Gaussian functions (see skewed_gaussian4) with respect to its parameters
+
+    :param t: Time to evaluate the Jacobian at
+    :param a1: Amplitude of the first skewed Gaussian function
+    :param loc1: Location parameter of the first skewed Gaussian function
+    :param scale1: Scale parameter of the first skewed Gaussian function
+    :param shape1: Shape parameter of the first skewed Gaussian function
+    :param a2: Amplitude of the second skewed Gaussian function
+    :param loc2: Location parameter of the second skewed Gaussian function
+    :param scale2: Scale parameter of the second skewed Gaussian function
+    :param shape2: Shape parameter of the second skewed Gaussian function
+    :param a3: Amplitude of the third skewed Gaussian function
+    :param loc3: Location parameter of the third skewed Gaussian function
+    :param scale3: Scale parameter of the third skewed Gaussian function
+    :param shape3: Shape parameter of the third skewed Gaussian function
+    :param a4: Amplitude of the fourth skewed Gaussian function
+    :param loc4: Location parameter of the fourth skewed Gaussian function
+    :param scale4: Scale parameter of the fourth skewed Gaussian function
+    :param shape4: Shape parameter of the fourth skewed Gaussian function
+    :return: An array with one row per time point and one column per parameter
+    '''
+    # Stack parameter-major so that each derivative is contiguous and return a (time x parameter) view
+    return np.moveaxis(np.stack(skewed_gaussian_derivatives(t, a1, loc1, scale1, shape1)
+                    + skewed_gaussian_derivatives(t, a2, loc2, scale2, shape2)
+                    + skewed_gaussian_derivatives(t, a3, loc3, scale3, shape3)
+                    + skewed_gaussian_derivatives(t, a4, loc4, scale4, shape4), axis=0), 0, -1)
+
 def skewed_gaussian4(t, a1, loc1, scale1, shape1, a2, loc2, scale2, shape2, a3, loc3, scale3, shape3, a4, loc4, scale4, shape4):
     '''
     Calculates the value of a sum of four skewed Gaussian functions with given parameters at the given time
@@ -45,15 +105,33 @@ def skewed_gaussian4(t, a1, loc1, scale1, shape1, a2, loc2, scale2, shape2, a3,
             + skewed_gaussian(t, a3, loc3, scale3, shape3)
             + skewed_gaussian(t, a4, loc4, scale4, shape4))
 
-def fit(pulse, initials=[0.05, 0.2, 1/8, 0.1, 0.05, 0.4, 1/8, 0.1, 0.05, 0.6, 1/8, 0.1, 0.05, 0.8, 1/8, 0.1]):
+def fit(pulse, initials=[0.05, 0.2, 1/8, 0.1, 0.05, 0.4, 1/8, 0.1, 0.05, 0.6, 1/8, 0.1, 0.05, 0.8, 1/8, 0.1], maxfev=100000, full_output=False):
     '''
     Performs decomposition of a PPG pulse into four Skewed Gaussian functions
 
     :param pulse: Pulse to be decomposed
     :param initials: Initial values of the parameters (amplitude, location, scale, and shape for 4 Gaussian functions)
-    :return: Parameters of the four skewed Gaussian functions fitting the pulse
+    :param maxfev: Maximum number of function evaluations
+    :param full_output: A boolean to also return the number of function evaluations of the fit
+    :return: Parameters of the four skewed Gaussian functions fitting the pulse (and the number of function evaluations)
     '''
     time = np.arange(pulse.size)
     time = time / pulse.size
-    opt, covar = curve_fit(skewed_gaussian4, time, pulse, p0=initials, maxfev=100000, bounds=(0, np.inf))
-    return opt
\ No newline at end of file
+    opt, covar, info, message, status = curve_fit(skewed_gaussian4, time, pulse, p0=initials, maxfev=maxfev, bounds=(0, np.inf), jac=skewed_gaussian4_jacobian, full_output=True)
+    return (opt, info['nfev']) if full_output else opt
+
+def fit_batch(pulses, initials=[0.05, 0.2, 1/8, 0.1, 0.05, 0.4, 1/8, 0.1, 0.05, 0.6, 1/8, 0.1, 0.05, 0.8, 1/8, 0.1], max_iter=1000, ftol=1e-8, xtol=1e-8, full_output=False):
+    '''
+    Performs decomposition of many PPG pulses into four skewed Gaussian functions at once with the batched
+    Levenberg-Marquardt engine
+
+    :param pulses: A list of pulses to be decomposed
+    :param initials: Initial values of the parameters (amplitude, location, scale, and shape for 4 Gaussian functions)
+    :param max_iter: Maximum number of iterations
+    :param ftol: Relative reduction of the sum of squares at which a fit stops
+    :param xtol: Relative change of the parameters at which a fit stops
+    :param full_output: A boolean to also return the number of evaluations of the model (one per pulse evaluated)
+    :return: A matrix of parameters of the four skewed Gaussian functions with one row per pulse (and the number of
+        evaluations)
+    '''
+    return batch_fit.levenberg_marquardt(skewed_gaussian4, skewed_gaussian4_jacobian, pulses, initials, max_iter=max_iter, ftol=ftol, xtol=xtol, full_output=full_output)
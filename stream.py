@@ -0,0 +1,369 @@
+import argparse
+import sys
+import time
+import numpy as np
+import pandas as pd
+from dotmap import DotMap
+from scipy import signal as sp
+# Import internal
+import process_signal as ps
+import gaussian
+import skewed
+import vpg
+import loaders
+
+# This file contains the streaming mode, which extracts features of every pulse as soon as it is complete
+
+class RingBuffer:
+    '''
+    Keeps the most recent samples of a stream in a fixed-size array. Samples are addressed by their position in the
+    stream (the number of samples pushed before them), not by their position in the array.
+    '''
+
+    def __init__(self, length):
+        '''
+        :param length: Number of samples kept
+        '''
+        self.buffer = np.zeros(length)
+        self.count = 0
+
+    def append(self, values):
+        '''
+        :param values: Samples to be added to the end of the stream (only the last samples are kept if there are more
+            than the buffer holds)
+        '''
+        values = np.asarray(values, dtype=float)
+        kept = values[-len(self.buffer):]
+        positions = (self.count + len(values) - len(kept) + np.arange(len(kept))) % len(self.buffer)
+        self.buffer[positions] = kept
+        self.count += len(values)
+
+    def get(self, start, end):
+        '''
+        :param start: Position of the first sample in the stream
+        :param end: Position after the last sample in the stream
+        :return: A copy of the samples between start and end
+        '''
+        if start < self.count - len(self.buffer) or end > self.count or start > end:
+            raise IndexError("Samples are not in the buffer")
+        return self.buffer[np.arange(start, end) % len(self.buffer)]
+
+class MovingAverage:
+    '''
+    Causal moving average keeping the samples of the previous call, so that a signal can be smoothed block by block.
+    '''
+
+    def __init__(self, win):
+        '''
+        :param win: Window length in samples
+        '''
+        self.b = np.ones(win) / win
+        self.zi = np.zeros(win - 1)
+
+    def __call__(self, values):
+        out, self.zi = sp.lfilter(self.b, 1, values, zi=self.zi)
+        return out
+
+class PulseStream:
+    '''
+    Extracts features of a PPG signal received block by block (e.g. from a bedside monitor).
+
+    Samples are filtered as they arrive with the same filters as pyPPG, but applied causally (forwards only, keeping
+    filter states between blocks), so the filtered signal is delayed and differs slightly from offline processing. Pulse
+    onsets are detected from the systolic upstroke of the VPG, and every pulse is decomposed and its VPG features are
+    calculated as soon as the onset of the next pulse is detected.
+    '''
+
+    def __init__(self,
+                 fs=200,
+                 fL=0.5,
+                 fH=12,
+                 order=4,
+                 sm_wins={'ppg':50, 'vpg':10, 'apg':10, 'jpg':10},
+                 enable_gauss=True,
+                 g_values=[0.9, 0.2, 10, 2/3, 0.4, 10, 0.5, 0.6, 10, 1/3, 0.8, 10],
+                 enable_skewed=True,
+                 s_values=[0.08, 0.2, 1/8, 1, 0.04, 0.4, 1/8, 1, 0.04, 0.6, 1/8, 1, 0.02, 0.8, 1/8, 1],
+                 backend='batch',
+                 buffer=10,
+                 min_pulse=0.3,
+                 max_pulse=2.0,
+                 settle=2.0,
+                 threshold=0.3):
+        '''
+        :param fs: Sampling frequency of the PPG signal
+        :param fL: Lower filter cutoff frequency in Hz
+        :param fH: Higher filter cutoff frequency in Hz
+        :param order: Filter order
+        :param sm_wins: Dictionary of smoothing windows (in ms) for the PPG and its derivatives
+        :param enable_gauss: Boolean value to enable Gaussian decomposition
+        :param g_values: Initial values for Gaussian decomposition parameters
+        :param enable_skewed: Boolean value to enable Skewed Gaussian decomposition
+        :param s_values: Initial values for Skewed Gaussian decomposition parameters
+        :param backend: Fitting backend for decomposition ('batch' for the Levenberg-Marquardt engine, 'curve_fit' for
+            SciPy, which can take much longer for some pulses)
+        :param buffer: Length of the signal kept in memory (in seconds), which has to be longer than the longest and the
+            shortest pulse together
+        :param min_pulse: Shortest accepted pulse (in seconds), also the shortest time between two onsets
+        :param max_pulse: Longest accepted pulse (in seconds), longer pulses are dropped
+        :param settle: Time (in seconds) at the start of the stream during which filters settle and no onsets are detected
+        :param threshold: Fraction of the typical systolic VPG peak at which an upstroke is detected
+        '''
+        if int(buffer * fs) <= int(max_pulse * fs) + int(min_pulse * fs):
+            raise ValueError("The buffer has to be longer than the longest pulse and the shortest pulse together")
+        self.fs = fs
+        self.enable_gauss = enable_gauss
+        self.g_values = g_values
+        self.enable_skewed = enable_skewed
+        self.s_values = s_values
+        self.backend = backend
+        self.min_pulse = int(min_pulse * fs)
+        self.max_pulse = int(max_pulse * fs)
+        self.settle = int(settle * fs)
+        self.threshold = threshold
+
+        # Filters (as pyPPG.preproc, but causal)
+        if fL == 0:
+            self.sos = sp.cheby2(order, 20, [fH], 'low', fs=fs, output='sos')
+        else:
+            self.sos = sp.cheby2(order, 20, [fL, fH], 'bandpass', fs=fs, output='sos')
+        self.zi = np.zeros((self.sos.shape[0], 2))
+        self.smooth_ppg = MovingAverage(round(fs * sm_wins['ppg'] / 1000)) if fs >= 75 else None
+        self.smooth_vpg = MovingAverage(round(fs * sm_wins['vpg'] / 1000)) if fs >= 150 else None
+        self.previous = None
+
+        # Signals
+        self.ppg = RingBuffer(int(buffer * fs))
+        self.vpg = RingBuffer(int(buffer * fs))
+
+        # Onset detection state
+        self.peak = 0.0
+        self.upstroke = None
+        self.upstroke_peak = 0.0
+        self.onset = None
+        self.pulses = 0
+
+    def filter(self, values):
+        '''
+        Filters a block of raw samples and obtains the VPG, continuing from the end of the previous block.
+
+        :param values: A block of raw samples
+        :return: The filtered PPG and VPG of the block
+        '''
+        ppg, self.zi = sp.sosfilt(self.sos, values, zi=self.zi)
+        if self.smooth_ppg is not None:
+            ppg = self.smooth_ppg(ppg)
+        # Backward difference (np.gradient needs the next sample)
+        vpg = np.diff(ppg, prepend=ppg[0] if self.previous is None else self.previous)
+        self.previous = ppg[-1]
+        if self.smooth_vpg is not None:
+            vpg = self.smooth_vpg(vpg)
+        return ppg, vpg
+
+    def push(self, values):
+        '''
+        Adds a block of raw samples to the stream.
+
+        :param values: A block of raw PPG samples (of any length)
+        :return: A list of dictionaries of features, one for every pulse completed by the block
+        '''
+        values = np.asarray(values, dtype=float)
+        # A pulse is processed when the next upstroke is detected, up to max_pulse + min_pulse samples after its onset,
+        # so longer blocks are split into pieces short enough for the whole pulse to still be in the buffer
+        size = len(self.ppg.buffer) - self.max_pulse - self.min_pulse
+        if len(values) > size:
+            return [result for first in range(0, len(values), size) for result in self.push_block(values[first:first + size])]
+        return self.push_block(values)
+
+    def push_block(self, values):
+        '''
+        Adds a block of raw samples to the stream.
+
+        :param values: A block of raw PPG samples, short enough for its pulses to be in the buffer (see push)
+        :return: A list of dictionaries of features, one for every pulse completed by the block
+        '''
+        if len(values) == 0:
+            return []
+        first = self.ppg.count
+        ppg, vpg = self.filter(values)
+        self.ppg.append(ppg)
+        self.vpg.append(vpg)
+
+        results = []
+        for i in range(len(vpg)):
+            position = first + i
+            if position < self.settle:
+                # Learn the size of systolic upstrokes while the filters settle
+                self.peak = max(self.peak, vpg[i])
+                continue
+            if self.upstroke is not None:
+                # Follow the upstroke to its peak, then update the typical peak
+                if vpg[i] > 0:
+                    self.upstroke_peak = max(self.upstroke_peak, vpg[i])
+                    continue
+                self.peak = 0.8 * self.peak + 0.2 * self.upstroke_peak
+                self.upstroke = None
+            if vpg[i] > self.threshold * self.peak and (self.onset is None or position - self.onset >= self.min_pulse):
+                self.upstroke = position
+                self.upstroke_peak = vpg[i]
+                onset = self.find_onset(position)
+                if self.onset is not None and onset - self.onset >= self.min_pulse:
+                    if onset - self.onset <= self.max_pulse:
+                        result = self.process_pulse(self.onset, onset)
+                        result['detected'] = position
+                        results.append(result)
+                    self.onset = onset
+                elif self.onset is None:
+                    self.onset = onset
+        return results
+
+    def find_onset(self, position):
+        '''
+        Finds the onset of a pulse as the minimum of the PPG before its systolic upstroke.
+
+        :param position: Position at which the upstroke was detected
+        :return: Position of the onset
+        '''
+        start = max(position - self.min_pulse, self.settle, self.ppg.count - len(self.ppg.buffer))
+        if self.onset is not None:
+            start = max(start, self.onset + 1)
+        if start >= position:
+            return position
+        return start + int(np.argmin(self.ppg.get(start, position + 1)))
+
+    def process_pulse(self, start, end):
+        '''
+        Decomposes a complete pulse and calculates its VPG features.
+
+        :param start: Position of the onset of the pulse
+        :param end: Position of the onset of the next pulse
+        :return: A dictionary of features (Pulse, on, end, Gaussian parameters prefixed with 'gauss_', skewed Gaussian
+            parameters prefixed with 'skewed_' and VPG features)
+        '''
+        pulse = self.ppg.get(start, end)
+        pulse_vpg = self.vpg.get(start, end)
+        result = {'Pulse': self.pulses, 'on': start, 'end': end}
+        self.pulses += 1
+
+        decompPulses = ps.preprocess_pulses([pulse])
+        if self.enable_gauss:
+            result.update(self.fit(lambda: ps.get_gaussians(decompPulses, g_values=self.g_values, backend=self.backend, preprocess=False),
+                                   gaussian.names, 'gauss'))
+        if self.enable_skewed:
+            result.update(self.fit(lambda: ps.get_skewed(decompPulses, initials=self.s_values, backend=self.backend, preprocess=False),
+                                   skewed.names, 'skewed'))
+
+        fp = DotMap(on=[0], dn=[dicrotic_notch(pulse, pulse_vpg)])
+        result.update(vpg.phase_features(pulse_vpg, fp).iloc[0].to_dict())
+        return result
+
+    def fit(self, decompose, names, prefix):
+        '''
+        Runs a decomposition, keeping the stream alive if the fit fails.
+
+        :param decompose: Function returning a dataframe of fitted parameters of the pulse
+        :param names: Names of the parameters
+        :param prefix: Prefix added to the parameter names (so that both decompositions can be combined)
+        :return: A dictionary of fitted parameters (NaN if the fit failed)
+        '''
+        try:
+            params = decompose().iloc[0]
+        except (RuntimeError, ValueError):
+            params = pd.Series(np.nan, index=names)
+        return {f"{prefix}_{name}": params[name] for name in names}
+
+def dicrotic_notch(pulse, pulse_vpg):
+    '''
+    Locates the dicrotic notch of a pulse as the first local minimum of the PPG after the systolic peak, or as the point
+    of the greatest upward curvature after the peak if the notch does not form a minimum.
+
+    :param pulse: Filtered PPG pulse
+    :param pulse_vpg: VPG of the pulse
+    :return: Index of the dicrotic notch in the pulse
+    '''
+    peak = int(np.argmax(pulse))
+    minima = np.flatnonzero((pulse_vpg[peak:-1] < 0) & (pulse_vpg[peak + 1:] >= 0))
+    if len(minima):
+        return peak + int(minima[0]) + 1
+    if peak >= len(pulse) - 2:
+        return peak
+    return peak + int(np.argmax(np.gradient(pulse_vpg[peak:])))
+
+def replay(path, fs=200, start=0, end=-1, speed=1.0, block=0.04, **options):
+    '''
+    Feeds a recording to a PulseStream block by block, as a live signal would arrive, and measures the latency of every
+    pulse.
+
+    :param path: Path of a file containing the PPG signal
+    :param fs: Sampling frequency of the PPG signal
+    :param start: Start of the signal
+    :param end: End of the signal (-1 for the whole signal)
+    :param speed: Replay speed relative to real time (e.g. 2 for twice as fast, None to feed blocks as fast as possible)
+    :param block: Length of each block (in seconds)
+    :param options: Parameters of the PulseStream
+    :return: A dataframe of features by pulse, with the delay of detection (from the end of the pulse to the sample at
+        which it was detected, in seconds) and the latency (from the arrival of the last sample of the pulse to the
+        output of its features, in seconds)
+    '''
+    signal = loaders.load(path, fs, start, end)
+    stream = PulseStream(fs=signal.fs, **options)
+    size = max(int(block * signal.fs), 1)
+    arrivals = []
+    results = []
+    began = time.perf_counter()
+    for first in range(0, len(signal.v), size):
+        values = signal.v[first:first + size]
+        if speed:
+            # Wait until the last sample of the block would have been recorded
+            delay = began + (first + len(values)) / signal.fs / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        arrivals.append(time.perf_counter())
+        pulses = stream.push(values)
+        finished = time.perf_counter()
+        for result in pulses:
+            # The pulse was complete once its last sample (end - 1) had arrived
+            result['delay'] = (result['detected'] - result['end'] + 1) / signal.fs
+            result['latency'] = finished - arrivals[(result['end'] - 1) // size]
+            results.append(result)
+
+    table = pd.DataFrame(results)
+    if len(table):
+        table = table.set_index('Pulse')
+    return table
+
+def main(argv=None):
+    '''
+    Entry point of the replay harness.
+
+    :param argv: Command line arguments (default: sys.argv[1:])
+    :return: Exit code
+    '''
+    parser = argparse.ArgumentParser(prog='stream', description="Replay a recording through the streaming mode and report the latency of every pulse.")
+    parser.add_argument('path', help="recording to be replayed")
+    parser.add_argument('--fs', type=int, default=200, help="sampling frequency in Hz (default: 200)")
+    parser.add_argument('--start', type=int, default=0, help="start of the signal")
+    parser.add_argument('--end', type=int, default=-1, help="end of the signal (-1 for the whole signal)")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed relative to real time, 0 for as fast as possible (default: 1)")
+    parser.add_argument('--block', type=float, default=0.04, help="length of each block in seconds (default: 0.04)")
+    parser.add_argument('--backend', choices=ps.backends, default='batch', help="fitting backend (default: batch)")
+    parser.add_argument('--no-gauss', action='store_true', help="skip Gaussian decomposition")
+    parser.add_argument('--no-skewed', action='store_true', help="skip skewed Gaussian decomposition")
+    parser.add_argument('-o', '--output', help="CSV file for the features and latency of every pulse")
+    args = parser.parse_args(argv)
+
+    table = replay(args.path, fs=args.fs, start=args.start, end=args.end, speed=args.speed or None, block=args.block,
+                   enable_gauss=not args.no_gauss, enable_skewed=not args.no_skewed, backend=args.backend)
+    if args.output:
+        table.to_csv(args.output)
+    if len(table) == 0:
+        print("No pulses detected.")
+        return 1
+    for name in ['delay', 'latency']:
+        values = table[name]
+        print(f"{name} (s): median {values.median():.4f}, 95th percentile {values.quantile(0.95):.4f}, maximum {values.max():.4f}")
+    print(f"{len(table)} pulses")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+import gaussian
+import skewed
+
+# This file contains a generator of synthetic PPG recordings built from the pulse decomposition models
+
+# Parameters of a typical pulse for every model (on the normalised time axis of a pulse, as fitted by the decompositions)
+gauss_params = [1.0, 0.2, 0.07, 0.6, 0.35, 0.08, 0.45, 0.55, 0.08, 0.2, 0.75, 0.08]
+skewed_params = [0.1, 0.2, 0.08, 2, 0.06, 0.35, 0.1, 1, 0.05, 0.55, 0.1, 1, 0.02, 0.75, 0.1, 1]
+
+# Pulse function, parameter names and typical parameters of every model
+models = {'gaussian': (gaussian.gaussians, gaussian.names, gauss_params),
+          'skewed': (skewed.skewed_gaussian4, skewed.names, skewed_params)}
+
+def pulse_lengths(fs, duration, heart_rate, variability=0.05, rng=None):
+    '''
+    Draws the lengths of consecutive pulses filling a recording.
+
+    :param fs: Sampling frequency (Hz)
+    :param duration: Length of the recording (s) - only whole pulses are generated, so the recording may be shorter
+    :param heart_rate: Mean heart rate (beats per minute)
+    :param variability: Standard deviation of the pulse length relative to the mean pulse length
+    :param rng: A numpy random Generator
+    :return: An array of pulse lengths (samples)
+    '''
+    rng = rng if rng is not None else np.random.default_rng()
+    mean = fs * 60 / heart_rate
+    lengths = []
+    total = 0
+    while True:
+        length = int(round(mean * (1 + variability * rng.standard_normal())))
+        # Keep pulses long enough for the decompositions to be fitted
+        length = max(length, 20)
+        if total + length > fs * duration:
+            break
+        lengths.append(length)
+        total += length
+    return np.array(lengths, dtype=int)
+
+def pulse_params(model, count, params=None, jitter=0.05, rng=None):
+    '''
+    Draws the ground truth parameters of every pulse around the parameters of a typical pulse.
+
+    :param model: Name of the model - 'gaussian' or 'skewed'
+    :param count: Number of pulses
+    :param params: Parameters of a typical pulse (None for the defaults of the model)
+    :param jitter: Standard deviation of every parameter relative to its typical value
+    :param rng: A numpy random Generator
+    :return: A dataframe of parameters by pulse (with the columns of get_gaussians or get_skewed)
+    '''
+    if model not in models:
+        raise ValueError(f"Unknown model: {model}")
+    rng = rng if rng is not None else np.random.default_rng()
+    _, names, typical = models[model]
+    params = np.asarray(params if params is not None else typical, dtype=float)
+    values = params * (1 + jitter * rng.standard_normal((count, len(params))))
+    return pd.DataFrame(values, columns=names).rename_axis("Pulse")
+
+def make_pulses(model, lengths, truth):
+    '''
+    Evaluates the model for every pulse.
+
+    :param model: Name of the model - 'gaussian' or 'skewed'
+    :param lengths: Lengths of the pulses (samples)
+    :param truth: A dataframe of parameters by pulse
+    :return: A list of pulses (sample i of a pulse of length n at normalised time i/n)
+    '''
+    function = models[model][0]
+    return [function(np.arange(length) / length, *params) for length, params in zip(lengths, truth.to_numpy())]
+
+def generate(fs=200, duration=60, heart_rate=75, model='gaussian', params=None, jitter=0.05, variability=0.05, noise=0.005, wander=0.0, seed=0):
+    '''
+    Generates a synthetic PPG recording as a train of model pulses with known parameters.
+
+    :param fs: Sampling frequency (Hz)
+    :param duration: Length of the recording (s)
+    :param heart_rate: Mean heart rate (beats per minute)
+    :param model: Model the pulses are generated from - 'gaussian' or 'skewed'
+    :param params: Parameters of a typical pulse (None for the defaults of the model)
+    :param jitter: Standard deviation of every pulse parameter relative to its typical value
+    :param variability: Standard deviation of the pulse length relative to the mean pulse length
+    :param noise: Standard deviation of white noise relative to the highest pulse amplitude
+    :param wander: Amplitude of a 0.2 Hz baseline wander relative to the highest pulse amplitude
+    :param seed: Seed of the random generator (the same seed gives the same recording)
+    :return: The signal, the onsets of the pulses (indices in the signal) and a dataframe of the parameters of every
+        pulse
+    '''
+    rng = np.random.default_rng(seed)
+    lengths = pulse_lengths(fs, duration, heart_rate, variability, rng)
+    truth = pulse_params(model, len(lengths), params, jitter, rng)
+    signal = np.concatenate(make_pulses(model, lengths, truth)) if len(lengths) else np.empty(0)
+    onsets = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(lengths) else np.empty(0, dtype=int)
+
+    peak = np.max(np.abs(signal)) if len(signal) else 0
+    if noise:
+        signal = signal + noise * peak * rng.standard_normal(len(signal))
+    if wander:
+        signal = signal + wander * peak * np.sin(2 * np.pi * 0.2 * np.arange(len(signal)) / fs)
+    return signal, onsets, truth
+
+def save_csv(path, signal):
+    '''
+    Saves a signal in the format read by pyPPG's load_data (a 'PPG' column with one sample per row).
+
+    :param path: Path to the .csv file
+    :param signal: Signal to be saved
+    '''
+    np.savetxt(path, signal, header='PPG', comments='')
+
+def main(argv=None):
+    '''
+    Entry point of the generator.
+
+    :param argv: Command line arguments (default: sys.argv[1:])
+    :return: Exit code
+    '''
+    parser = argparse.ArgumentParser(prog='synthetic', description="Generate a synthetic PPG recording from a pulse decomposition model.")
+    parser.add_argument('output', help="CSV file the recording is written to")
+    parser.add_argument('--model', choices=list(models), default='gaussian', help="model the pulses are generated from (default: gaussian)")
+    parser.add_argument('--fs', type=int, default=200, help="sampling frequency in Hz (default: 200)")
+    parser.add_argument('--duration', type=float, default=60, help="length of the recording in seconds (default: 60)")
+    parser.add_argument('--heart-rate', type=float, default=75, help="mean heart rate in beats per minute (default: 75)")
+    parser.add_argument('--noise', type=float, default=0.005, help="white noise relative to the highest pulse amplitude (default: 0.005)")
+    parser.add_argument('--wander', type=float, default=0.0, help="baseline wander relative to the highest pulse amplitude (default: 0)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generator (default: 0)")
+    parser.add_argument('--truth', help="CSV file for the onset and parameters of every pulse")
+    args = parser.parse_args(argv)
+
+    signal, onsets, truth = generate(args.fs, args.duration, args.heart_rate, args.model, noise=args.noise,
+                                     wander=args.wander, seed=args.seed)
+    if len(onsets) == 0:
+        print("The recording is too short for a single pulse.")
+        return 1
+    save_csv(args.output, signal)
+    if args.truth:
+        truth.insert(0, 'onset', onsets)
+        truth.to_csv(args.truth)
+    print(f"{len(onsets)} pulses ({len(signal)} samples) saved to {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+import batch
+from batch import output_folders
+
+def test_output_folders_of_recordings_with_the_same_name():
+    paths = [os.path.join('data', 'a', 'rec.csv'), os.path.join('data', 'b', 'rec.csv'), os.path.join('data', 'b', 'rec.npy')]
+    folders = output_folders(paths, 'results')
+    assert folders == {paths[0]: os.path.join('results', 'a', 'rec'),
+                       paths[1]: os.path.join('results', 'b', 'rec_csv'),
+                       paths[2]: os.path.join('results', 'b', 'rec_npy')}
+
+def test_output_folders_of_one_folder():
+    paths = [os.path.join('data', 'rec1.csv'), os.path.join('data', 'rec2.csv')]
+    assert output_folders(paths, 'results') == {paths[0]: os.path.join('results', 'rec1'),
+                                                paths[1]: os.path.join('results', 'rec2')}
+
+def test_save_time_is_recorded_when_saving_finishes(tmp_path, monkeypatch):
+    # The first recording is saved quickly in the background while the second one takes long to process
+    def process_file(path, folder, options, saver=None):
+        result = {'file': path, 'status': 'success', 'seconds': 0, 'error': ''}
+        if path == 'slow':
+            time.sleep(0.5)
+            return result, None
+        future = Future()
+        threading.Timer(0.05, future.set_result, [{}]).start()
+        return result, future
+    monkeypatch.setattr(batch, 'process_file', process_file)
+    results = batch.run_batch(['fast', 'slow'], str(tmp_path), {})
+    assert results[0]['seconds'] < 0.3
@@ -0,0 +1,28 @@
+import os
+from functools import partial
+import numpy as np
+import wfdb
+import batch_fit
+import skewed
+from cache import SignalCache
+from process_signal import solver_settings
+
+def test_signal_key_covers_wfdb_data_files(tmp_path):
+    signal = np.sin(np.arange(1000) / 20)[:, np.newaxis]
+    wfdb.wrsamp('rec', fs=200, units=['mV'], sig_name=['PLETH'], p_signal=signal, fmt=['16'], write_dir=str(tmp_path))
+    header = str(tmp_path / 'rec.hea')
+    key = SignalCache.key(header, fs=200)
+    assert SignalCache.key(header, fs=200) == key
+
+    # Re-recording the data file (the header is not touched)
+    data = tmp_path / 'rec.dat'
+    data.write_bytes(data.read_bytes()[::-1])
+    os.utime(data, ns=(0, 10 ** 9))
+    assert SignalCache.key(header, fs=200) != key
+
+def test_fit_settings_tell_solvers_apart():
+    assert solver_settings(skewed.fit) != solver_settings(partial(skewed.fit, maxfev=100))
+    assert solver_settings(partial(skewed.fit, full_output=True)) == solver_settings(skewed.fit)
+    engine = partial(batch_fit.levenberg_marquardt, skewed.skewed_gaussian4, skewed.skewed_gaussian4_jacobian)
+    assert solver_settings(engine) != solver_settings(partial(engine, ftol=1e-6))
+    assert solver_settings(partial(engine, max_iter=1000)) == solver_settings(engine)
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import feature_stats
+
+def features(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    table = pd.DataFrame({'normal': rng.standard_normal(rows), 'skewed': rng.exponential(size=rows),
+                          'constant': np.ones(rows)})
+    table.iloc[::7, 1] = np.nan
+    return table
+
+def test_summary_matches_pandas():
+    table = features(500)
+    stats = feature_stats.summary(table)
+    expected = pd.DataFrame({'mean': table.mean(), 'median': table.median(), 'std': table.std(),
+                             'percentile_25': table.quantile(0.25), 'percentile_75': table.quantile(0.75),
+                             'skew': table.skew(), 'kurtosis': table.kurtosis()}).T
+    pd.testing.assert_frame_equal(stats.loc[expected.index], expected, rtol=1e-10, atol=1e-12)
+
+def test_running_summary_of_blocks_matches_summary():
+    table = features(1000)
+    running = feature_stats.RunningSummary()
+    for first in range(0, len(table), 64):
+        running.update(table.iloc[first:first + 64])
+    pd.testing.assert_frame_equal(running.summary(), feature_stats.summary(table), rtol=1e-10, atol=1e-12)
+
+def test_merged_running_summaries():
+    table = features(20000)
+    parts = [feature_stats.RunningSummary(capacity=1000) for _ in range(2)]
+    parts[0].update(table.iloc[:12000])
+    parts[1].update(table.iloc[12000:])
+    parts[0].merge(parts[1])
+    stats = parts[0].summary()
+    expected = feature_stats.summary(table)
+    # Moments are merged exactly, quantiles are estimated by the sketches
+    moments = ['mean', 'std', 'skew', 'kurtosis']
+    pd.testing.assert_frame_equal(stats.loc[moments], expected.loc[moments], rtol=1e-9, atol=1e-12)
+    pd.testing.assert_frame_equal(stats, expected, rtol=0, atol=0.02)
+    assert sum(len(values) for values in parts[0].sketches[0].levels) <= 2 * 1000 * len(parts[0].sketches[0].levels)
+
+def test_infinite_values_match_pandas():
+    table = pd.DataFrame({'inf': [1, np.inf, 3, np.nan, 5], 'both': [1, -np.inf, np.inf, 2, 1],
+                          'all_inf': [np.inf] * 5, 'minus_inf': [1, -np.inf, 2, 3, 4]})
+    expected = pd.DataFrame({'mean': table.mean(), 'median': table.median(), 'std': table.std(),
+                             'percentile_25': table.quantile(0.25), 'percentile_75': table.quantile(0.75),
+                             'skew': table.skew(), 'kurtosis': table.kurtosis(),
+                             'mad': (table - table.mean()).abs().mean()}).T
+    stats = feature_stats.summary(table)
+    pd.testing.assert_frame_equal(stats.loc[expected.index], expected)
+    assert np.isinf(stats.loc['mad', ['inf', 'minus_inf']]).all()
+    running = feature_stats.RunningSummary()
+    for first in range(0, len(table), 2):
+        running.update(table.iloc[first:first + 2])
+    pd.testing.assert_frame_equal(running.summary(), stats)
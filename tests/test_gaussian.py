@@ -0,0 +1,22 @@
+import numpy as np
+import gaussian
+import process_signal as ps
+import synthetic
+
+# Initial values of process_signal
+g_values = [0.9, 0.2, 10, 2/3, 0.4, 10, 0.5, 0.6, 10, 1/3, 0.8, 10]
+
+def test_fit_recovers_model_pulse_in_order():
+    truth = np.array(synthetic.gauss_params)
+    pulse = gaussian.gaussians(np.arange(160) / 160, *truth)
+    params = gaussian.find_gaussians(pulse, [0.9, 0.2, 0.01, 2/3, 0.4, 0.01, 0.5, 0.6, 0.01, 1/3, 0.8, 0.01])
+    np.testing.assert_allclose(params, truth, atol=1e-8)
+
+def test_component_order_of_fixed_pulse():
+    # The derived features (AI, RI, Sys/Dia...) depend on which component is which, so a change of solver which swaps
+    # components changes them even if the fit is as good
+    signal, onsets, _ = synthetic.generate(duration=10, seed=3)
+    pulse = list(ps.preprocess_pulses([signal[onsets[0]:onsets[1]]]))[0]
+    params = gaussian.find_gaussians(pulse, g_values)
+    assert np.all(np.diff(params[1::3]) > 0)
+    np.testing.assert_allclose(params[:6], [0.791, 0.207, 0.079, 0.500, 0.466, 0.195], atol=2e-3)
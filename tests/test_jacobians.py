@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from scipy.optimize import approx_fprime
+import gaussian
+import skewed
+import synthetic
+
+# Model function, Jacobian and typical parameters of every model
+models = {'gaussian': (gaussian.gaussians, gaussian.gaussians_jacobian, synthetic.gauss_params),
+          'skewed': (skewed.skewed_gaussian4, skewed.skewed_gaussian4_jacobian, synthetic.skewed_params)}
+
+@pytest.mark.parametrize('model', list(models))
+@pytest.mark.parametrize('seed', range(5))
+def test_jacobian_matches_finite_differences(model, seed):
+    function, jacobian, typical = models[model]
+    rng = np.random.default_rng(seed)
+    params = np.array(typical) * (1 + 0.2 * rng.standard_normal(len(typical)))
+    t = np.arange(150) / 150
+
+    analytic = jacobian(t, *params)
+    numeric = approx_fprime(params, lambda p: function(t, *p), 1e-7)
+    assert analytic.shape == (len(t), len(params))
+    np.testing.assert_allclose(analytic, numeric, rtol=1e-4, atol=1e-4 * np.max(np.abs(numeric)))
+
+@pytest.mark.parametrize('model', list(models))
+def test_jacobian_of_many_pulses(model):
+    # The batched engine evaluates the Jacobian of many pulses at once, with one column of parameters per pulse
+    function, jacobian, typical = models[model]
+    params = np.array(typical) * np.array([[1.0], [1.1], [0.9]])
+    t = np.arange(100) / 100
+    batched = jacobian(t, *params.T[:, :, np.newaxis])
+    for index, pulse_params in enumerate(params):
+        np.testing.assert_allclose(batched[index], jacobian(t, *pulse_params))
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+import synthetic
+from stream import PulseStream, RingBuffer
+
+def features(blocks, **options):
+    stream = PulseStream(enable_gauss=False, enable_skewed=False, **options)
+    results = [result for block in blocks for result in stream.push(block)]
+    return pd.DataFrame(results).drop(columns='detected')
+
+def test_ring_buffer_keeps_the_end_of_long_blocks():
+    buffer = RingBuffer(10)
+    buffer.append(np.arange(3))
+    buffer.append(np.arange(3, 25))
+    assert buffer.count == 25
+    np.testing.assert_array_equal(buffer.get(15, 25), np.arange(15, 25))
+    with pytest.raises(IndexError):
+        buffer.get(14, 25)
+
+@pytest.mark.parametrize('buffer', [10, 3])
+def test_push_whole_recording(buffer):
+    signal, onsets, _ = synthetic.generate(duration=60, seed=1)
+    blocks = features([signal[first:first + 8] for first in range(0, len(signal), 8)], buffer=buffer)
+    whole = features([signal], buffer=buffer)
+    assert len(whole) > 0.8 * len(onsets)
+    pd.testing.assert_frame_equal(whole, blocks)
+
+def test_buffer_shorter_than_pulses():
+    with pytest.raises(ValueError):
+        PulseStream(buffer=2, max_pulse=2.0)
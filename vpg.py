@@ -1,25 +1,75 @@
 import numpy as np
 import pandas as pd
+import feature_stats
+from pulses import PulseStore
 
 # This file contains functions which process additional VPG features
 
-def sys_dia(vpg, fp):
+def phase_boundaries(fp, length):
     '''
-    Splits VPG pulses into systolic and diastolic phases
+    Interleaves onsets and dicrotic notches into boundaries of systolic and diastolic phases: systolic phase i (onset to
+    dicrotic notch) lies between boundaries 2i and 2i+1, diastolic phase i (dicrotic notch to the next onset, or to the
+    end of the signal) between boundaries 2i+1 and 2i+2.
 
-    :param vpg: VPG signal to be split
     :param fp: Fiducials object containing the fiducial points data
-    :return: Two arrays, one containing parts of VPG pulses in systolic phase and the other in diastolic phase
+    :param length: Length of the signal (end of the last diastolic phase)
+    :return: An array of phase boundaries (NaN where a fiducial point is missing)
     '''
-    sys_vpg = []
-    dia_vpg = []
-    for i in range(len(fp.on)):
-        sys_vpg.append(vpg[fp.on[i] : fp.dn[i]])
-        if i == len(fp.on) - 1:
-            dia_vpg.append(vpg[fp.dn[i]:])
+    on = np.asarray(fp.on, dtype=float)
+    dn = np.asarray(fp.dn, dtype=float)
+    boundaries = np.empty(2 * len(on) + 1)
+    boundaries[0:-1:2] = on
+    boundaries[1:-1:2] = dn
+    boundaries[-1] = length
+    return boundaries
+
+def phase_features(signal, fp):
+    '''
+    Extracts mean and variance in systolic/diastolic phases of every pulse from a PPG derivative (VPG, APG or JPG).
+    All phases are reduced at once with segment reductions, unless the phase boundaries are missing or out of order, in
+    which case each phase is processed separately.
+
+    :param signal: Signal (VPG, APG or JPG) to be processed
+    :param fp: Fiducials object containing the fiducial points data
+    :return: A dataframe containing mean and variance of pulses in systolic and diastolic phases
+    '''
+    signal = np.asarray(signal, dtype=float)
+    boundaries = phase_boundaries(fp, len(signal))
+    if np.isnan(boundaries).any():
+        means, variances = phase_features_loop(signal, boundaries)
+    else:
+        phases = PulseStore(signal, np.clip(boundaries, 0, len(signal)))
+        if phases.is_monotonic():
+            means = phases.mean()
+            # Two-pass variance (as np.var) from deviations around the mean of each phase
+            variances = phases.mean(phases.deviations(means) ** 2)
         else:
-            dia_vpg.append(vpg[fp.dn[i] : fp.on[i + 1]])
-    return sys_vpg, dia_vpg
+            means, variances = phase_features_loop(signal, boundaries)
+
+    dict = {'sys_mean': means[0::2],
+            'sys_var': variances[0::2],
+            'dia_mean': means[1::2],
+            'dia_var': variances[1::2]}
+    return pd.DataFrame(dict)
+
+def phase_features_loop(signal, boundaries):
+    '''
+    Calculates mean and variance of every phase one by one (used when phases cannot be reduced at once)
+
+    :param signal: Signal to be processed
+    :param boundaries: Phase boundaries as returned by phase_boundaries
+    :return: Two arrays - mean and variance of every phase (NaN for empty phases or missing boundaries)
+    '''
+    means = np.full(len(boundaries) - 1, np.nan)
+    variances = np.full(len(boundaries) - 1, np.nan)
+    for i in range(len(boundaries) - 1):
+        if np.isnan(boundaries[i]) or np.isnan(boundaries[i + 1]):
+            continue
+        phase = signal[int(boundaries[i]):int(boundaries[i + 1])]
+        if len(phase):
+            means[i] = np.mean(phase)
+            variances[i] = np.var(phase)
+    return means, variances
 
 def features(vpg, fp):
     '''
@@ -29,19 +79,7 @@ def features(vpg, fp):
     :param fp: Fiducials object containing the fiducial points data
     :return: A dataframe containing mean and variance of VPG pulses in systolic and diastolic phases
     '''
-    dict = {'sys_mean':[],
-            'sys_var':[],
-            'dia_mean':[],
-            'dia_var':[],}
-    sys_vpg, dia_vpg = sys_dia(vpg, fp)
-    for pulse in sys_vpg:
-        dict['sys_mean'].append(np.mean(pulse))
-        dict['sys_var'].append(np.var(pulse))
-    for pulse in dia_vpg:
-        dict['dia_mean'].append(np.mean(pulse))
-        dict['dia_var'].append(np.var(pulse))
-    stats = pd.DataFrame(dict)
-    return stats
+    return phase_features(vpg, fp)
 
 def stats(features):
     '''
@@ -50,30 +88,4 @@ def stats(features):
     :param features: A dataframe of VPG features
     :return: A dataframe of VPG features statistics across all pulses
     '''
-    index = ['mean', 'median', 'std', 'percentile_25', 'percentile_75', 'iqr', 'skew', 'kurtosis', 'mad']
-    dict = {"sys_mean": [],
-            "sys_var": [],
-            "dia_mean": [],
-            "dia_var": []}
-    for key, value in features.mean().items():
-        dict[key].append(value)
-    for key, value in features.median().items():
-        dict[key].append(value)
-    for key, value in features.std().items():
-        dict[key].append(value)
-    for key, value in features.quantile(q=0.25).items():
-        dict[key].append(value)
-    for key, value in features.quantile(q=0.75).items():
-        dict[key].append(value)
-    # Subtract 75th (last item) from 25th percentile (2nd to last item) to get IQR
-    for key in dict:
-        dict[key].append(dict[key][-1] - dict[key][-2])
-    for key, value in features.skew().items():
-        dict[key].append(value)
-    for key, value in features.kurtosis().items():
-        dict[key].append(value)
-    # Mean absolute deviation
-    for key in dict:
-        dict[key].append((features[key] - features[key].mean()).abs().mean())
-
-    return pd.DataFrame(dict, index=index)
\ No newline at end of file
+    return feature_stats.summary(features)
\ No newline at end of file